@@ -0,0 +1,67 @@
+import os
+import struct
+from cffi import FFI
+
+ffi = FFI()
+ffi.cdef("""
+int inotify_init1(int flags);
+int inotify_add_watch(int fd, const char *pathname, uint32_t mask);
+int inotify_rm_watch(int fd, int wd);
+""")
+libc = ffi.dlopen(None)
+
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+
+# struct inotify_event without the name
+EVENT = struct.Struct("iIII")
+
+
+class Inotify():
+  """Non blocking inotify instance, read_events returns what happened since the last call."""
+  def __init__(self):
+    self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if self.fd == -1:
+      raise OSError(ffi.errno, f"{os.strerror(ffi.errno)}: inotify_init1")
+
+  def add_watch(self, path, mask):
+    wd = libc.inotify_add_watch(self.fd, path.encode(), mask)
+    if wd == -1:
+      raise OSError(ffi.errno, f"{os.strerror(ffi.errno)}: inotify_add_watch({path}, {mask})")
+    return wd
+
+  def rm_watch(self, wd):
+    libc.inotify_rm_watch(self.fd, wd)
+
+  def read_events(self):
+    """List of (wd, mask, name) events."""
+    events = []
+    while True:
+      try:
+        buf = os.read(self.fd, 64 * 1024)
+      except BlockingIOError:
+        break
+
+      i = 0
+      while i < len(buf):
+        wd, mask, _, length = EVENT.unpack_from(buf, i)
+        i += EVENT.size
+        name = buf[i:i + length].rstrip(b"\0").decode()
+        i += length
+        events.append((wd, mask, name))
+    return events
+
+  def close(self):
+    if self.fd >= 0:
+      os.close(self.fd)
+      self.fd = -1
@@ -117,6 +117,8 @@ class SwagLogger(logging.Logger):
     evt.update(kwargs)
     if 'error' in kwargs:
       self.error(evt)
+    elif 'debug' in kwargs:
+      self.debug(evt)
     else:
       self.info(evt)
 
@@ -1,22 +1,52 @@
+from bisect import bisect_left
+
+
 def int_rnd(x):
   return int(round(x))
 
 def clip(x, lo, hi):
-  return max(lo, min(hi, x))
+  # same as max(lo, min(hi, x)) without the builtin calls
+  x = x if x < hi else hi
+  return x if x > lo else lo
+
+def _interp(xv, xp, fp, N):
+  hi = bisect_left(xp, xv)
+  if hi == N:
+    return fp[-1]
+  elif hi == 0:
+    return fp[0]
+  low = hi - 1
+  return (xv - xp[low]) * (fp[hi] - fp[low]) / (xp[hi] - xp[low]) + fp[low]
 
 def interp(x, xp, fp):
   N = len(xp)
-
-  def get_interp(xv):
-    hi = 0
-    while hi < N and xv > xp[hi]:
-      hi += 1
-    low = hi - 1
-    return fp[-1] if hi == N and xv > xp[low] else (
-      fp[0] if hi == 0 else
-      (xv - xp[low]) * (fp[hi] - fp[low]) / (xp[hi] - xp[low]) + fp[low])
-
-  return [get_interp(v) for v in x] if hasattr(x, '__iter__') else get_interp(x)
+  if hasattr(x, '__iter__'):
+    return [_interp(v, xp, fp, N) for v in x]
+  return _interp(x, xp, fp, N)
 
 def mean(x):
   return sum(x) / len(x)
+
+
+class Interpolator():
+  """interp for constant tables. The breakpoints are copied into tuples of floats
+     once, so numpy arrays and capnp lists don't have to be indexed on every call."""
+  def __init__(self, xp, fp):
+    assert len(xp) == len(fp) > 0, "breakpoints and values must have the same, nonzero length"
+    self.xp = tuple(float(v) for v in xp)
+    self.fp = tuple(float(v) for v in fp)
+    self.dxp = tuple(b - a for a, b in zip(self.xp, self.xp[1:]))
+    self.dfp = tuple(b - a for a, b in zip(self.fp, self.fp[1:]))
+    self.N = len(self.xp)
+
+  def __call__(self, x):
+    if hasattr(x, '__iter__'):
+      return [self(v) for v in x]
+
+    hi = bisect_left(self.xp, x)
+    if hi == self.N:
+      return self.fp[-1]
+    elif hi == 0:
+      return self.fp[0]
+    low = hi - 1
+    return (x - self.xp[low]) * self.dfp[low] / self.dxp[low] + self.fp[low]
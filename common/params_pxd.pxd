@@ -1,5 +1,7 @@
 from libcpp.string cimport string
 from libcpp cimport bool
+from libcpp.map cimport map
+from libcpp.vector cimport vector
 
 cdef extern from "selfdrive/common/params.cc":
   pass
@@ -11,6 +13,23 @@ cdef extern from "selfdrive/common/params.h":
   cdef cppclass Params:
     Params(bool)
     Params(string)
+    string get_params_path()
     string get(string, bool) nogil
+    int read_db_value_blocking(const char*, char**, size_t*, int) nogil
     int delete_db_value(string)
     int write_db_value(string, string)
+    int write_db_values(map[string, string], vector[string]) nogil
+
+cdef extern from "sys/inotify.h":
+  int inotify_init1(int)
+  int inotify_add_watch(int, const char*, unsigned int)
+  enum:
+    IN_CLOEXEC
+    IN_CREATE
+    IN_DELETE
+    IN_MOVED_FROM
+    IN_MOVED_TO
+    IN_CLOSE_WRITE
+    IN_Q_OVERFLOW
+    IN_DELETE_SELF
+    IN_IGNORED
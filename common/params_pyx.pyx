@@ -1,10 +1,16 @@
 # distutils: language = c++
 # cython: language_level = 3
 from libcpp cimport bool
+from libcpp.map cimport map
 from libcpp.string cimport string
+from libcpp.vector cimport vector
+from libc.stdlib cimport free
 from params_pxd cimport Params as c_Params
+from params_pxd cimport inotify_init1, inotify_add_watch, IN_CLOEXEC, IN_CREATE, IN_DELETE, \
+                        IN_MOVED_FROM, IN_MOVED_TO, IN_CLOSE_WRITE, IN_Q_OVERFLOW, IN_DELETE_SELF, IN_IGNORED
 
 import os
+import struct
 import threading
 from common.basedir import BASEDIR
 
@@ -82,22 +88,152 @@ def ensure_bytes(v):
 class UnknownKeyName(Exception):
   pass
 
+
+class ParamsTransaction:
+  """Stages puts and deletes, and commits them all at once when the with block exits
+     without an exception. While it's open, put and delete on the Params are staged too."""
+  def __init__(self, params):
+    self.params = params
+    self.values = {}
+    self.deletes = set()
+
+  def __enter__(self):
+    assert self.params.txn is None, "transactions can't be nested"
+    self.params.txn = self
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.params.txn = None
+    if exc_type is None:
+      self.commit()
+
+  def put(self, key, dat):
+    key = ensure_bytes(key)
+    if key not in keys:
+      raise UnknownKeyName(key)
+    self.values[key] = ensure_bytes(dat)
+    self.deletes.discard(key)
+
+  def delete(self, key):
+    key = ensure_bytes(key)
+    self.values.pop(key, None)
+    self.deletes.add(key)
+
+  def commit(self):
+    if self.values or self.deletes:
+      self.params.write_all(self.values, self.deletes)
+    self.values = {}
+    self.deletes = set()
+
+
+INOTIFY_EVENT = struct.Struct("iIII")
+
+class ParamsCache:
+  """Values read from one params directory, kept until inotify reports a change to
+     the key. Shared by all the Params(cache=True) of a process, see get_cache."""
+  def __init__(self, path):
+    self.path = path
+    self.values = {}
+    # bumped on every invalidation, so a value read from disk at the same time isn't stored
+    self.generation = 0
+    self.lock = threading.Lock()
+
+    self.fd = inotify_init1(IN_CLOEXEC)
+    if self.fd < 0:
+      raise OSError("inotify_init1 failed")
+    self.params_wd = inotify_add_watch(self.fd, path.encode(), IN_CREATE | IN_MOVED_TO)
+    if self.params_wd < 0:
+      os.close(self.fd)
+      raise OSError(f"can't watch {path}")
+    self.d_wd = self._watch_d()
+
+    self.thread = threading.Thread(target=self._watcher, daemon=True)
+    self.thread.start()
+
+  def _watch_d(self):
+    mask = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_CLOSE_WRITE | IN_DELETE_SELF
+    return inotify_add_watch(self.fd, os.path.join(self.path, "d").encode(), mask)
+
+  def get(self, key, read):
+    try:
+      return self.values[key]
+    except KeyError:
+      pass
+
+    generation = self.generation
+    dat = read(key)
+    with self.lock:
+      if generation == self.generation:
+        self.values[key] = dat
+    return dat
+
+  def invalidate(self, key=None):
+    with self.lock:
+      self.generation += 1
+      if key is None:
+        self.values.clear()
+      else:
+        self.values.pop(key, None)
+
+  def _watcher(self):
+    while True:
+      buf = os.read(self.fd, 4096)
+      i = 0
+      while i < len(buf):
+        wd, mask, _, length = INOTIFY_EVENT.unpack_from(buf, i)
+        name = buf[i + INOTIFY_EVENT.size:i + INOTIFY_EVENT.size + length].rstrip(b"\0")
+        i += INOTIFY_EVENT.size + length
+
+        if wd == self.params_wd and name == b"d":
+          # <params>/d was created or swapped, watch the new directory before dropping everything
+          self.d_wd = self._watch_d()
+          self.invalidate()
+        elif mask & IN_Q_OVERFLOW or (wd == self.d_wd and mask & (IN_DELETE_SELF | IN_IGNORED)):
+          # the dropped events or the removal of the watched directory can mean <params>/d was swapped
+          self.d_wd = self._watch_d()
+          self.invalidate()
+        elif wd == self.d_wd:
+          self.invalidate(name)
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def get_cache(path):
+  """The ParamsCache for path, None if its changes can't be watched."""
+  with _caches_lock:
+    if path not in _caches:
+      try:
+        _caches[path] = ParamsCache(path)
+      except OSError:
+        _caches[path] = None
+    return _caches[path]
+
+
 cdef class Params:
   cdef c_Params* p
+  cdef public object txn
+  cdef public object cache
 
-  def __cinit__(self, d=None, bool persistent_params=False):
+  def __cinit__(self, d=None, bool persistent_params=False, bool cache=False):
     if d is None:
       self.p = new c_Params(persistent_params)
     else:
       self.p = new c_Params(<string>d.encode())
 
+    # with cache, get() only goes to disk after the key was changed
+    self.cache = get_cache(self.p.get_params_path().decode()) if cache else None
+
   def __dealloc__(self):
     del self.p
 
   def clear_all(self, tx_type=None):
-    for key in keys:
-      if tx_type is None or tx_type in keys[key]:
-        self.delete(key)
+    to_delete = [key for key in keys if tx_type is None or tx_type in keys[key]]
+    if self.txn is not None:
+      for key in to_delete:
+        self.txn.delete(key)
+    else:
+      self.write_all({}, to_delete)
 
   def manager_start(self):
     self.clear_all(TxType.CLEAR_ON_MANAGER_START)
@@ -105,31 +241,73 @@ cdef class Params:
   def panda_disconnect(self):
     self.clear_all(TxType.CLEAR_ON_PANDA_DISCONNECT)
 
-  def get(self, key, block=False, encoding=None):
+  def transaction(self):
+    """with params.transaction(): ... writes all puts and deletes in the block at once,
+       taking the lock and syncing to disk once instead of for every key."""
+    return ParamsTransaction(self)
+
+  def write_all(self, values, deletes=()):
+    cdef map[string, string] v = values
+    cdef vector[string] d = [ensure_bytes(k) for k in deletes]
+    cdef int r
+    with nogil:
+      r = self.p.write_db_values(v, d)
+    if self.cache is not None:
+      self.cache.invalidate()
+    if r < 0:
+      raise OSError(f"writing params to {self.p.get_params_path().decode()} failed ({r})")
+
+  def _read(self, key):
+    cdef string k = key
+    cdef string val
+    with nogil:
+      val = self.p.get(k, False)
+    return None if val == b"" else val
+
+  def get(self, key, block=False, encoding=None, timeout=None):
+    """Read a param, None if it isn't set. With block=True wait until it's written,
+       or at most timeout seconds, after which None is returned."""
     key = ensure_bytes(key)
 
     if key not in keys:
       raise UnknownKeyName(key)
 
+    # staged in the open transaction
+    if self.txn is not None and (key in self.txn.values or key in self.txn.deletes):
+      staged = self.txn.values.get(key)
+      if staged is not None and encoding is not None:
+        return staged.decode(encoding)
+      return staged
+
     cdef string k = key
-    cdef bool b = block
+    cdef int timeout_ms = -1 if timeout is None else max(int(timeout * 1000), 0)
+    cdef char* value = NULL
+    cdef size_t size = 0
+    cdef int r
 
     cdef string val
-    with nogil:
-      val = self.p.get(k, b)
+    if block:
+      with nogil:
+        r = self.p.read_db_value_blocking(k.c_str(), &value, &size, timeout_ms)
 
-    if val == b"":
-      if block:
-        # If we got no value while running in blocked mode
-        # it means we got an interrupt while waiting
+      if r == 1:
+        # interrupted by SIGINT or SIGTERM while waiting
         raise KeyboardInterrupt
-      else:
+      elif r != 0:
         return None
 
-    if encoding is not None:
-      return val.decode(encoding)
+      val = string(value, size)
+      free(value)
+      dat = val
+    elif self.cache is not None:
+      dat = self.cache.get(key, self._read)
+    else:
+      dat = self._read(key)
+
+    if dat is not None and encoding is not None:
+      return dat.decode(encoding)
     else:
-      return val
+      return dat
 
   def put(self, key, dat):
     """
@@ -144,11 +322,21 @@ cdef class Params:
     if key not in keys:
       raise UnknownKeyName(key)
 
-    self.p.write_db_value(key, dat)
+    if self.txn is not None:
+      self.txn.put(key, dat)
+    else:
+      self.p.write_db_value(key, dat)
+      if self.cache is not None:
+        self.cache.invalidate(key)
 
   def delete(self, key):
     key = ensure_bytes(key)
-    self.p.delete_db_value(key)
+    if self.txn is not None:
+      self.txn.delete(key)
+    else:
+      self.p.delete_db_value(key)
+      if self.cache is not None:
+        self.cache.invalidate(key)
 
 
 def put_nonblocking(key, val, d=None):
@@ -1,4 +1,5 @@
 import time
+import numpy as np
 
 class Profiler():
   def __init__(self, enabled=False):
@@ -43,3 +44,57 @@ class Profiler():
       else:
         print("%30s: %9.2f  avg: %7.2f  percent: %3.0f" % (n, ms*1000.0, ms*1000.0/self.iter, ms/self.tot*100))
     print("Iter clock: %2.6f   TOTAL: %2.2f" % (self.tot/self.iter, self.tot))
+
+
+class StageTimer():
+  """Always on timing of the stages of a loop, cheap enough to leave enabled.
+
+     The durations of the last `size` runs of each stage are kept in a ring
+     buffer of monotonic nanoseconds, summary() reduces them to percentiles.
+  """
+  def __init__(self, size=1000):
+    self.size = size
+    self.samples = {}
+    self.pos = {}
+    self.count = {}
+    self.start_ns = self.last_ns = time.monotonic_ns()
+
+  def start(self):
+    self.start_ns = self.last_ns = time.monotonic_ns()
+
+  def checkpoint(self, name):
+    t = time.monotonic_ns()
+    self._record(name, t - self.last_ns)
+    self.last_ns = t
+
+  def end(self):
+    """Records the time since start() as the 'total' stage"""
+    t = time.monotonic_ns()
+    self._record("total", t - self.start_ns)
+    self.last_ns = t
+
+  def _record(self, name, dt):
+    if name not in self.samples:
+      self.samples[name] = [0] * self.size
+      self.pos[name] = 0
+      self.count[name] = 0
+
+    pos = self.pos[name]
+    self.samples[name][pos] = dt
+    self.pos[name] = pos + 1 if pos + 1 < self.size else 0
+    self.count[name] += 1
+
+  def summary(self):
+    """Returns the stats of every stage over the buffered runs, in ms"""
+    ret = {}
+    for name, samples in self.samples.items():
+      n = min(self.count[name], self.size)
+      ms = np.array(samples[:n], dtype=np.float64) * 1e-6
+      ret[name] = {
+        "count": n,
+        "mean": float(np.mean(ms)),
+        "p50": float(np.percentile(ms, 50)),
+        "p99": float(np.percentile(ms, 99)),
+        "max": float(np.max(ms)),
+      }
+    return ret
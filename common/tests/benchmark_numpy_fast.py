@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+# Time per call of interp and Interpolator against a linear scan and np.interp
+import timeit
+
+SETUP = """
+import numpy as np
+from common.numpy_fast import interp, Interpolator
+from common.tests.test_numpy_fast import interp_linear
+xp = [0., 5., 10., 20., 40.]
+fp = [-1.0, -.8, -.67, -.5, -.30]
+xp_np, fp_np = np.array(xp), np.array(fp)
+f = Interpolator(xp, fp)
+"""
+
+STMTS = [
+  ("linear scan", "interp_linear(15.2, xp, fp)"),
+  ("interp", "interp(15.2, xp, fp)"),
+  ("interp (numpy tables)", "interp(15.2, xp_np, fp_np)"),
+  ("Interpolator", "f(15.2)"),
+  ("np.interp", "np.interp(15.2, xp_np, fp_np)"),
+]
+
+N = 10000
+
+
+if __name__ == "__main__":
+  for name, stmt in STMTS:
+    t = timeit.timeit(stmt, setup=SETUP, number=N) / N
+    print("%-22s %6.2f us" % (name, t * 1e6))
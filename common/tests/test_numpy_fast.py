@@ -1,7 +1,23 @@
 import numpy as np
 import unittest
 
-from common.numpy_fast import interp
+from common.numpy_fast import clip, interp, Interpolator
+
+
+def interp_linear(x, xp, fp):
+  # linear scan implementation interp used to have
+  N = len(xp)
+
+  def get_interp(xv):
+    hi = 0
+    while hi < N and xv > xp[hi]:
+      hi += 1
+    low = hi - 1
+    return fp[-1] if hi == N and xv > xp[low] else (
+      fp[0] if hi == 0 else
+      (xv - xp[low]) * (fp[hi] - fp[low]) / (xp[hi] - xp[low]) + fp[low])
+
+  return [get_interp(v) for v in x] if hasattr(x, '__iter__') else get_interp(x)
 
 
 class InterpTest(unittest.TestCase):
@@ -21,6 +37,25 @@ class InterpTest(unittest.TestCase):
       actual = interp(v_ego, _A_CRUISE_MIN_BP, _A_CRUISE_MIN_V)
       np.testing.assert_equal(actual, expected)
 
+  def test_same_as_linear(self):
+    np.random.seed(0)
+    for n in [1, 2, 3, 5, 10]:
+      xp = np.sort(np.random.uniform(-10, 10, n))
+      xp[n // 2] = xp[n // 2 - 1]  # repeated breakpoint
+      fp = np.random.uniform(-10, 10, n)
+      x = list(np.random.uniform(-15, 15, 100)) + list(xp) + [float('nan')]
+
+      expected = interp_linear(x, list(xp), list(fp))
+      np.testing.assert_equal(interp(x, list(xp), list(fp)), expected)
+      np.testing.assert_equal(interp(x, xp, fp), expected)
+      np.testing.assert_equal(Interpolator(xp, fp)(x), expected)
+      np.testing.assert_equal([Interpolator(xp, fp)(v) for v in x], expected)
+
+  def test_clip(self):
+    for x in [-2., -1., 0., 1., 2., float('nan'), float('inf'), -float('inf')]:
+      np.testing.assert_equal(clip(x, -1., 1.), max(-1., min(1., x)))
+    self.assertEqual(clip(5, 2, 1), 2)
+
 
 if __name__ == "__main__":
   unittest.main()
@@ -61,6 +61,135 @@ class TestParams(unittest.TestCase):
     assert self.params.get("CarParams") is None
     assert self.params.get("CarParams", True) == b"test"
 
+  def test_params_get_block_timeout(self):
+    t = time.monotonic()
+    assert self.params.get("CarParams", True, timeout=0.2) is None
+    assert 0.2 <= time.monotonic() - t < 1.
+
+    self.params.put("CarParams", "test")
+    assert self.params.get("CarParams", True, timeout=0.2) == b"test"
+
+  def test_params_get_block_wakeup(self):
+    # the reader is woken up by the write, not by polling
+    t = {}
+    def _delayed_writer():
+      time.sleep(0.2)
+      t['put'] = time.monotonic()
+      self.params.put("CarParams", "test")
+    threading.Thread(target=_delayed_writer).start()
+    assert self.params.get("CarParams", True, timeout=5) == b"test"
+    assert time.monotonic() - t['put'] < 0.05
+
+  def test_params_transaction(self):
+    self.params.put("DongleId", "bob")
+    self.params.put("AthenadPid", "123")
+    with self.params.transaction():
+      self.params.put("CarParams", "test")
+      self.params.put("IsMetric", "1")
+      self.params.delete("AthenadPid")
+      # staged, not written yet
+      assert self.params.get("CarParams") == b"test"
+      assert self.params.get("AthenadPid") is None
+      assert Params(self.tmpdir).get("CarParams") is None
+      assert Params(self.tmpdir).get("AthenadPid") == b"123"
+
+    q = Params(self.tmpdir)
+    assert q.get("CarParams") == b"test"
+    assert q.get("IsMetric") == b"1"
+    assert q.get("DongleId") == b"bob"
+    assert q.get("AthenadPid") is None
+    # the old data directory is gone
+    assert sorted(os.listdir(self.tmpdir)) == sorted([".lock", "d", os.path.basename(os.readlink(f"{self.tmpdir}/d"))])
+
+    st_mode = os.stat(f"{self.tmpdir}/d/CarParams").st_mode
+    assert (st_mode & 0o666) == 0o666
+
+  def test_params_transaction_exception(self):
+    with self.assertRaises(ValueError):
+      with self.params.transaction():
+        self.params.put("CarParams", "test")
+        raise ValueError
+    assert self.params.get("CarParams") is None
+
+  def test_params_transaction_failed(self):
+    # params can't be written under a file
+    fn = os.path.join(self.tmpdir, "file")
+    open(fn, "w").close()
+    params = Params(fn)
+    with self.assertRaises(OSError):
+      params.write_all({b"CarParams": b"test"})
+    with self.assertRaises(OSError):
+      with params.transaction():
+        params.put("CarParams", "test")
+
+  def test_params_clear_all(self):
+    self.params.put("CarParams", "test")
+    self.params.put("DongleId", "bob")
+    self.params.clear_all()
+    assert self.params.get("CarParams") is None
+    assert self.params.get("DongleId") is None
+    self.params.put("DongleId", "bob")
+    assert self.params.get("DongleId") == b"bob"
+
+  def test_params_get_block_transaction(self):
+    def _delayed_writer():
+      time.sleep(0.1)
+      with Params(self.tmpdir).transaction() as txn:
+        txn.put("CarParams", "test")
+    self.params.put("DongleId", "bob")
+    threading.Thread(target=_delayed_writer).start()
+    assert self.params.get("CarParams", True, timeout=5) == b"test"
+
+  def _wait_for(self, params, key, val, timeout=1.):
+    t = time.monotonic()
+    while params.get(key) != val:
+      assert time.monotonic() - t < timeout, f"{key} not {val}"
+      time.sleep(0.001)
+
+  def test_params_cache(self):
+    q = Params(self.tmpdir, cache=True)
+    assert q.get("CarParams") is None
+    self.params.put("CarParams", "test")
+    self._wait_for(q, "CarParams", b"test")
+
+    # cached values aren't read from disk again
+    q.cache.values[b"CarParams"] = b"cached"
+    assert q.get("CarParams") == b"cached"
+    assert q.get("CarParams", encoding="utf8") == "cached"
+
+    self.params.delete("CarParams")
+    self._wait_for(q, "CarParams", None)
+
+    # own writes are seen immediately
+    q.put("DongleId", "bob")
+    assert q.get("DongleId") == b"bob"
+
+  def test_params_cache_transaction(self):
+    q = Params(self.tmpdir, cache=True)
+    self.params.put("DongleId", "bob")
+    self._wait_for(q, "DongleId", b"bob")
+
+    # <params>/d is swapped by transactions
+    for i in range(3):
+      with self.params.transaction():
+        self.params.put("DongleId", str(i))
+        self.params.put("AthenadPid", str(i))
+      self._wait_for(q, "DongleId", str(i).encode())
+      self._wait_for(q, "AthenadPid", str(i).encode())
+
+  def test_params_cache_missed_swap(self):
+    # <params>/d exists before the cache starts watching, so there are no events from <params> to wait for
+    self.params.put("DongleId", "bob")
+    q = Params(self.tmpdir, cache=True)
+    assert q.get("DongleId") == b"bob"
+
+    # as if the swaps of <params>/d were lost in a queue overflow, the removal of the old directory is enough
+    q.cache.params_wd = -1
+    for i in range(3):
+      with self.params.transaction():
+        self.params.put("DongleId", str(i))
+      self._wait_for(q, "DongleId", str(i).encode())
+
   def test_params_unknown_key_fails(self):
     with self.assertRaises(UnknownKeyName):
       self.params.get("swag")
@@ -0,0 +1,35 @@
+import unittest
+from unittest import mock
+
+from common.profiler import StageTimer
+
+
+class TestStageTimer(unittest.TestCase):
+  def test_summary(self):
+    ns = [0]
+    with mock.patch("time.monotonic_ns", lambda: ns[0]):
+      timer = StageTimer(size=100)
+      for i in range(250):
+        timer.start()
+        ns[0] += 1000000
+        timer.checkpoint("a")
+        ns[0] += (i % 100) * 10000
+        timer.checkpoint("b")
+        timer.end()
+
+    summary = timer.summary()
+    self.assertEqual(set(summary.keys()), {"a", "b", "total"})
+    self.assertEqual(summary["a"]["count"], 100)
+    self.assertAlmostEqual(summary["a"]["p99"], 1.)
+    self.assertAlmostEqual(summary["b"]["max"], .99)
+    self.assertAlmostEqual(summary["b"]["mean"], .495)
+    self.assertAlmostEqual(summary["total"]["max"], 1.99)
+
+  def test_partial_buffer(self):
+    timer = StageTimer(size=100)
+    timer.checkpoint("a")
+    self.assertEqual(timer.summary()["a"]["count"], 1)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -8,9 +8,14 @@
 #include <stdlib.h>
 #include <unistd.h>
 #include <dirent.h>
+#include <limits.h>
+#include <poll.h>
+#include <time.h>
 #include <sys/file.h>
+#include <sys/inotify.h>
 #include <sys/stat.h>
 
+#include <algorithm>
 #include <map>
 #include <string>
 #include <iostream>
@@ -110,6 +115,10 @@ Params::Params(std::string path) {
   params_path = path;
 }
 
+std::string Params::get_params_path() {
+  return params_path;
+}
+
 int Params::write_db_value(std::string key, std::string dat){
   return write_db_value(key.c_str(), dat.c_str(), dat.length());
 }
@@ -236,6 +245,151 @@ cleanup:
   return result;
 }
 
+static int remove_dir(std::string path) {
+  DIR *d = opendir(path.c_str());
+  if (!d) {
+    return -1;
+  }
+  struct dirent *de = NULL;
+  while ((de = readdir(d))) {
+    if (strcmp(de->d_name, ".") == 0 || strcmp(de->d_name, "..") == 0) continue;
+    unlink((path + "/" + de->d_name).c_str());
+  }
+  closedir(d);
+  return rmdir(path.c_str());
+}
+
+int Params::write_db_values(const std::map<std::string, std::string> &values, const std::vector<std::string> &deletes) {
+  // All keys change at once by building a new data directory and swapping the <params>/d symlink:
+  // 1) Create a temp directory, and write and fsync the new values into it
+  // 2) Under the lock, hard link every other value of the current directory into it
+  // 3) fsync() the temp directory
+  // 4) rename a symlink to it over <params>/d and fsync() <params>
+  // 5) remove the old directory
+  // Compared to write_db_value for every key this takes the lock once and syncs two directories in total.
+
+  int lock_fd = -1;
+  int result;
+  std::string path;
+  std::string tmp_dir;
+  std::string old_dir;
+  std::string link_path;
+  char old_dir_buf[PATH_MAX];
+  bool swapped = false;
+
+  result = ensure_dir_exists(params_path);
+  if (result < 0) {
+    goto cleanup;
+  }
+
+  path = params_path + "/.tmp_XXXXXX";
+  if (mkdtemp((char*)path.c_str()) == NULL) {
+    result = -1;
+    goto cleanup;
+  }
+  tmp_dir = path;
+
+  result = chmod(tmp_dir.c_str(), 0777);
+  if (result < 0) {
+    goto cleanup;
+  }
+
+  // Write new values
+  for (auto const &kv : values) {
+    path = tmp_dir + "/" + kv.first;
+    int fd = open(path.c_str(), O_CREAT | O_WRONLY | O_TRUNC | O_CLOEXEC, 0666);
+    if (fd < 0) {
+      result = -1;
+      goto cleanup;
+    }
+    ssize_t bytes_written = write(fd, kv.second.data(), kv.second.size());
+    // change permissions to 0666 for apks
+    result = fchmod(fd, 0666);
+    if (result == 0) {
+      result = fsync(fd);
+    }
+    close(fd);
+    if (bytes_written < 0 || (size_t)bytes_written != kv.second.size()) {
+      result = -20;
+    }
+    if (result < 0) {
+      goto cleanup;
+    }
+  }
+
+  // Take lock.
+  path = params_path + "/.lock";
+  lock_fd = open(path.c_str(), O_CREAT, 0775);
+  result = flock(lock_fd, LOCK_EX);
+  if (result < 0) {
+    goto cleanup;
+  }
+
+  // Carry over the values that aren't changed
+  path = params_path + "/d";
+  if (realpath(path.c_str(), old_dir_buf) != NULL) {
+    old_dir = old_dir_buf;
+    DIR *d = opendir(old_dir.c_str());
+    if (!d) {
+      result = -1;
+      goto cleanup;
+    }
+    struct dirent *de = NULL;
+    while ((de = readdir(d))) {
+      if (strcmp(de->d_name, ".") == 0 || strcmp(de->d_name, "..") == 0) continue;
+      std::string key(de->d_name);
+      if (values.count(key) || std::find(deletes.begin(), deletes.end(), key) != deletes.end()) continue;
+
+      result = link((old_dir + "/" + key).c_str(), (tmp_dir + "/" + key).c_str());
+      if (result < 0) {
+        break;
+      }
+    }
+    closedir(d);
+    if (result < 0) {
+      goto cleanup;
+    }
+  }
+
+  result = fsync_dir(tmp_dir.c_str());
+  if (result < 0) {
+    goto cleanup;
+  }
+
+  // Move symlink to <params>/d
+  link_path = tmp_dir + ".link";
+  result = symlink(tmp_dir.c_str(), link_path.c_str());
+  if (result < 0) {
+    goto cleanup;
+  }
+  path = params_path + "/d";
+  result = rename(link_path.c_str(), path.c_str());
+  if (result < 0) {
+    remove(link_path.c_str());
+    goto cleanup;
+  }
+  swapped = true;
+
+  result = fsync_dir(params_path.c_str());
+  if (result < 0) {
+    goto cleanup;
+  }
+
+cleanup:
+  if (swapped) {
+    if (!old_dir.empty()) {
+      remove_dir(old_dir);
+    }
+  } else if (!tmp_dir.empty()) {
+    remove_dir(tmp_dir);
+  }
+  // Release lock.
+  if (lock_fd >= 0) {
+    close(lock_fd);
+  }
+  return result;
+}
+
 int Params::delete_db_value(std::string key) {
   int lock_fd = -1;
   int result;
@@ -303,23 +457,69 @@ int Params::read_db_value(const char* key, char** value, size_t* value_sz) {
   return 0;
 }
 
-int Params::read_db_value_blocking(const char* key, char** value, size_t* value_sz) {
+static double monotonic_ms() {
+  struct timespec t;
+  clock_gettime(CLOCK_MONOTONIC, &t);
+  return t.tv_sec * 1000.0 + t.tv_nsec * 1e-6;
+}
+
+int Params::read_db_value_blocking(const char* key, char** value, size_t* value_sz, int timeout_ms) {
   params_do_exit = 0;
   void (*prev_handler_sigint)(int) = std::signal(SIGINT, params_sig_handler);
   void (*prev_handler_sigterm)(int) = std::signal(SIGTERM, params_sig_handler);
 
+  // Wake up as soon as a value is written to <params>/d, or <params>/d itself is created.
+  // Without inotify this falls back to polling every 0.1 s.
+  std::string d_path = params_path + "/d";
+  int inotify_fd = inotify_init1(IN_NONBLOCK | IN_CLOEXEC);
+  int d_wd = -1;
+  if (inotify_fd >= 0) {
+    inotify_add_watch(inotify_fd, params_path.c_str(), IN_CREATE | IN_MOVED_TO);
+  }
+
+  const double deadline = monotonic_ms() + timeout_ms;
+  int result = 0;
   while (!params_do_exit) {
-    const int result = read_db_value(key, value, value_sz);
-    if (result == 0) {
+    // (re)watch the directory the values are moved into, it's only created on the first write
+    if (inotify_fd >= 0 && d_wd < 0) {
+      d_wd = inotify_add_watch(inotify_fd, d_path.c_str(), IN_CREATE | IN_MOVED_TO | IN_CLOSE_WRITE);
+    }
+
+    if (read_db_value(key, value, value_sz) == 0) {
       break;
+    }
+
+    int wait_ms = 100;
+    if (timeout_ms >= 0) {
+      const double remaining = deadline - monotonic_ms();
+      if (remaining <= 0) {
+        result = ERR_TIMEOUT;
+        break;
+      }
+      wait_ms = std::min(wait_ms, (int)remaining + 1);
+    }
+
+    if (inotify_fd >= 0) {
+      // bounded, so a signal arriving just before poll() is noticed
+      struct pollfd fds = {.fd = inotify_fd, .events = POLLIN};
+      if (poll(&fds, 1, wait_ms) > 0) {
+        // drain the events, the key is checked again either way
+        char buf[4096] __attribute__((aligned(__alignof__(struct inotify_event))));
+        while (read(inotify_fd, buf, sizeof(buf)) > 0) {}
+        // <params>/d may have been swapped for a new directory by write_db_values
+        d_wd = -1;
+      }
     } else {
-      usleep(100000); // 0.1 s
+      usleep(wait_ms * 1000);
     }
   }
 
+  if (inotify_fd >= 0) {
+    close(inotify_fd);
+  }
   std::signal(SIGINT, prev_handler_sigint);
   std::signal(SIGTERM, prev_handler_sigterm);
-  return params_do_exit; // Return 0 if we had no interrupt
+  return params_do_exit ? 1 : result; // 1 if we had an interrupt
 }
 
 int Params::read_db_all(std::map<std::string, std::string> *params) {
@@ -5,6 +5,7 @@
 #include <vector>
 
 #define ERR_NO_VALUE -33
+#define ERR_TIMEOUT -34
 
 class Params {
 private:
@@ -14,6 +15,8 @@ public:
   Params(bool persistent_param = false);
   Params(std::string path);
 
+  std::string get_params_path();
+
   int write_db_value(std::string key, std::string dat);
   int write_db_value(const char* key, const char* value, size_t value_size);
 
@@ -34,9 +37,21 @@ public:
   // Inputs are the same as read_db_value, without value and value_sz.
   int delete_db_value(std::string key);
 
+  // Writes and deletes several values as one transaction. Readers either see
+  // all of the changes or none of them.
+  // Inputs:
+  //  values: The keys to write, and their values.
+  //  deletes: The keys to delete.
+  //
+  // Returns: Negative on failure, otherwise 0.
+  int write_db_values(const std::map<std::string, std::string> &values, const std::vector<std::string> &deletes);
+
   // Reads a value from the params database, blocking until successful.
-  // Inputs are the same as read_db_value.
-  int read_db_value_blocking(const char* key, char** value, size_t* value_sz);
+  // Inputs are the same as read_db_value, plus
+  //  timeout_ms: Maximum time to wait, negative to wait forever.
+  //
+  // Returns: 0 on success, 1 if interrupted by SIGINT or SIGTERM, ERR_TIMEOUT on timeout.
+  int read_db_value_blocking(const char* key, char** value, size_t* value_sz, int timeout_ms = -1);
 
   int read_db_all(std::map<std::string, std::string> *params);
   std::vector<char> read_db_bytes(const char* param_name);
@@ -4,7 +4,7 @@ from cereal import car, log
 from common.hardware import HARDWARE
 from common.numpy_fast import clip
 from common.realtime import sec_since_boot, config_realtime_process, Priority, Ratekeeper, DT_CTRL
-from common.profiler import Profiler
+from common.profiler import StageTimer
 from common.params import Params, put_nonblocking
 import cereal.messaging as messaging
 from selfdrive.config import Conversions as CV
@@ -21,11 +21,14 @@ from selfdrive.controls.lib.alertmanager import AlertManager
 from selfdrive.controls.lib.vehicle_model import VehicleModel
 from selfdrive.controls.lib.planner import LON_MPC_STEP
 from selfdrive.locationd.calibrationd import Calibration
+from selfdrive.message_pool import MessagePool
+from selfdrive.swaglog import cloudlog
 
 LDW_MIN_SPEED = 31 * CV.MPH_TO_MS
 LANE_DEPARTURE_THRESHOLD = 0.1
 STEER_ANGLE_SATURATION_TIMEOUT = 1.0 / DT_CTRL
 STEER_ANGLE_SATURATION_THRESHOLD = 2.5  # Degrees
+TIMING_SUMMARY_FRAMES = int(10. / DT_CTRL)  # log stage timings every 10s
 
 SIMULATION = "SIMULATION" in os.environ
 NOSENSOR = "NOSENSOR" in os.environ
@@ -142,7 +145,8 @@ class Controls:
 
     # controlsd is driven by can recv, expected at 100Hz
     self.rk = Ratekeeper(100, print_delay_threshold=None)
-    self.prof = Profiler(False)  # off by default
+    self.timer = StageTimer(TIMING_SUMMARY_FRAMES)
+    self.pool = MessagePool()
 
   def update_events(self, CS):
     """Compute carEvents from carState"""
@@ -247,6 +251,8 @@ class Controls:
 
     # Update carState from CAN
     can_strs = messaging.drain_sock_raw(self.can_sock, wait_for_one=True)
+    # waiting for can is not part of data_sample
+    self.timer.checkpoint("can_recv")
     CS = self.CI.update(self.CC, can_strs)
 
     self.sm.update(0)
@@ -349,13 +355,13 @@ class Controls:
     # Check if openpilot is engaged
     self.enabled = self.active or self.state == State.preEnabled
 
-  def state_control(self, CS):
-    """Given the state, this function returns an actuators packet"""
+  def state_control(self, CS, CC):
+    """Given the state, this function fills the actuators of CC"""
 
     plan = self.sm['plan']
     path_plan = self.sm['pathPlan']
 
-    actuators = car.CarControl.Actuators.new_message()
+    actuators = CC.actuators
 
     if CS.leftBlinker or CS.rightBlinker:
       self.last_blinker_frame = self.sm.frame
@@ -397,14 +403,14 @@ class Controls:
       if left_deviation or right_deviation:
         self.events.add(EventName.steerSaturated)
 
-    return actuators, v_acc_sol, a_acc_sol, lac_log
+    return v_acc_sol, a_acc_sol, lac_log
 
-  def publish_logs(self, CS, start_time, actuators, v_acc, a_acc, lac_log):
+  def publish_logs(self, CS, start_time, cc_send, v_acc, a_acc, lac_log):
     """Send actuators and hud commands to the car, send controlsstate and MPC logging"""
 
-    CC = car.CarControl.new_message()
+    CC = cc_send.carControl
+    actuators = CC.actuators
     CC.enabled = self.enabled
-    CC.actuators = actuators
 
     CC.cruiseControl.override = True
     CC.cruiseControl.cancel = not self.CP.enableCruise or (not self.enabled and CS.cruiseState.enabled)
@@ -460,7 +466,7 @@ class Controls:
     steer_angle_rad = (CS.steeringAngle - self.sm['pathPlan'].angleOffset) * CV.DEG_TO_RAD
 
     # controlsState
-    dat = messaging.new_message('controlsState')
+    dat = self.pool.new_message('controlsState')
     dat.valid = CS.canValid
     controlsState = dat.controlsState
     controlsState.alertText1 = self.AM.alert_text_1
@@ -511,17 +517,16 @@ class Controls:
     self.pm.send('controlsState', dat)
 
     # carState
-    car_events = self.events.to_msg()
-    cs_send = messaging.new_message('carState')
+    cs_send = self.pool.new_message('carState')
     cs_send.valid = CS.canValid
     cs_send.carState = CS
-    cs_send.carState.events = car_events
+    self.events.write_msg(cs_send.carState.init('events', len(self.events)))
     self.pm.send('carState', cs_send)
 
     # carEvents - logged every second or on change
     if (self.sm.frame % int(1. / DT_CTRL) == 0) or (self.events.names != self.events_prev):
-      ce_send = messaging.new_message('carEvents', len(self.events))
-      ce_send.carEvents = car_events
+      ce_send = self.pool.new_message('carEvents', len(self.events))
+      self.events.write_msg(ce_send.carEvents)
       self.pm.send('carEvents', ce_send)
     self.events_prev = self.events.names.copy()
 
@@ -532,9 +537,7 @@ class Controls:
       self.pm.send('carParams', cp_send)
 
     # carControl
-    cc_send = messaging.new_message('carControl')
     cc_send.valid = CS.canValid
-    cc_send.carControl = CC
     self.pm.send('carControl', cc_send)
 
     # copy CarControl to pass to CarInterface on the next iteration
@@ -542,33 +545,48 @@ class Controls:
 
   def step(self):
     start_time = sec_since_boot()
-    self.prof.checkpoint("Ratekeeper", ignore=True)
+    self.timer.start()
 
     # Sample data from sockets and get a carState
     CS = self.data_sample()
-    self.prof.checkpoint("Sample")
+    self.timer.checkpoint("data_sample")
 
     self.update_events(CS)
+    self.timer.checkpoint("update_events")
 
     if not self.read_only:
       # Update control state
       self.state_transition(CS)
-      self.prof.checkpoint("State transition")
+      self.timer.checkpoint("state_transition")
 
     # Compute actuators (runs PID loops and lateral MPC)
-    actuators, v_acc, a_acc, lac_log = self.state_control(CS)
-
-    self.prof.checkpoint("State Control")
+    cc_send = self.pool.new_message('carControl')
+    v_acc, a_acc, lac_log = self.state_control(CS, cc_send.carControl)
+    self.timer.checkpoint("state_control")
 
     # Publish data
-    self.publish_logs(CS, start_time, actuators, v_acc, a_acc, lac_log)
-    self.prof.checkpoint("Sent")
+    self.publish_logs(CS, start_time, cc_send, v_acc, a_acc, lac_log)
+    self.timer.checkpoint("publish_logs")
+    self.timer.end()
+
+    if self.sm.frame % TIMING_SUMMARY_FRAMES == 0:
+      # debug, so it only goes to the rlog and not to logentries
+      cloudlog.event("controlsd_timing", stages=self.timer.summary(), debug=True)
 
   def controlsd_thread(self):
+    for _ in self.steps():
+      pass
+
+  def steps(self):
+    """Runs one iteration of the control loop per next(), used to replay controlsd in lock-step"""
     while True:
+      yield
       self.step()
       self.rk.monitor_time()
-      self.prof.display()
+
+def controlsd_steps(sm=None, pm=None, logcan=None):
+  controls = Controls(sm, pm, logcan)
+  yield from controls.steps()
 
 def main(sm=None, pm=None, logcan=None):
   controls = Controls(sm, pm, logcan)
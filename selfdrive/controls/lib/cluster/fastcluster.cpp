@@ -215,4 +215,51 @@ extern "C" {
     delete[] merge;
     delete[] height;
   }
+
+  // Same as cluster_points_centroid, but first splits the points into groups
+  // that are further than sqrt(dist) apart in their first coordinate. A centroid
+  // stays within the range of its points, so these groups never merge and are
+  // clustered separately, which keeps the O(n^2) clustering small.
+  void cluster_points_centroid_split(int n, int m, double* pts, double dist, int* idx) {
+    std::vector<int> order(n);
+    for (int i = 0; i < n; i++) {
+      order[i] = i;
+    }
+    std::stable_sort(order.begin(), order.end(), [&](int a, int b) { return pts[a * m] < pts[b * m]; });
+
+    std::vector<double> group_pts;
+    std::vector<int> group_idx;
+    int next_label = 0;
+    int start = 0;
+    for (int i = 1; i <= n; i++) {
+      if (i < n) {
+        double gap = pts[order[i] * m] - pts[order[i - 1] * m];
+        if (gap * gap <= dist) {
+          continue;
+        }
+      }
+
+      int cnt = i - start;
+      if (cnt == 1) {
+        idx[order[start]] = next_label++;
+      } else {
+        // keep the original order within the group
+        std::sort(order.begin() + start, order.begin() + i);
+        group_pts.resize(cnt * m);
+        group_idx.resize(cnt);
+        for (int j = 0; j < cnt; j++) {
+          std::copy(pts + order[start + j] * m, pts + (order[start + j] + 1) * m, group_pts.begin() + j * m);
+        }
+        cluster_points_centroid(cnt, m, group_pts.data(), dist, group_idx.data());
+
+        int max_label = 0;
+        for (int j = 0; j < cnt; j++) {
+          idx[order[start + j]] = next_label + group_idx[j];
+          max_label = std::max(max_label, group_idx[j]);
+        }
+        next_label += max_label + 1;
+      }
+      start = i;
+    }
+  }
 }
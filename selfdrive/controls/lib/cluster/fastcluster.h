@@ -72,6 +72,7 @@ enum hclust_fast_methods {
 
 void hclust_pdist(int n, int m, double* pts, double* out);
 void cluster_points_centroid(int n, int m, double* pts, double dist, int* idx);
+void cluster_points_centroid_split(int n, int m, double* pts, double dist, int* idx);
 
 
 #endif
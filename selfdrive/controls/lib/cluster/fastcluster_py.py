@@ -13,16 +13,25 @@ int hclust_fast(int n, double* distmat, int method, int* merge, double* height);
 void cutree_cdist(int n, const int* merge, double* height, double cdist, int* labels);
 void hclust_pdist(int n, int m, double* pts, double* out);
 void cluster_points_centroid(int n, int m, double* pts, double dist, int* idx);
+void cluster_points_centroid_split(int n, int m, double* pts, double dist, int* idx);
 """)
 
 hclust = ffi.dlopen(cluster_fn)
 
 
-def cluster_points_centroid(pts, dist):
+def _cluster_points_centroid(pts, dist, split=False):
   pts = np.ascontiguousarray(pts, dtype=np.float64)
   pts_ptr = ffi.cast("double *", pts.ctypes.data)
   n, m = pts.shape
 
   labels_ptr = ffi.new("int[]", n)
-  hclust.cluster_points_centroid(n, m, pts_ptr, dist**2, labels_ptr)
+  if split:
+    hclust.cluster_points_centroid_split(n, m, pts_ptr, dist**2, labels_ptr)
+  else:
+    hclust.cluster_points_centroid(n, m, pts_ptr, dist**2, labels_ptr)
   return list(labels_ptr)
+
+
+def cluster_points_centroid(pts, dist):
+  # points far apart in dRel are split off before the hierarchical clustering
+  return _cluster_points_centroid(pts, dist, split=True)
@@ -37,10 +37,15 @@ class ET:
 EVENT_NAME = {v: k for k, v in EventName.schema.enumerants.items()}
 
 class Events:
+  """Active events, kept in the order they were added and as a bitset over
+     EventName values, which makes any() a single AND with a mask per type."""
   def __init__(self):
     self.events = []
     self.static_events = []
-    self.events_prev = dict.fromkeys(EVENTS.keys(), 0)
+    self.mask = 0
+    self.static_mask = 0
+    # number of consecutive cycles each of the previous events was active
+    self.events_prev = {}
 
   @property
   def names(self):
@@ -52,24 +57,34 @@ class Events:
   def add(self, event_name, static=False):
     if static:
       self.static_events.append(event_name)
+      self.static_mask |= 1 << event_name
     self.events.append(event_name)
+    self.mask |= 1 << event_name
 
   def clear(self):
-    self.events_prev = {k: (v+1 if k in self.events else 0) for k, v in self.events_prev.items()}
+    self.events_prev = {k: self.events_prev.get(k, 0) + 1 for k in self.events if k in EVENTS}
     self.events = self.static_events.copy()
+    self.mask = self.static_mask
 
   def any(self, event_type):
-    for e in self.events:
-      if event_type in EVENTS.get(e, {}).keys():
-        return True
-    return False
+    return (self.mask & EVENT_TYPE_MASKS.get(event_type, 0)) != 0
 
   def create_alerts(self, event_types, callback_args=None):
     if callback_args is None:
       callback_args = []
 
+    types_mask = 0
+    for et in event_types:
+      types_mask |= EVENT_TYPE_MASKS.get(et, 0)
+
     ret = []
+    if not self.mask & types_mask:
+      return ret
+
     for e in self.events:
+      if not (1 << e) & types_mask:
+        continue
+
       types = EVENTS[e].keys()
       for et in event_types:
         if et in types:
@@ -77,7 +92,7 @@ class Events:
           if not isinstance(alert, Alert):
             alert = alert(*callback_args)
 
-          if DT_CTRL * (self.events_prev[e] + 1) >= alert.creation_delay:
+          if DT_CTRL * (self.events_prev.get(e, 0) + 1) >= alert.creation_delay:
             alert.alert_type = f"{EVENT_NAME[e]}/{et}"
             alert.event_type = et
             ret.append(alert)
@@ -86,17 +101,22 @@ class Events:
   def add_from_msg(self, events):
     for e in events:
       self.events.append(e.name.raw)
+      self.mask |= 1 << e.name.raw
 
   def to_msg(self):
     ret = []
     for event_name in self.events:
-      event = car.CarEvent.new_message()
-      event.name = event_name
-      for event_type in EVENTS.get(event_name, {}).keys():
-        setattr(event, event_type , True)
-      ret.append(event)
+      ret.append(car.CarEvent.new_message(name=event_name, **EVENT_TYPE_FIELDS.get(event_name, {})))
     return ret
 
+  def write_msg(self, events_msg):
+    """Same as to_msg, but fills a list of CarEvent that was initialized with
+       len(self) entries instead of building a message per event"""
+    for event, event_name in zip(events_msg, self.events):
+      event.name = event_name
+      for event_type in EVENT_TYPE_FIELDS.get(event_name, {}):
+        setattr(event, event_type, True)
+
 class Alert:
   def __init__(self,
                alert_text_1: str,
@@ -751,3 +771,9 @@ EVENTS: Dict[int, Dict[str, Union[Alert, Callable[[Any, messaging.SubMaster, boo
   },
 
 }
+
+# bitset over EventName values of the events that have each event type
+EVENT_TYPE_MASKS: Dict[str, int] = {et: sum(1 << e for e, alerts in EVENTS.items() if et in alerts)
+                                    for et in {et for alerts in EVENTS.values() for et in alerts}}
+# fields to set in a CarEvent for each event
+EVENT_TYPE_FIELDS: Dict[int, Dict[str, bool]] = {e: dict.fromkeys(alerts, True) for e, alerts in EVENTS.items()}
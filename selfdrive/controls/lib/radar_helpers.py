@@ -1,5 +1,5 @@
-from common.numpy_fast import mean
-from common.kalman.simple_kalman import KF1D
+import numpy as np
+
 from selfdrive.config import RADAR_TO_CAMERA
 
 
@@ -7,113 +7,162 @@ from selfdrive.config import RADAR_TO_CAMERA
 # TODO is this a good default?
 _LEAD_ACCEL_TAU = 1.5
 
-# radar tracks
-SPEED, ACCEL = 0, 1   # Kalman filter states enum
-
 # stationary qualification parameters
 v_ego_stationary = 4.   # no stationary object flag below this speed
 
 
-class Track():
-  def __init__(self, v_lead, kalman_params):
-    self.cnt = 0
-    self.aLeadTau = _LEAD_ACCEL_TAU
-    self.K_A = kalman_params.A
-    self.K_C = kalman_params.C
-    self.K_K = kalman_params.K
-    self.kf = KF1D([[v_lead], [0.0]], self.K_A, self.K_C, self.K_K)
-
-  def update(self, d_rel, y_rel, v_rel, v_lead, measured):
-    # relative values, copy
-    self.dRel = d_rel   # LONG_DIST
-    self.yRel = y_rel   # -LAT_DIST
-    self.vRel = v_rel   # REL_SPEED
+class Tracks():
+  """Radar tracks stored as one array per field, rows sorted by track id.
+
+     All tracks share the same lead Kalman filter parameters, so the filters
+     are stepped together instead of keeping a KF1D per track.
+  """
+  def __init__(self, kalman_params):
+    A, C, K = kalman_params.A, kalman_params.C, kalman_params.K
+    # same precomputation as KF1D, so the states match it exactly
+    self.K0, self.K1 = K[0][0], K[1][0]
+    self.A_K_0 = A[0][0] - self.K0 * C[0]
+    self.A_K_1 = A[0][1] - self.K0 * C[1]
+    self.A_K_2 = A[1][0] - self.K1 * C[0]
+    self.A_K_3 = A[1][1] - self.K1 * C[1]
+
+    self.ids = np.zeros(0, dtype=np.int64)
+    self.dRel = np.zeros(0)     # LONG_DIST
+    self.yRel = np.zeros(0)     # -LAT_DIST
+    self.vRel = np.zeros(0)     # REL_SPEED
+    self.vLead = np.zeros(0)
+    self.measured = np.zeros(0, dtype=bool)   # measured or estimate
+    self.vLeadK = np.zeros(0)   # Kalman filter SPEED state
+    self.aLeadK = np.zeros(0)   # Kalman filter ACCEL state
+    self.aLeadTau = np.zeros(0)
+    self.cnt = np.zeros(0, dtype=np.int64)
+
+  def __len__(self):
+    return len(self.ids)
+
+  def update(self, ids, d_rel, y_rel, v_rel, v_lead, measured):
+    """Replaces the tracks with the given points. Points whose id was already
+       tracked keep their filter state, tracks that are missing are dropped."""
+    ids = np.asarray(ids, dtype=np.int64)
+    v_lead = np.asarray(v_lead, dtype=np.float64)
+
+    # carry over the state of existing tracks, create the new ones
+    x0, x1 = v_lead.copy(), np.zeros(len(ids))
+    a_lead_tau = np.full(len(ids), _LEAD_ACCEL_TAU)
+    cnt = np.zeros(len(ids), dtype=np.int64)
+    if len(self.ids):
+      pos = np.minimum(np.searchsorted(self.ids, ids), len(self.ids) - 1)
+      existing = self.ids[pos] == ids
+      pos = pos[existing]
+      x0[existing] = self.vLeadK[pos]
+      x1[existing] = self.aLeadK[pos]
+      a_lead_tau[existing] = self.aLeadTau[pos]
+      cnt[existing] = self.cnt[pos]
+
+    self.ids = ids
+    self.dRel = np.asarray(d_rel, dtype=np.float64)
+    self.yRel = np.asarray(y_rel, dtype=np.float64)
+    self.vRel = np.asarray(v_rel, dtype=np.float64)
     self.vLead = v_lead
-    self.measured = measured   # measured or estimate
+    self.measured = np.asarray(measured, dtype=bool)
 
-    # computed velocity and accelerations
-    if self.cnt > 0:
-      self.kf.update(self.vLead)
-
-    self.vLeadK = float(self.kf.x[SPEED][0])
-    self.aLeadK = float(self.kf.x[ACCEL][0])
+    # computed velocity and accelerations, a new track starts at its first measurement
+    kf = cnt > 0
+    self.vLeadK = np.where(kf, self.A_K_0 * x0 + self.A_K_1 * x1 + self.K0 * v_lead, x0)
+    self.aLeadK = np.where(kf, self.A_K_2 * x0 + self.A_K_3 * x1 + self.K1 * v_lead, x1)
 
     # Learn if constant acceleration
-    if abs(self.aLeadK) < 0.5:
-      self.aLeadTau = _LEAD_ACCEL_TAU
-    else:
-      self.aLeadTau *= 0.9
+    self.aLeadTau = np.where(np.abs(self.aLeadK) < 0.5, _LEAD_ACCEL_TAU, a_lead_tau * 0.9)
 
-    self.cnt += 1
+    self.cnt = cnt + 1
 
-  def get_key_for_cluster(self):
+  def get_keys_for_cluster(self):
     # Weigh y higher since radar is inaccurate in this dimension
-    return [self.dRel, self.yRel*2, self.vRel]
+    return np.column_stack((self.dRel, self.yRel*2, self.vRel))
+
+  def reset_a_lead(self, mask, aLeadK, aLeadTau):
+    self.vLeadK = np.where(mask, self.vLead, self.vLeadK)
+    self.aLeadK = np.where(mask, aLeadK, self.aLeadK)
+    self.aLeadTau = np.where(mask, aLeadTau, self.aLeadTau)
+
+
+class Clusters():
+  """Per cluster means of the track fields, computed once per radar cycle."""
+  def __init__(self, tracks, labels):
+    labels = np.asarray(labels, dtype=np.int64)
+    n = int(labels.max()) + 1 if len(labels) else 0
+    cnt = np.bincount(labels, minlength=n)
+
+    def mean(x, mask=None):
+      if mask is None:
+        return np.bincount(labels, weights=x, minlength=n) / cnt
+      # sum only the selected tracks, in the same order as a full mean
+      sel_cnt = np.bincount(labels[mask], minlength=n)
+      sums = np.bincount(labels[mask], weights=x[mask], minlength=n)
+      return sums / np.maximum(sel_cnt, 1), sel_cnt > 0
+
+    self.dRel = mean(tracks.dRel)
+    self.yRel = mean(tracks.yRel)
+    self.vRel = mean(tracks.vRel)
+    self.vLead = mean(tracks.vLead)
+    self.vLeadK = mean(tracks.vLeadK)
+    self.measured = np.bincount(labels, weights=tracks.measured, minlength=n) > 0
+
+    # the acceleration of new tracks isn't known yet
+    a_lead_k, learned = mean(tracks.aLeadK, tracks.cnt > 1)
+    a_lead_tau, _ = mean(tracks.aLeadTau, tracks.cnt > 1)
+    self.aLeadK = np.where(learned, a_lead_k, 0.)
+    self.aLeadTau = np.where(learned, a_lead_tau, _LEAD_ACCEL_TAU)
+
+  def __len__(self):
+    return len(self.dRel)
+
+  def potential_low_speed_leads(self, v_ego):
+    # stop for stuff in front of you and low speed, even without model confirmation
+    return (np.abs(self.yRel) < 1.5) & (v_ego < v_ego_stationary) & (self.dRel < 25)
 
-  def reset_a_lead(self, aLeadK, aLeadTau):
-    self.kf = KF1D([[self.vLead], [aLeadK]], self.K_A, self.K_C, self.K_K)
-    self.aLeadK = aLeadK
-    self.aLeadTau = aLeadTau
+  def __getitem__(self, idx):
+    if idx < 0 or idx >= len(self):
+      raise IndexError(idx)
+    return Cluster(self, idx)
 
 
 class Cluster():
-  def __init__(self):
-    self.tracks = set()
+  def __init__(self, clusters=None, idx=0):
+    self.clusters = clusters
+    self.idx = idx
 
-  def add(self, t):
-    # add the first track
-    self.tracks.add(t)
-
-  # TODO: make generic
   @property
   def dRel(self):
-    return mean([t.dRel for t in self.tracks])
+    return self.clusters.dRel[self.idx]
 
   @property
   def yRel(self):
-    return mean([t.yRel for t in self.tracks])
+    return self.clusters.yRel[self.idx]
 
   @property
   def vRel(self):
-    return mean([t.vRel for t in self.tracks])
-
-  @property
-  def aRel(self):
-    return mean([t.aRel for t in self.tracks])
+    return self.clusters.vRel[self.idx]
 
   @property
   def vLead(self):
-    return mean([t.vLead for t in self.tracks])
-
-  @property
-  def dPath(self):
-    return mean([t.dPath for t in self.tracks])
-
-  @property
-  def vLat(self):
-    return mean([t.vLat for t in self.tracks])
+    return self.clusters.vLead[self.idx]
 
   @property
   def vLeadK(self):
-    return mean([t.vLeadK for t in self.tracks])
+    return self.clusters.vLeadK[self.idx]
 
   @property
   def aLeadK(self):
-    if all(t.cnt <= 1 for t in self.tracks):
-      return 0.
-    else:
-      return mean([t.aLeadK for t in self.tracks if t.cnt > 1])
+    return self.clusters.aLeadK[self.idx]
 
   @property
   def aLeadTau(self):
-    if all(t.cnt <= 1 for t in self.tracks):
-      return _LEAD_ACCEL_TAU
-    else:
-      return mean([t.aLeadTau for t in self.tracks if t.cnt > 1])
+    return self.clusters.aLeadTau[self.idx]
 
   @property
   def measured(self):
-    return any(t.measured for t in self.tracks)
+    return bool(self.clusters.measured[self.idx])
 
   def get_RadarState(self, model_prob=0.0):
     return {
@@ -149,9 +198,5 @@ class Cluster():
     ret = "x: %4.1f  y: %4.1f  v: %4.1f  a: %4.1f" % (self.dRel, self.yRel, self.vRel, self.aLeadK)
     return ret
 
-  def potential_low_speed_lead(self, v_ego):
-    # stop for stuff in front of you and low speed, even without model confirmation
-    return abs(self.yRel) < 1.5 and (v_ego < v_ego_stationary) and self.dRel < 25
-
   def is_potential_fcw(self, model_prob):
     return model_prob > .9
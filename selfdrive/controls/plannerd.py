@@ -9,7 +9,8 @@ from selfdrive.controls.lib.pathplanner import PathPlanner
 import cereal.messaging as messaging
 
 
-def plannerd_thread(sm=None, pm=None):
+def plannerd_steps(sm=None, pm=None):
+  """Sets up plannerd and then runs one iteration of its loop per next()"""
 
   config_realtime_process(2, Priority.CTRL_LOW)
 
@@ -35,6 +36,7 @@ def plannerd_thread(sm=None, pm=None):
   sm['liveParameters'].stiffnessFactor = 1.0
 
   while True:
+    yield
     sm.update()
 
     if sm.updated['model']:
@@ -43,6 +45,11 @@ def plannerd_thread(sm=None, pm=None):
       PL.update(sm, pm, CP, VM, PP)
 
 
+def plannerd_thread(sm=None, pm=None):
+  for _ in plannerd_steps(sm, pm):
+    pass
+
+
 def main(sm=None, pm=None):
   plannerd_thread(sm, pm)
 
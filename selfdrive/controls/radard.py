@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 import importlib
-import math
-from collections import defaultdict, deque
+from collections import deque
+
+import numpy as np
 
 import cereal.messaging as messaging
 from cereal import car
@@ -10,7 +11,8 @@ from common.params import Params
 from common.realtime import Ratekeeper, Priority, config_realtime_process
 from selfdrive.config import RADAR_TO_CAMERA
 from selfdrive.controls.lib.cluster.fastcluster_py import cluster_points_centroid
-from selfdrive.controls.lib.radar_helpers import Cluster, Track
+from selfdrive.controls.lib.radar_helpers import Cluster, Clusters, Tracks
+from selfdrive.message_pool import MessagePool
 from selfdrive.swaglog import cloudlog
 
 
@@ -31,65 +33,71 @@ class KalmanParams():
 
 
 def laplacian_cdf(x, mu, b):
-  b = max(b, 1e-4)
-  return math.exp(-abs(x-mu)/b)
-
+  b = np.maximum(b, 1e-4)
+  return np.exp(-np.abs(x-mu)/b)
 
-def match_vision_to_cluster(v_ego, lead, clusters):
-  # match vision point to best statistical cluster match
-  offset_vision_dist = lead.dist - RADAR_TO_CAMERA
 
-  def prob(c):
-    prob_d = laplacian_cdf(c.dRel, offset_vision_dist, lead.std)
-    prob_y = laplacian_cdf(c.yRel, lead.relY, lead.relYStd)
-    prob_v = laplacian_cdf(c.vRel, lead.relVel, lead.relVelStd)
+def match_vision_to_clusters(v_ego, leads, clusters):
+  """Returns the index of the best matching cluster for every vision lead,
+     or None for leads without a sane match."""
+  # match vision points to best statistical cluster matches, all leads at once
+  offset_vision_dist = np.array([lead.dist - RADAR_TO_CAMERA for lead in leads])
+  rel_y = np.array([lead.relY for lead in leads])
+  rel_vel = np.array([lead.relVel for lead in leads])
 
-    # This is isn't exactly right, but good heuristic
-    return prob_d * prob_y * prob_v
+  prob_d = laplacian_cdf(clusters.dRel, offset_vision_dist[:, None], np.array([lead.std for lead in leads])[:, None])
+  prob_y = laplacian_cdf(clusters.yRel, rel_y[:, None], np.array([lead.relYStd for lead in leads])[:, None])
+  prob_v = laplacian_cdf(clusters.vRel, rel_vel[:, None], np.array([lead.relVelStd for lead in leads])[:, None])
 
-  cluster = max(clusters, key=prob)
+  # This is isn't exactly right, but good heuristic
+  best = np.argmax(prob_d * prob_y * prob_v, axis=1)
 
-  # if no 'sane' match is found return -1
+  # if no 'sane' match is found return None
   # stationary radar points can be false positives
-  dist_sane = abs(cluster.dRel - offset_vision_dist) < max([(offset_vision_dist)*.25, 5.0])
-  vel_sane = (abs(cluster.vRel - lead.relVel) < 10) or (v_ego + cluster.vRel > 3)
-  if dist_sane and vel_sane:
-    return cluster
-  else:
-    return None
+  d_rel, v_rel = clusters.dRel[best], clusters.vRel[best]
+  dist_sane = np.abs(d_rel - offset_vision_dist) < np.maximum(offset_vision_dist*.25, 5.0)
+  vel_sane = (np.abs(v_rel - rel_vel) < 10) | (v_ego + v_rel > 3)
+  return [int(idx) if sane else None for idx, sane in zip(best, dist_sane & vel_sane)]
 
 
-def get_lead(v_ego, ready, clusters, lead_msg, low_speed_override=True):
+def get_leads(v_ego, ready, clusters, lead_msgs, low_speed_override):
+  """Determines a lead for every vision lead in lead_msgs, low_speed_override
+     holds a flag per lead."""
   # Determine leads, this is where the essential logic happens
-  if len(clusters) > 0 and ready and lead_msg.prob > .5:
-    cluster = match_vision_to_cluster(v_ego, lead_msg, clusters)
+  if len(clusters) > 0 and ready and any(lead_msg.prob > .5 for lead_msg in lead_msgs):
+    matches = match_vision_to_clusters(v_ego, lead_msgs, clusters)
   else:
-    cluster = None
-
-  lead_dict = {'status': False}
-  if cluster is not None:
-    lead_dict = cluster.get_RadarState(lead_msg.prob)
-  elif (cluster is None) and ready and (lead_msg.prob > .5):
-    lead_dict = Cluster().get_RadarState_from_vision(lead_msg, v_ego)
-
-  if low_speed_override:
-    low_speed_clusters = [c for c in clusters if c.potential_low_speed_lead(v_ego)]
-    if len(low_speed_clusters) > 0:
-      closest_cluster = min(low_speed_clusters, key=lambda c: c.dRel)
-
+    matches = [None] * len(lead_msgs)
+
+  closest = None
+  if len(clusters) > 0 and any(low_speed_override):
+    low_speed = np.flatnonzero(clusters.potential_low_speed_leads(v_ego))
+    if len(low_speed) > 0:
+      closest = low_speed[np.argmin(clusters.dRel[low_speed])]
+
+  lead_dicts = []
+  for lead_msg, match, override in zip(lead_msgs, matches, low_speed_override):
+    lead_dict = {'status': False}
+    if match is not None and lead_msg.prob > .5:
+      lead_dict = clusters[match].get_RadarState(lead_msg.prob)
+    elif ready and (lead_msg.prob > .5):
+      lead_dict = Cluster().get_RadarState_from_vision(lead_msg, v_ego)
+
+    if override and closest is not None:
       # Only choose new cluster if it is actually closer than the previous one
-      if (not lead_dict['status']) or (closest_cluster.dRel < lead_dict['dRel']):
-        lead_dict = closest_cluster.get_RadarState()
+      if (not lead_dict['status']) or (clusters.dRel[closest] < lead_dict['dRel']):
+        lead_dict = clusters[closest].get_RadarState()
+    lead_dicts.append(lead_dict)
 
-  return lead_dict
+  return lead_dicts
 
 
 class RadarD():
   def __init__(self, radar_ts, delay=0):
     self.current_time = 0
 
-    self.tracks = defaultdict(dict)
-    self.kalman_params = KalmanParams(radar_ts)
+    self.tracks = Tracks(KalmanParams(radar_ts))
+    self.pool = MessagePool()
 
     # v_ego
     self.v_ego = 0.
@@ -110,53 +118,29 @@ class RadarD():
     for pt in rr.points:
       ar_pts[pt.trackId] = [pt.dRel, pt.yRel, pt.vRel, pt.measured]
 
-    # *** remove missing points from meta data ***
-    for ids in list(self.tracks.keys()):
-      if ids not in ar_pts:
-        self.tracks.pop(ids, None)
-
     # *** compute the tracks ***
-    for ids in ar_pts:
-      rpt = ar_pts[ids]
-
-      # align v_ego by a fixed time to align it with the radar measurement
-      v_lead = rpt[2] + self.v_ego_hist[0]
-
-      # create the track if it doesn't exist or it's a new track
-      if ids not in self.tracks:
-        self.tracks[ids] = Track(v_lead, self.kalman_params)
-      self.tracks[ids].update(rpt[0], rpt[1], rpt[2], v_lead, rpt[3])
-
-    idens = list(sorted(self.tracks.keys()))
-    track_pts = list([self.tracks[iden].get_key_for_cluster() for iden in idens])
-
-    # If we have multiple points, cluster them
-    if len(track_pts) > 1:
-      cluster_idxs = cluster_points_centroid(track_pts, 2.5)
-      clusters = [None] * (max(cluster_idxs) + 1)
-
-      for idx in range(len(track_pts)):
-        cluster_i = cluster_idxs[idx]
-        if clusters[cluster_i] is None:
-          clusters[cluster_i] = Cluster()
-        clusters[cluster_i].add(self.tracks[idens[idx]])
-    elif len(track_pts) == 1:
-      # FIXME: cluster_point_centroid hangs forever if len(track_pts) == 1
-      cluster_idxs = [0]
-      clusters = [Cluster()]
-      clusters[0].add(self.tracks[idens[0]])
+    ids = sorted(ar_pts.keys())
+    rpts = [ar_pts[iden] for iden in ids]
+    # align v_ego by a fixed time to align it with the radar measurement
+    v_lead = [rpt[2] + self.v_ego_hist[0] for rpt in rpts]
+    self.tracks.update(ids, [rpt[0] for rpt in rpts], [rpt[1] for rpt in rpts],
+                       [rpt[2] for rpt in rpts], v_lead, [rpt[3] for rpt in rpts])
+
+    # Cluster the points, the split clustering also takes a single one
+    if len(self.tracks) > 0:
+      cluster_idxs = cluster_points_centroid(self.tracks.get_keys_for_cluster(), 2.5)
     else:
-      clusters = []
+      cluster_idxs = []
+    cluster_idxs = np.array(cluster_idxs, dtype=np.int64)
+    clusters = Clusters(self.tracks, cluster_idxs)
 
     # if a new point, reset accel to the rest of the cluster
-    for idx in range(len(track_pts)):
-      if self.tracks[idens[idx]].cnt <= 1:
-        aLeadK = clusters[cluster_idxs[idx]].aLeadK
-        aLeadTau = clusters[cluster_idxs[idx]].aLeadTau
-        self.tracks[idens[idx]].reset_a_lead(aLeadK, aLeadTau)
+    new_tracks = self.tracks.cnt <= 1
+    if np.any(new_tracks):
+      self.tracks.reset_a_lead(new_tracks, clusters.aLeadK[cluster_idxs], clusters.aLeadTau[cluster_idxs])
 
     # *** publish radarState ***
-    dat = messaging.new_message('radarState')
+    dat = self.pool.new_message('radarState')
     dat.valid = sm.all_alive_and_valid()
     radarState = dat.radarState
     radarState.mdMonoTime = sm.logMonoTime['model']
@@ -165,13 +149,14 @@ class RadarD():
     radarState.controlsStateMonoTime = sm.logMonoTime['controlsState']
 
     if enable_lead:
-      radarState.leadOne = get_lead(self.v_ego, self.ready, clusters, sm['model'].lead, low_speed_override=True)
-      radarState.leadTwo = get_lead(self.v_ego, self.ready, clusters, sm['model'].leadFuture, low_speed_override=False)
+      leads = get_leads(self.v_ego, self.ready, clusters, [sm['model'].lead, sm['model'].leadFuture], [True, False])
+      radarState.leadOne, radarState.leadTwo = leads
     return dat
 
 
 # fuses camera and radar data for best lead detection
-def radard_thread(sm=None, pm=None, can_sock=None):
+def radard_steps(sm=None, pm=None, can_sock=None):
+  """Sets up radard and then runs one iteration of its loop per next()"""
   config_realtime_process(2, Priority.CTRL_LOW)
 
   # wait for stats about the car to come in from controls
@@ -200,6 +185,7 @@ def radard_thread(sm=None, pm=None, can_sock=None):
   enable_lead = CP.openpilotLongitudinalControl or not CP.radarOffCan
 
   while 1:
+    yield
     can_strings = messaging.drain_sock_raw(can_sock, wait_for_one=True)
     rr = RI.update(can_strings)
 
@@ -215,20 +201,25 @@ def radard_thread(sm=None, pm=None, can_sock=None):
 
     # *** publish tracks for UI debugging (keep last) ***
     tracks = RD.tracks
-    dat = messaging.new_message('liveTracks', len(tracks))
+    dat = RD.pool.new_message('liveTracks', len(tracks))
 
-    for cnt, ids in enumerate(sorted(tracks.keys())):
+    for cnt in range(len(tracks)):
       dat.liveTracks[cnt] = {
-        "trackId": ids,
-        "dRel": float(tracks[ids].dRel),
-        "yRel": float(tracks[ids].yRel),
-        "vRel": float(tracks[ids].vRel),
+        "trackId": int(tracks.ids[cnt]),
+        "dRel": float(tracks.dRel[cnt]),
+        "yRel": float(tracks.yRel[cnt]),
+        "vRel": float(tracks.vRel[cnt]),
       }
     pm.send('liveTracks', dat)
 
     rk.monitor_time()
 
 
+def radard_thread(sm=None, pm=None, can_sock=None):
+  for _ in radard_steps(sm, pm, can_sock):
+    pass
+
+
 def main(sm=None, pm=None, can_sock=None):
   radard_thread(sm, pm, can_sock)
 
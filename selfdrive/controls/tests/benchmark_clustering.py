@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+# Time per call of centroid clustering with and without the dRel split
+import time
+import numpy as np
+
+from selfdrive.controls.lib.cluster.fastcluster_py import cluster_points_centroid, _cluster_points_centroid
+
+N = 200
+
+
+def random_radar_pts(n):
+  # spread like the points of a radar with many tracks
+  x = np.random.uniform(0, 200, (n, 1))
+  y = np.random.uniform(-10, 10, (n, 1))
+  vrel = np.random.uniform(-20, 5, (n, 1))
+  return np.hstack([x, y, vrel])
+
+
+def time_per_call(f, samples):
+  t = time.monotonic()
+  for pts in samples:
+    f(pts, 2.5)
+  return (time.monotonic() - t) / len(samples)
+
+
+if __name__ == "__main__":
+  np.random.seed(1337)
+
+  print("tracks  all (us)  split (us)")
+  for n in [1, 2, 4, 8, 16, 32, 64, 128]:
+    samples = [random_radar_pts(n) for _ in range(N)]
+    t_split = time_per_call(cluster_points_centroid, samples)
+    # the hierarchical clustering alone can't take a single point
+    if n == 1:
+      print("%6d  %8s  %10.1f" % (n, "-", t_split * 1e6))
+      continue
+    t_all = time_per_call(_cluster_points_centroid, samples)
+    print("%6d  %8.1f  %10.1f" % (n, t_all * 1e6, t_split * 1e6))
@@ -8,7 +8,7 @@ from scipy.cluster import _hierarchy
 from scipy.spatial.distance import pdist
 
 from selfdrive.controls.lib.cluster.fastcluster_py import hclust, ffi
-from selfdrive.controls.lib.cluster.fastcluster_py import cluster_points_centroid
+from selfdrive.controls.lib.cluster.fastcluster_py import cluster_points_centroid, _cluster_points_centroid
 
 
 def fcluster(Z, t, criterion='inconsistent', depth=2, R=None, monocrit=None):
@@ -135,6 +135,22 @@ class TestClustering(unittest.TestCase):
 
       self.assertTrue(same_clusters(old_cluster_idx, cluster_idx))
 
+  def random_radar_pts(self, n):
+    # spread like the points of a radar with many tracks
+    x = np.random.uniform(0, 200, (n, 1))
+    y = np.random.uniform(-10, 10, (n, 1))
+    vrel = np.random.uniform(-20, 5, (n, 1))
+    return np.hstack([x, y, vrel])
+
+  def test_split_clustering(self):
+    np.random.seed(1337)
+    for _ in range(1000):
+      pts = self.random_radar_pts(int(np.random.uniform(2, 128)))
+      self.assertTrue(same_clusters(_cluster_points_centroid(pts, 2.5), cluster_points_centroid(pts, 2.5)))
+
+    self.assertEqual(cluster_points_centroid(TRACK_PTS[:1], 2.5), [0])
+    self.assertEqual(cluster_points_centroid(TRACK_PTS[:0], 2.5), [])
+
 
 if __name__ == "__main__":
   unittest.main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+import random
+import unittest
+
+from cereal import car
+from common.realtime import DT_CTRL
+from selfdrive.controls.lib.events import Alert, Events, EVENTS, ET
+
+EventName = car.CarEvent.EventName
+EVENT_TYPES = [v for k, v in vars(ET).items() if not k.startswith('_')]
+
+
+class TestEvents(unittest.TestCase):
+  def test_any(self):
+    random.seed(0)
+    names = list(EVENTS.keys())
+    events = Events()
+    for _ in range(100):
+      events.clear()
+      active = random.sample(names, random.randint(0, 5))
+      for e in active:
+        events.add(e)
+
+      self.assertEqual(events.names, active)
+      for et in EVENT_TYPES:
+        expected = any(et in EVENTS[e] for e in active)
+        self.assertEqual(events.any(et), expected, msg=et)
+
+  def test_static_events(self):
+    events = Events()
+    events.add(EventName.startupMaster, static=True)
+    events.add(EventName.canError)
+    events.clear()
+    self.assertEqual(events.names, [EventName.startupMaster])
+    self.assertTrue(events.any(ET.PERMANENT))
+    self.assertFalse(events.any(ET.IMMEDIATE_DISABLE))
+
+  def test_to_msg(self):
+    events = Events()
+    events.add(EventName.canError)
+    events.add(EventName.pcmEnable)
+    msgs = events.to_msg()
+
+    self.assertEqual([m.name for m in msgs], ["canError", "pcmEnable"])
+    for m, e in zip(msgs, [EventName.canError, EventName.pcmEnable]):
+      for et in EVENT_TYPES:
+        self.assertEqual(getattr(m, et), et in EVENTS[e])
+
+  def test_creation_delay(self):
+    events = Events()
+    # find an event with a delayed alert
+    e, et = next((e, et) for e, alerts in EVENTS.items() for et, a in alerts.items()
+                 if isinstance(a, Alert) and a.creation_delay > 0)
+    delay = EVENTS[e][et].creation_delay
+
+    cycles = 0
+    while True:
+      events.clear()
+      events.add(e)
+      cycles += 1
+      if len(events.create_alerts([et])):
+        break
+    self.assertAlmostEqual(cycles * DT_CTRL, delay, delta=DT_CTRL + 1e-6)
+
+
+if __name__ == "__main__":
+  unittest.main()
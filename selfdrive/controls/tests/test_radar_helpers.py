@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+import random
+import unittest
+import numpy as np
+
+from common.kalman.simple_kalman import KF1D
+from common.numpy_fast import mean
+from selfdrive.controls.lib.radar_helpers import Clusters, Tracks, _LEAD_ACCEL_TAU
+from selfdrive.controls.radard import KalmanParams
+
+
+class TestRadarHelpers(unittest.TestCase):
+  def test_tracks_match_kf1d(self):
+    random.seed(0)
+    kp = KalmanParams(0.05)
+    tracks = Tracks(kp)
+    kfs = {}
+
+    for _ in range(200):
+      ids = sorted(random.sample(range(32), random.randint(0, 16)))
+      v_lead = [random.uniform(0., 30.) for _ in ids]
+      tracks.update(ids, [50.] * len(ids), [0.] * len(ids), [0.] * len(ids), v_lead, [True] * len(ids))
+
+      kfs = {i: kfs[i] for i in ids if i in kfs}
+      for i, v in zip(ids, v_lead):
+        if i in kfs:
+          kfs[i].update(v)
+        else:
+          kfs[i] = KF1D([[v], [0.0]], kp.A, kp.C, kp.K)
+
+      self.assertEqual(list(tracks.ids), ids)
+      self.assertEqual(list(tracks.vLeadK), [kfs[i].x[0][0] for i in ids])
+      self.assertEqual(list(tracks.aLeadK), [kfs[i].x[1][0] for i in ids])
+
+  def test_cluster_means(self):
+    tracks = Tracks(KalmanParams(0.05))
+    tracks.update([1, 2, 3, 4], [10., 11., 50., 51.], [0.1, 0.2, 0.3, 0.4], [-1., -2., -3., -4.],
+                  [20., 21., 22., 23.], [True, False, False, False])
+    tracks.update([1, 2, 3, 4, 5], [10., 11., 50., 51., 52.], [0.1, 0.2, 0.3, 0.4, 0.5], [-1., -2., -3., -4., -5.],
+                  [20., 21., 22., 23., 24.], [True, False, False, False, False])
+    labels = np.array([0, 0, 1, 1, 1])
+    clusters = Clusters(tracks, labels)
+
+    self.assertEqual(len(clusters), 2)
+    self.assertEqual(len(list(clusters)), 2)
+    for c in range(2):
+      sel = labels == c
+      self.assertEqual(clusters[c].dRel, mean(list(tracks.dRel[sel])))
+      self.assertEqual(clusters[c].vLeadK, mean(list(tracks.vLeadK[sel])))
+      # the new track doesn't count towards the cluster acceleration
+      learned = sel & (tracks.cnt > 1)
+      self.assertEqual(clusters[c].aLeadK, mean(list(tracks.aLeadK[learned])))
+    self.assertTrue(clusters[0].measured)
+    self.assertFalse(clusters[1].measured)
+
+    clusters = Clusters(tracks, np.array([0, 0, 1, 1, 2]))
+    self.assertEqual(clusters[2].aLeadK, 0.)
+    self.assertEqual(clusters[2].aLeadTau, _LEAD_ACCEL_TAU)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+import unittest
+from types import SimpleNamespace
+import numpy as np
+
+from selfdrive.config import RADAR_TO_CAMERA
+from selfdrive.controls.lib.radar_helpers import Clusters, Tracks
+from selfdrive.controls.radard import KalmanParams, get_leads
+
+
+def make_lead(dist, rel_y=0., rel_vel=0., prob=.9):
+  return SimpleNamespace(dist=dist + RADAR_TO_CAMERA, std=2., relY=rel_y, relYStd=1.,
+                         relVel=rel_vel, relVelStd=1., prob=prob)
+
+
+def make_clusters(pts):
+  tracks = Tracks(KalmanParams(0.05))
+  tracks.update(list(range(len(pts))), [p[0] for p in pts], [p[1] for p in pts], [p[2] for p in pts],
+                [20. + p[2] for p in pts], [True] * len(pts))
+  return Clusters(tracks, np.arange(len(pts)))
+
+
+class TestRadard(unittest.TestCase):
+  def test_match_per_lead(self):
+    clusters = make_clusters([(20., 0., -1.), (50., 1., -5.), (90., -3., 0.)])
+    lead_one, lead_two = get_leads(20., True, clusters, [make_lead(49., 1., -5.), make_lead(88., -3., 0.)], [True, False])
+
+    self.assertTrue(lead_one['radar'])
+    self.assertEqual(lead_one['dRel'], 50.)
+    self.assertTrue(lead_two['radar'])
+    self.assertEqual(lead_two['dRel'], 90.)
+
+  def test_vision_fallback(self):
+    # no cluster close enough to the vision lead
+    clusters = make_clusters([(20., 0., -1.), (50., 1., -5.)])
+    lead_one, lead_two = get_leads(20., True, clusters, [make_lead(80.), make_lead(80., prob=.1)], [True, False])
+
+    self.assertFalse(lead_one['radar'])
+    self.assertAlmostEqual(lead_one['dRel'], 80.)
+    self.assertFalse(lead_two['status'])
+
+    lead_one, lead_two = get_leads(20., False, clusters, [make_lead(80.), make_lead(80.)], [True, False])
+    self.assertFalse(lead_one['status'])
+    self.assertFalse(lead_two['status'])
+
+  def test_low_speed_override(self):
+    clusters = make_clusters([(30., 0., -1.), (10., 0.5, 0.), (5., 4., 0.)])
+    lead_one, lead_two = get_leads(2., True, clusters, [make_lead(30.), make_lead(30.)], [True, False])
+
+    # closest cluster in front overrides the first lead only
+    self.assertEqual(lead_one['dRel'], 10.)
+    self.assertEqual(lead_two['dRel'], 30.)
+
+    lead_one, _ = get_leads(10., True, clusters, [make_lead(30.), make_lead(30.)], [True, False])
+    self.assertEqual(lead_one['dRel'], 30.)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -176,7 +176,8 @@ class Calibrator():
     pm.send('liveCalibration', cal_send)
 
 
-def calibrationd_thread(sm=None, pm=None):
+def calibrationd_steps(sm=None, pm=None):
+  """Sets up calibrationd and then runs one iteration of its loop per next()"""
   if sm is None:
     sm = messaging.SubMaster(['cameraOdometry', 'carState'], poll=['cameraOdometry'])
 
@@ -186,6 +187,7 @@ def calibrationd_thread(sm=None, pm=None):
   calibrator = Calibrator(param_put=True)
 
   while 1:
+    yield
     timeout = 0 if sm.frame == -1 else 100
     sm.update(timeout)
 
@@ -204,6 +206,11 @@ def calibrationd_thread(sm=None, pm=None):
       calibrator.send_data(pm)
 
 
+def calibrationd_thread(sm=None, pm=None):
+  for _ in calibrationd_steps(sm, pm):
+    pass
+
+
 def main(sm=None, pm=None):
   calibrationd_thread(sm, pm)
 
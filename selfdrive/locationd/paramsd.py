@@ -65,7 +65,8 @@ class ParamsLearner:
       self.kf.filter.reset_rewind()
 
 
-def main(sm=None, pm=None):
+def paramsd_steps(sm=None, pm=None):
+  """Sets up paramsd and then runs one iteration of its loop per next()"""
   if sm is None:
     sm = messaging.SubMaster(['liveLocationKalman', 'carState'], poll=['liveLocationKalman'])
   if pm is None:
@@ -110,6 +111,7 @@ def main(sm=None, pm=None):
   learner = ParamsLearner(CP, params['steerRatio'], params['stiffnessFactor'], math.radians(params['angleOffsetAverage']))
 
   while True:
+    yield
     sm.update()
 
     for which, updated in sm.updated.items():
@@ -148,5 +150,10 @@ def main(sm=None, pm=None):
       pm.send('liveParameters', msg)
 
 
+def main(sm=None, pm=None):
+  for _ in paramsd_steps(sm, pm):
+    pass
+
+
 if __name__ == "__main__":
   main()
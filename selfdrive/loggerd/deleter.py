@@ -1,35 +1,212 @@
 #!/usr/bin/env python3
+import heapq
 import os
-import shutil
+import stat
 import threading
+import time
+from common.inotify import Inotify, IN_ATTRIB, IN_CLOSE_WRITE, IN_CREATE, IN_DELETE, IN_IGNORED, IN_ISDIR, \
+                           IN_MOVED_FROM, IN_MOVED_TO, IN_Q_OVERFLOW
+from common.xattr import getxattr
 from selfdrive.swaglog import cloudlog
 from selfdrive.loggerd.config import ROOT, get_available_bytes, get_available_percent
-from selfdrive.loggerd.uploader import listdir_by_creation
+from selfdrive.loggerd.uploader import UPLOAD_ATTR_NAME, UNWATCHED_RESCAN_INTERVAL, get_directory_sort
 
 MIN_BYTES = 5 * 1024 * 1024 * 1024
 MIN_PERCENT = 10
 
+# uploaded files go first, then files with a lower value, then older files
+DELETE_PRIORITY = {"fcamera.hevc": 0, "ecamera.hevc": 0, "dcamera.hevc": 1, "qcamera.ts": 2,
+                   "rlog.bz2": 3, "bootlog.bz2": 3, "qlog.bz2": 4}
 
-def deleter_thread(exit_event):
-  while not exit_event.is_set():
-    out_of_bytes = get_available_bytes(default=MIN_BYTES + 1) < MIN_BYTES
-    out_of_percent = get_available_percent(default=MIN_PERCENT + 1) < MIN_PERCENT
 
-    if out_of_percent or out_of_bytes:
-      # remove the earliest directory we can
-      dirs = listdir_by_creation(ROOT)
-      for delete_dir in dirs:
-        delete_path = os.path.join(ROOT, delete_dir)
+def bytes_to_free():
+  available_bytes = get_available_bytes(default=MIN_BYTES + 1)
+  available_percent = get_available_percent(default=MIN_PERCENT + 1)
+
+  needed = MIN_BYTES - available_bytes
+  if 0 < available_percent < MIN_PERCENT:
+    # the free space is available_percent of the disk
+    needed = max(needed, (MIN_PERCENT - available_percent) * available_bytes / available_percent)
+  return max(needed, 0)
+
+
+class DeletionPlanner():
+  """Size and upload state of every file in root.
+
+     root is scanned once, after that inotify events from root and the segment
+     directories keep the index up to date, including the upload xattrs set by
+     the uploader. Segments that can't be watched are listed every
+     UNWATCHED_RESCAN_INTERVAL instead. plan picks the files to delete to free
+     a number of bytes.
+  """
+  SEGMENT_MASK = IN_CREATE | IN_CLOSE_WRITE | IN_MOVED_TO | IN_DELETE | IN_MOVED_FROM | IN_ATTRIB
+
+  def __init__(self, root):
+    self.root = root
+    self.inotify = None
+    self.rebuild()
+
+  def rebuild(self):
+    if self.inotify is not None:
+      self.inotify.close()
+      self.inotify = None
 
-        if any(name.endswith(".lock") for name in os.listdir(delete_path)):
+    self.files = {}  # logname -> {name: (size, uploaded)}
+    self.locks = {}  # logname -> lock files, locked segments are never deleted
+    self.wds = {}  # watch descriptor -> logname
+    self.unwatched = set()  # lognames without a watch, rescanned instead
+    self.last_rescan = time.monotonic()
+
+    if not os.path.isdir(self.root):
+      return
+
+    try:
+      self.inotify = Inotify()
+      self.root_wd = self.inotify.add_watch(self.root, IN_CREATE | IN_MOVED_TO | IN_DELETE | IN_MOVED_FROM)
+    except OSError:
+      cloudlog.exception("deleter inotify failed, rescanning every time")
+      self.inotify = None
+
+    for logname in os.listdir(self.root):
+      self.add_segment(logname)
+
+  def update(self):
+    if self.inotify is None:
+      self.rebuild()
+      return
+
+    if self.unwatched and time.monotonic() - self.last_rescan > UNWATCHED_RESCAN_INTERVAL:
+      self.last_rescan = time.monotonic()
+      for logname in list(self.unwatched):
+        self.add_segment(logname)
+
+    for wd, mask, name in self.inotify.read_events():
+      if mask & IN_Q_OVERFLOW:
+        self.rebuild()
+        return
+      elif wd == self.root_wd:
+        if mask & (IN_CREATE | IN_MOVED_TO) and mask & IN_ISDIR:
+          self.add_segment(name)
+        elif mask & (IN_DELETE | IN_MOVED_FROM):
+          self.remove_segment(name)
+      elif wd in self.wds:
+        logname = self.wds[wd]
+        if mask & IN_IGNORED:
+          del self.wds[wd]
+        elif logname not in self.files or not name:
           continue
+        elif name.endswith(".lock"):
+          if mask & (IN_CREATE | IN_MOVED_TO):
+            self.locks[logname].add(name)
+          elif mask & (IN_DELETE | IN_MOVED_FROM):
+            self.locks[logname].discard(name)
+        elif mask & (IN_DELETE | IN_MOVED_FROM):
+          self.files[logname].pop(name, None)
+        else:
+          self.add_file(logname, name)
+
+  def add_segment(self, logname):
+    path = os.path.join(self.root, logname)
+    if not os.path.isdir(path):
+      self.remove_segment(logname)
+      return
+
+    if self.inotify is not None:
+      try:
+        self.wds[self.inotify.add_watch(path, self.SEGMENT_MASK)] = logname
+        self.unwatched.discard(logname)
+      except OSError:
+        if logname not in self.unwatched:
+          cloudlog.exception("deleter can't watch %s, rescanning it" % path)
+        self.unwatched.add(logname)
+
+    try:
+      names = os.listdir(path)
+    except OSError:
+      return
+
+    self.files[logname] = {}
+    self.locks[logname] = {name for name in names if name.endswith(".lock")}
+    for name in names:
+      if not name.endswith(".lock"):
+        self.add_file(logname, name)
+
+  def remove_segment(self, logname):
+    self.unwatched.discard(logname)
+    self.files.pop(logname, None)
+    self.locks.pop(logname, None)
+
+  def add_file(self, logname, name):
+    fn = os.path.join(self.root, logname, name)
+    try:
+      st = os.stat(fn)
+      if not stat.S_ISREG(st.st_mode):
+        return
+      uploaded = getxattr(fn, UPLOAD_ATTR_NAME) is not None
+    except OSError:
+      self.files[logname].pop(name, None)
+      return
+    # blocks used on disk, that's what deleting it frees
+    self.files[logname][name] = (st.st_blocks * 512, uploaded)
+
+  def plan(self, needed):
+    """[(logname, name, size)] to delete to free needed bytes, or as many as possible.
+       Files of locked segments are never deleted."""
+    self.update()
+
+    candidates = []
+    for logname, files in self.files.items():
+      if self.locks[logname]:
+        continue
+      seg = tuple(get_directory_sort(logname))
+      for name, (size, uploaded) in files.items():
+        candidates.append((not uploaded, DELETE_PRIORITY.get(name, 0), seg, logname, name, size))
+    heapq.heapify(candidates)
+
+    plan = []
+    freed = 0
+    while freed < needed and len(candidates):
+      _, _, _, logname, name, size = heapq.heappop(candidates)
+      plan.append((logname, name, size))
+      freed += size
+    return plan
+
+  def delete(self, plan):
+    """Deletes the files of a plan, and the unlocked segments that are left without files."""
+    for logname, name, _ in plan:
+      fn = os.path.join(self.root, logname, name)
+      try:
+        cloudlog.info("deleting %s" % fn)
+        os.remove(fn)
+      except OSError:
+        cloudlog.exception("issue deleting %s" % fn)
+      self.files[logname].pop(name, None)
+
+    # an empty newest segment can be one loggerd is about to write to
+    newest = max(self.files, key=get_directory_sort, default=None)
+    emptied = {logname for logname, _, _ in plan}
+    for logname in [l for l, files in self.files.items() if not files and not self.locks[l]]:
+      if logname == newest and logname not in emptied:
+        continue
+
+      path = os.path.join(self.root, logname)
+      try:
+        os.rmdir(path)
+        self.remove_segment(logname)
+      except OSError:
+        cloudlog.exception("issue deleting %s" % path)
+
+
+def deleter_thread(exit_event):
+  planner = DeletionPlanner(ROOT)
+  while not exit_event.is_set():
+    needed = bytes_to_free()
 
-        try:
-          cloudlog.info("deleting %s" % delete_path)
-          shutil.rmtree(delete_path)
-          break
-        except OSError:
-          cloudlog.exception("issue deleting %s" % delete_path)
+    if needed > 0:
+      plan = planner.plan(needed)
+      if len(plan):
+        cloudlog.info("deleting %d files, %d bytes to free" % (len(plan), needed))
+      planner.delete(plan)
       exit_event.wait(.1)
     else:
       exit_event.wait(30)
@@ -53,7 +53,7 @@ class MockApiIgnore():
     return "fake-token"
 
 class MockParams():
-  def __init__(self):
+  def __init__(self, cache=False):
     self.params = {
       "DongleId": b"0000000000000000",
       "IsUploadRawEnabled": b"1",
@@ -75,6 +75,7 @@ class UploaderTestCase(unittest.TestCase):
     uploader.Api = MockApi
     uploader.Params = MockParams
     uploader.fake_upload = 1
+    uploader.UPLOAD_WORKERS = 1  # keeps the upload order deterministic
     uploader.is_on_hotspot = lambda *args: False
     uploader.is_on_wifi = lambda *args: True
     self.seg_num = random.randint(1, 300)
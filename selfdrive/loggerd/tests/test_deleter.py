@@ -3,8 +3,11 @@ import time
 import threading
 import unittest
 from collections import namedtuple
+from unittest import mock
 
 import selfdrive.loggerd.deleter as deleter
+from common.xattr import setxattr
+from selfdrive.loggerd.uploader import UPLOAD_ATTR_NAME, UPLOAD_ATTR_VALUE
 from common.timeout import Timeout, TimeoutException
 
 from selfdrive.loggerd.tests.loggerd_tests_common import UploaderTestCase
@@ -52,6 +55,11 @@ class TestDeleter(UploaderTestCase):
     self.seg_dir = self.seg_format.format(self.seg_num)
     f_path_2 = self.make_file_with_data(self.seg_dir, self.f_type)
 
+    # deleting one file is enough
+    block_size = 4096
+    available = (deleter.MIN_BYTES - os.stat(f_path_1).st_blocks * 512 // 2) // block_size
+    self.fake_stats = Stats(f_bavail=available, f_blocks=available * 2, f_frsize=block_size)
+
     self.start_thread()
 
     with Timeout(5, "Timeout waiting for file to be deleted"):
@@ -101,5 +109,128 @@ class TestDeleter(UploaderTestCase):
     self.assertTrue(os.path.exists(f_path), "File deleted when locked")
 
 
+class TestDeletionPlanner(UploaderTestCase):
+  def make_segment(self, i, files, uploaded=(), lock=False):
+    seg_dir = self.seg_format.format(i)
+    paths = {}
+    for f in files:
+      paths[f] = self.make_file_with_data(seg_dir, f, lock=lock)
+      if f in uploaded:
+        setxattr(paths[f], UPLOAD_ATTR_NAME, UPLOAD_ATTR_VALUE)
+    return paths
+
+  def planned(self, planner, needed):
+    return [(logname, name) for logname, name, _ in planner.plan(needed)]
+
+  def test_plan_order(self):
+    self.make_segment(0, ["qlog.bz2", "rlog.bz2", "fcamera.hevc"])
+    self.make_segment(1, ["qlog.bz2", "rlog.bz2", "fcamera.hevc"], uploaded=["qlog.bz2", "rlog.bz2"])
+    planner = deleter.DeletionPlanner(self.root)
+
+    seg0, seg1 = self.seg_format.format(0), self.seg_format.format(1)
+    self.assertEqual(self.planned(planner, float('inf')), [
+      (seg1, "rlog.bz2"), (seg1, "qlog.bz2"),  # uploaded first
+      (seg0, "fcamera.hevc"), (seg1, "fcamera.hevc"),
+      (seg0, "rlog.bz2"), (seg0, "qlog.bz2"),
+    ])
+
+  def test_plan_exact_bytes(self):
+    paths = self.make_segment(0, ["qlog.bz2", "rlog.bz2", "fcamera.hevc"])
+    planner = deleter.DeletionPlanner(self.root)
+    size = os.stat(paths["fcamera.hevc"]).st_blocks * 512
+
+    self.assertEqual(self.planned(planner, 0), [])
+    self.assertEqual(len(planner.plan(size)), 1)
+    self.assertEqual(len(planner.plan(size + 1)), 2)
+    self.assertEqual(sum(s for _, _, s in planner.plan(size + 1)), 2 * size)
+
+  def test_plan_skips_locked(self):
+    self.make_segment(0, ["fcamera.hevc"], lock=True)
+    planner = deleter.DeletionPlanner(self.root)
+    self.assertEqual(self.planned(planner, float('inf')), [])
+
+    os.remove(os.path.join(self.root, self.seg_format.format(0), "fcamera.hevc.lock"))
+    self.assertEqual(self.planned(planner, float('inf')), [(self.seg_format.format(0), "fcamera.hevc")])
+
+  def test_index_updates(self):
+    # the tree is only scanned once, later changes come from inotify
+    planner = deleter.DeletionPlanner(self.root)
+    paths = self.make_segment(0, ["qlog.bz2", "fcamera.hevc"])
+    seg0 = self.seg_format.format(0)
+    self.assertEqual(self.planned(planner, float('inf')), [(seg0, "fcamera.hevc"), (seg0, "qlog.bz2")])
+
+    # uploaded by the uploader
+    setxattr(paths["qlog.bz2"], UPLOAD_ATTR_NAME, UPLOAD_ATTR_VALUE)
+    self.assertEqual(self.planned(planner, float('inf')), [(seg0, "qlog.bz2"), (seg0, "fcamera.hevc")])
+
+    os.remove(paths["qlog.bz2"])
+    self.assertEqual(self.planned(planner, float('inf')), [(seg0, "fcamera.hevc")])
+
+  def test_delete(self):
+    paths = self.make_segment(0, ["qlog.bz2", "fcamera.hevc"])
+    planner = deleter.DeletionPlanner(self.root)
+
+    planner.delete(planner.plan(1))
+    self.assertFalse(os.path.exists(paths["fcamera.hevc"]))
+    self.assertTrue(os.path.exists(paths["qlog.bz2"]))
+
+    # the segment goes with its last file
+    planner.delete(planner.plan(1))
+    self.assertEqual(os.listdir(self.root), [])
+    self.assertEqual(planner.plan(1), [])
+
+  def test_delete_empty_segments(self):
+    self.make_segment(0, ["fcamera.hevc"])
+    self.make_segment(1, ["fcamera.hevc"])
+    os.makedirs(os.path.join(self.root, self.seg_format.format(2)))
+    os.makedirs(os.path.join(self.root, self.seg_format.format(3)))
+    planner = deleter.DeletionPlanner(self.root)
+
+    # empty segments go even when no file of theirs is planned, except the newest one
+    planner.delete([])
+    self.assertEqual(sorted(os.listdir(self.root)), [self.seg_format.format(i) for i in (0, 1, 3)])
+
+    # a locked segment stays
+    os.makedirs(os.path.join(self.root, self.seg_format.format(4)))
+    open(os.path.join(self.root, self.seg_format.format(4), "fcamera.hevc.lock"), "w").close()
+    planner.delete(planner.plan(float('inf')))
+    self.assertEqual(os.listdir(self.root), [self.seg_format.format(4)])
+
+  def test_unwatched_segment(self):
+    seg0 = self.seg_format.format(0)
+    self.make_segment(0, ["qlog.bz2"])
+    add_watch = deleter.Inotify.add_watch
+
+    def no_segment_watches(inotify, path, mask):
+      if path != self.root:
+        raise OSError(28, "No space left on device")
+      return add_watch(inotify, path, mask)
+
+    with mock.patch.object(deleter.Inotify, "add_watch", no_segment_watches):
+      planner = deleter.DeletionPlanner(self.root)
+      self.assertEqual(self.planned(planner, float('inf')), [(seg0, "qlog.bz2")])
+
+      # files written to an unwatched segment are found by the rescan
+      self.make_segment(0, ["fcamera.hevc"])
+      self.assertEqual(self.planned(planner, float('inf')), [(seg0, "qlog.bz2")])
+      with mock.patch.object(deleter, "UNWATCHED_RESCAN_INTERVAL", 0):
+        self.assertEqual(self.planned(planner, float('inf')), [(seg0, "fcamera.hevc"), (seg0, "qlog.bz2")])
+
+
+class TestBytesToFree(unittest.TestCase):
+  def test_bytes_to_free(self):
+    GB = 1024 * 1024 * 1024
+    for total, available, needed in [(100 * GB, 50 * GB, 0),
+                                     (100 * GB, 4 * GB, 6 * GB),  # 10% is more than MIN_BYTES
+                                     (20 * GB, 1 * GB, 4 * GB),  # MIN_BYTES is more than 10%
+                                     (100 * GB, 0, deleter.MIN_BYTES)]:
+      stats = Stats(f_bavail=available // 4096, f_blocks=total // 4096, f_frsize=4096)
+      with mock.patch("os.statvfs", return_value=stats):
+        self.assertAlmostEqual(deleter.bytes_to_free(), needed, delta=4096)
+
+    with mock.patch("os.statvfs", side_effect=OSError):
+      self.assertEqual(deleter.bytes_to_free(), 0)
+
+
 if __name__ == "__main__":
   unittest.main()
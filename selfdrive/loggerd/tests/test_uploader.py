@@ -1,15 +1,19 @@
+import os
+import shutil
 import time
 import threading
 import unittest
 import logging
 import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
 
 from selfdrive.swaglog import cloudlog
 import selfdrive.loggerd.uploader as uploader
 
 from common.xattr import getxattr
 
-from selfdrive.loggerd.tests.loggerd_tests_common import UploaderTestCase
+from selfdrive.loggerd.tests.loggerd_tests_common import MockResponse, UploaderTestCase
 
 class TestLogHandler(logging.Handler):
   def __init__(self):
@@ -134,5 +138,286 @@ class TestUploader(UploaderTestCase):
       self.assertFalse(getxattr(f_path, uploader.UPLOAD_ATTR_NAME), "File upload when locked")
 
 
+class TestUploadQueue(UploaderTestCase):
+  def make_queue(self):
+    up = uploader.Uploader("0000000000000000", self.root)
+    return up.queue
+
+  def test_order(self):
+    for i in [2, 0, 1]:
+      for f in ["bootlog.bz2", "fcamera.hevc", "qlog.bz2", "rlog.bz2"]:
+        self.make_file_with_data(self.seg_format.format(i), f)
+    q = self.make_queue()
+
+    order = []
+    while True:
+      d = q.next(with_raw=True)
+      if d is None:
+        break
+      order.append(d)
+      uploader.setxattr(os.path.join(self.root, *d), uploader.UPLOAD_ATTR_NAME, uploader.UPLOAD_ATTR_VALUE)
+
+    segs = [self.seg_format.format(i) for i in range(3)]
+    expected = [(s, "qlog.bz2") for s in segs]
+    expected += [(s, f) for s in segs for f in ["rlog.bz2", "fcamera.hevc"]]
+    expected += [(s, "bootlog.bz2") for s in segs]
+    self.assertEqual(order, expected)
+
+  def test_no_raw(self):
+    self.make_file_with_data(self.seg_dir, "rlog.bz2")
+    q = self.make_queue()
+    self.assertIsNone(q.next(with_raw=False))
+    self.assertEqual(q.next(with_raw=True), (self.seg_dir, "rlog.bz2"))
+
+  def test_new_segments(self):
+    # root is only scanned once, files written later are picked up through inotify
+    self.make_file_with_data(self.seg_format.format(0), "qlog.bz2")
+    q = self.make_queue()
+    self.assertEqual(q.next(with_raw=False), (self.seg_format.format(0), "qlog.bz2"))
+
+    # locked until loggerd is done with the segment
+    fn = self.make_file_with_data(self.seg_format.format(1), "qlog.bz2", lock=True)
+    uploader.setxattr(os.path.join(self.root, self.seg_format.format(0), "qlog.bz2"), uploader.UPLOAD_ATTR_NAME, uploader.UPLOAD_ATTR_VALUE)
+    self.assertIsNone(q.next(with_raw=False))
+
+    os.remove(fn + ".lock")
+    self.assertEqual(q.next(with_raw=False), (self.seg_format.format(1), "qlog.bz2"))
+
+    # deleted segments are dropped
+    self.make_file_with_data(self.seg_format.format(2), "qlog.bz2")
+    shutil.rmtree(os.path.join(self.root, self.seg_format.format(1)))
+    self.assertEqual(q.next(with_raw=False), (self.seg_format.format(2), "qlog.bz2"))
+
+    os.remove(os.path.join(self.root, self.seg_format.format(2), "qlog.bz2"))
+    self.assertIsNone(q.next(with_raw=False))
+
+  def test_no_full_scan(self):
+    self.make_file_with_data(self.seg_dir, "qlog.bz2")
+    q = self.make_queue()
+    with mock.patch("os.listdir", side_effect=AssertionError("listdir")):
+      self.assertEqual(q.next(with_raw=False), (self.seg_dir, "qlog.bz2"))
+
+  def test_unwatched_segment(self):
+    self.make_file_with_data(self.seg_format.format(0), "qlog.bz2")
+    add_watch = uploader.Inotify.add_watch
+
+    def no_segment_watches(inotify, path, mask):
+      if path != self.root:
+        raise OSError(28, "No space left on device")
+      return add_watch(inotify, path, mask)
+
+    with mock.patch.object(uploader.Inotify, "add_watch", no_segment_watches):
+      q = self.make_queue()
+      self.assertEqual(q.next(with_raw=False), (self.seg_format.format(0), "qlog.bz2"))
+
+      # files written to an unwatched segment are found by the rescan
+      self.make_file_with_data(self.seg_format.format(0), "rlog.bz2")
+      self.assertIsNone(q.next(with_raw=True))
+      with mock.patch.object(uploader, "UNWATCHED_RESCAN_INTERVAL", 0):
+        self.assertEqual(q.next(with_raw=True), (self.seg_format.format(0), "rlog.bz2"))
+
+  def test_rebuild_keeps_in_flight(self):
+    for f in ["qlog.bz2", "rlog.bz2"]:
+      self.make_file_with_data(self.seg_dir, f)
+    q = self.make_queue()
+    self.assertEqual(q.next(with_raw=True), (self.seg_dir, "qlog.bz2"))
+
+    # e.g. after IN_Q_OVERFLOW
+    q.rebuild()
+    self.assertEqual(q.next(with_raw=True), (self.seg_dir, "rlog.bz2"))
+    self.assertIsNone(q.next(with_raw=True))
+
+    # not uploaded, so it's back in the queue
+    q.done(self.seg_dir, "qlog.bz2", False)
+    self.assertEqual(q.next(with_raw=True), (self.seg_dir, "qlog.bz2"))
+
+
+class UploadHandler(BaseHTTPRequestHandler):
+  """Stands in for the upload endpoint, PUTs with a Content-Range append to the file.
+     Without ranges on the server it's a plain presigned PUT url, every PUT replaces the file."""
+  def do_PUT(self):
+    dat = self.rfile.read(int(self.headers['Content-Length']))
+    self.server.bytes_received += len(dat)
+    self.server.ranges_received.append(self.headers['Content-Range'])
+    start, total = 0, len(dat)
+    if not self.server.ranges:
+      self.server.files[self.path] = bytearray(dat)
+      self.send_response(201)
+      self.send_header('Content-Length', '0')
+      self.end_headers()
+      return
+    elif self.headers['Content-Range'] is not None:
+      r, total = self.headers['Content-Range'].split(' ')[1].split('/')
+      start, total = int(r.split('-')[0]), int(total)
+
+    f = self.server.files.setdefault(self.path, bytearray())
+    if start in self.server.fail_at:
+      self.server.fail_at.remove(start)
+      status = 500
+    elif start != len(f):
+      status = 416
+    else:
+      f += dat
+      status = 201 if len(f) == total else 308
+    self.send_response(status)
+    self.send_header('Content-Length', '0')
+    self.end_headers()
+
+  def log_message(self, *args):
+    pass
+
+class LocalApi():
+  def __init__(self, url, resumable=True):
+    self.url = url
+    self.resumable = resumable
+
+  def get(self, *args, path=None, **kwargs):
+    return MockResponse(json.dumps({"url": f"{self.url}/{path}", "headers": {}, "resumable": self.resumable}), 200)
+
+  def get_token(self):
+    return "fake-token"
+
+class TestChunkedUpload(UploaderTestCase):
+  def setUp(self):
+    super().setUp()
+    uploader.fake_upload = 0
+    self.chunk_size = uploader.UPLOAD_CHUNK_SIZE
+    uploader.UPLOAD_CHUNK_SIZE = 64 * 1024
+
+    self.server = ThreadingHTTPServer(("127.0.0.1", 0), UploadHandler)
+    self.server.files = {}
+    self.server.fail_at = set()
+    self.server.bytes_received = 0
+    self.server.ranges = True
+    self.server.ranges_received = []
+    threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    self.up = uploader.Uploader("0000000000000000", self.root)
+    self.up.api = LocalApi(f"http://127.0.0.1:{self.server.server_port}")
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+    uploader.UPLOAD_CHUNK_SIZE = self.chunk_size
+    super().tearDown()
+
+  def read(self, fn):
+    with open(fn, "rb") as f:
+      return f.read()
+
+  def test_small_file(self):
+    fn = self.make_file_with_data(self.seg_dir, "qlog.bz2", size_mb=.01)
+    key, _ = self.up.next_file_to_upload(with_raw=False)
+    self.assertTrue(self.up.upload(key, fn))
+    self.assertEqual(self.server.files[f"/{key}"], self.read(fn))
+    self.assertTrue(getxattr(fn, uploader.UPLOAD_ATTR_NAME))
+
+  def test_resume(self):
+    fn = self.make_file_with_data(self.seg_dir, "rlog.bz2", size_mb=.5)
+    sz = os.path.getsize(fn)
+    self.server.fail_at.add(3 * uploader.UPLOAD_CHUNK_SIZE)
+
+    key, _ = self.up.next_file_to_upload(with_raw=True)
+    self.assertFalse(self.up.upload(key, fn))
+    self.assertEqual(uploader.get_upload_offset(fn, sz), 3 * uploader.UPLOAD_CHUNK_SIZE)
+
+    # a new uploader continues where the last one stopped
+    up = uploader.Uploader("0000000000000000", self.root)
+    up.api = self.up.api
+    self.assertEqual(up.next_file_to_upload(with_raw=True), (key, fn))
+    self.assertTrue(up.upload(key, fn))
+    self.assertEqual(self.server.files[f"/{key}"], self.read(fn))
+    # only the failed chunk was sent twice
+    self.assertEqual(self.server.bytes_received, sz + uploader.UPLOAD_CHUNK_SIZE)
+
+  def test_resume_rejected(self):
+    fn = self.make_file_with_data(self.seg_dir, "rlog.bz2", size_mb=.5)
+    sz = os.path.getsize(fn)
+    uploader.setxattr(fn, uploader.UPLOAD_OFFSET_ATTR_NAME, str(sz // 2).encode())
+
+    key, _ = self.up.next_file_to_upload(with_raw=True)
+    self.assertTrue(self.up.upload(key, fn))
+    self.assertEqual(self.server.files[f"/{key}"], self.read(fn))
+
+  def test_qlog_preempts_raw(self):
+    raw_fn = self.make_file_with_data(self.seg_format.format(0), "fcamera.hevc", size_mb=.5)
+    key, _ = self.up.next_file_to_upload(with_raw=True)
+
+    qlog_fn = self.make_file_with_data(self.seg_format.format(1), "qlog.bz2", size_mb=.01)
+    self.assertIsNone(self.up.upload(key, raw_fn))
+    self.assertEqual(uploader.get_upload_offset(raw_fn, os.path.getsize(raw_fn)), uploader.UPLOAD_CHUNK_SIZE)
+
+    self.assertEqual(self.up.next_file_to_upload(with_raw=True)[1], qlog_fn)
+    self.assertTrue(self.up.upload(os.path.join(self.seg_format.format(1), "qlog.bz2"), qlog_fn))
+    self.assertEqual(self.up.next_file_to_upload(with_raw=True), (key, raw_fn))
+    self.assertTrue(self.up.upload(key, raw_fn))
+    self.assertEqual(self.server.files[f"/{key}"], self.read(raw_fn))
+
+  def test_workers(self):
+    uploader.UPLOAD_WORKERS = 2
+    uploader.Api = lambda dongle_id: self.up.api
+    f_paths = [self.make_file_with_data(self.seg_format.format(i), f, size_mb=.2)
+               for i in range(3) for f in ["qlog.bz2", "rlog.bz2"]]
+
+    end_event = threading.Event()
+    t = threading.Thread(target=uploader.uploader_fn, args=[end_event], daemon=True)
+    t.start()
+    start = time.monotonic()
+    while not all(getxattr(fn, uploader.UPLOAD_ATTR_NAME) for fn in f_paths):
+      self.assertLess(time.monotonic() - start, 10)
+      time.sleep(0.01)
+    end_event.set()
+    t.join()
+
+    for fn in f_paths:
+      key = os.path.relpath(fn, self.root)
+      self.assertEqual(self.server.files[f"/{key}"], self.read(fn))
+
+  def test_not_resumable(self):
+    self.up.api = LocalApi(self.up.api.url, resumable=False)
+    fn = self.make_file_with_data(self.seg_dir, "rlog.bz2", size_mb=.5)
+    key, _ = self.up.next_file_to_upload(with_raw=True)
+    self.assertTrue(self.up.upload(key, fn))
+    self.assertEqual(self.server.files[f"/{key}"], self.read(fn))
+    self.assertEqual(self.server.ranges_received, [None])
+
+  def test_ranges_ignored(self):
+    # claims to be resumable, but every chunk replaces the file
+    self.server.ranges = False
+    fn = self.make_file_with_data(self.seg_dir, "rlog.bz2", size_mb=.5)
+    key, _ = self.up.next_file_to_upload(with_raw=True)
+    self.assertTrue(self.up.upload(key, fn))
+    self.assertEqual(self.server.files[f"/{key}"], self.read(fn))
+    self.assertEqual(self.server.ranges_received[-1], None)
+    self.assertTrue(getxattr(fn, uploader.UPLOAD_ATTR_NAME))
+
+
+class FakeClock():
+  def __init__(self):
+    self.t = 0.
+    self.sleeps = []
+
+  def monotonic(self):
+    return self.t
+
+  def sleep(self, dt):
+    self.sleeps.append(dt)
+    self.t += dt
+
+
+class TestRateLimiter(unittest.TestCase):
+  def test_rate_limit(self):
+    clock = FakeClock()
+    with mock.patch.object(uploader, "time", clock):
+      limiter = uploader.RateLimiter(1e6, burst=1e5)
+      for _ in range(30):
+        limiter.consume(1e4)
+
+    # the burst goes through at once, after that 10 kB take 10 ms each
+    self.assertEqual(len(clock.sleeps), 20)
+    for dt in clock.sleeps:
+      self.assertAlmostEqual(dt, 0.01)
+
+
 if __name__ == "__main__":
   unittest.main()
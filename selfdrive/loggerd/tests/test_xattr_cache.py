@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import tempfile
+import unittest
+
+from selfdrive.loggerd.xattr_cache import XattrCache
+
+ATTR = "user.upload"
+
+
+class TestXattrCache(unittest.TestCase):
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.root)
+
+  def make_file(self, *path):
+    fn = os.path.join(self.root, *path)
+    os.makedirs(os.path.dirname(fn), exist_ok=True)
+    open(fn, "wb").close()
+    return fn
+
+  def test_hits(self):
+    cache = XattrCache()
+    fn = self.make_file("seg", "qlog.bz2")
+    self.assertIsNone(cache.get(fn, ATTR))
+    self.assertIsNone(cache.get(fn, ATTR))
+    cache.set(fn, ATTR, b"1")
+    self.assertEqual(cache.get(fn, ATTR), b"1")
+    self.assertEqual(cache.stats(), {"entries": 1, "hits": 1, "misses": 2})
+
+  def test_bounded(self):
+    cache = XattrCache(max_entries=4)
+    fns = [self.make_file("seg", str(i)) for i in range(6)]
+    for fn in fns:
+      cache.get(fn, ATTR)
+      cache.get(fns[0], ATTR)  # recently used, stays
+    self.assertEqual(len(cache.values), 4)
+    self.assertIn((fns[0], ATTR), cache.values)
+    self.assertNotIn((fns[1], ATTR), cache.values)
+    self.assertEqual(sum(len(k) for k in cache.dirs.values()), 4)
+
+  def test_invalidate(self):
+    cache = XattrCache()
+    seg1 = [self.make_file("seg1", f) for f in ["qlog.bz2", "rlog.bz2"]]
+    seg2 = [self.make_file("seg2", f) for f in ["qlog.bz2", "rlog.bz2"]]
+    for fn in seg1 + seg2:
+      cache.get(fn, ATTR)
+
+    # deleted and recreated, the old value isn't used
+    shutil.rmtree(os.path.join(self.root, "seg1"))
+    cache.invalidate(os.path.join(self.root, "seg1"))
+    self.assertEqual(len(cache.values), 2)
+    with self.assertRaises(OSError):
+      cache.get(seg1[0], ATTR)
+
+    self.make_file("seg1", "qlog.bz2")
+    cache.invalidate(self.root + "/")
+    self.assertEqual(len(cache.values), 0)
+    self.assertEqual(cache.dirs, {})
+
+
+if __name__ == "__main__":
+  unittest.main()
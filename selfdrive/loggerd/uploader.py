@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 import ctypes
+import heapq
 import inspect
 import json
 import os
@@ -12,7 +13,10 @@ import traceback
 from cereal import log
 from common.hardware import HARDWARE
 from common.api import Api
+from common.inotify import Inotify, IN_CLOSE_WRITE, IN_CREATE, IN_DELETE, IN_IGNORED, IN_ISDIR, \
+                           IN_MOVED_FROM, IN_MOVED_TO, IN_Q_OVERFLOW
 from common.params import Params
+from selfdrive.loggerd import xattr_cache
 from selfdrive.loggerd.xattr_cache import getxattr, setxattr
 from selfdrive.loggerd.config import ROOT
 from selfdrive.swaglog import cloudlog
@@ -20,6 +24,15 @@ from selfdrive.swaglog import cloudlog
 NetworkType = log.ThermalData.NetworkType
 UPLOAD_ATTR_NAME = 'user.upload'
 UPLOAD_ATTR_VALUE = b'1'
+# bytes of a partially uploaded file the server has
+UPLOAD_OFFSET_ATTR_NAME = 'user.upload_offset'
+
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+UPLOAD_WORKERS = 2
+# bytes per second over all workers, unlimited if 0
+UPLOAD_RATE_LIMIT = int(os.getenv("UPLOAD_RATE_LIMIT", "0"))
+# segments inotify can't watch, e.g. past max_user_watches, are listed again this often
+UNWATCHED_RESCAN_INTERVAL = 10.
 
 fake_upload = os.getenv("FAKEUPLOAD") is not None
 
@@ -71,112 +84,361 @@ def clear_locks(root):
 def is_on_wifi():
   return HARDWARE.get_network_type() == NetworkType.wifi
 
-class Uploader():
-  def __init__(self, dongle_id, root):
-    self.dongle_id = dongle_id
-    self.api = Api(dongle_id)
-    self.root = root
 
-    self.upload_thread = None
+class UploadQueue():
+  """Files in root that are waiting for upload, in upload order.
 
-    self.last_resp = None
-    self.last_exc = None
+     root is scanned once, after that inotify events from root and the segment
+     directories keep the queue up to date. Picking the next file is a heap lookup
+     and one getxattr, instead of listing every segment and getxattr on every file.
 
-    self.immediate_priority = {"qlog.bz2": 0, "qcamera.ts": 1}
-    self.high_priority = {"rlog.bz2": 0, "fcamera.hevc": 1, "dcamera.hevc": 2, "ecamera.hevc": 3}
+     Files handed out by next are in flight until done is called, so upload workers
+     never get the same file, also not after a rebuild. Segments that can't be
+     watched are listed every UNWATCHED_RESCAN_INTERVAL instead.
+  """
+  SEGMENT_MASK = IN_CREATE | IN_CLOSE_WRITE | IN_MOVED_TO | IN_DELETE | IN_MOVED_FROM
 
-  def get_upload_sort(self, name):
-    if name in self.immediate_priority:
-      return self.immediate_priority[name]
-    if name in self.high_priority:
-      return self.high_priority[name] + 100
-    return 1000
+  def __init__(self, root, immediate_priority, high_priority):
+    self.root = root
+    self.immediate_priority = immediate_priority
+    self.high_priority = high_priority
+    self.inotify = None
+    self.lock = threading.Lock()
+    self.in_flight = set()  # (logname, name) handed out by next
+    self.rebuild()
+
+  def rebuild(self):
+    if self.inotify is not None:
+      self.inotify.close()
+      self.inotify = None
+
+    self.immediate = []  # qlogs, any time
+    self.raw = []  # everything else, only with raw uploads allowed
+    self.queued = set()  # (logname, name) in the heaps, held or in flight
+    self.locks = {}  # logname -> lock files, segments are uploaded once they have none
+    self.held = {}  # logname -> names waiting for the segment to be unlocked
+    self.wds = {}  # watch descriptor -> logname
+    self.unwatched = set()  # lognames without a watch, rescanned instead
+    self.last_rescan = time.monotonic()
 
-  def gen_upload_files(self):
     if not os.path.isdir(self.root):
       return
+
+    try:
+      self.inotify = Inotify()
+      self.root_wd = self.inotify.add_watch(self.root, IN_CREATE | IN_MOVED_TO | IN_DELETE | IN_MOVED_FROM)
+    except OSError:
+      cloudlog.exception("uploader inotify failed, rescanning every time")
+      self.inotify = None
+
     for logname in listdir_by_creation(self.root):
-      path = os.path.join(self.root, logname)
+      self.add_segment(logname)
+
+  def update(self):
+    if self.inotify is None:
+      self.rebuild()
+      return
+
+    if self.unwatched and time.monotonic() - self.last_rescan > UNWATCHED_RESCAN_INTERVAL:
+      self.last_rescan = time.monotonic()
+      for logname in list(self.unwatched):
+        self.add_segment(logname)
+
+    for wd, mask, name in self.inotify.read_events():
+      if mask & IN_Q_OVERFLOW:
+        self.rebuild()
+        return
+      elif wd == self.root_wd:
+        if mask & (IN_CREATE | IN_MOVED_TO) and mask & IN_ISDIR:
+          self.add_segment(name)
+        elif mask & (IN_DELETE | IN_MOVED_FROM):
+          self.remove_segment(name)
+      elif wd in self.wds:
+        logname = self.wds[wd]
+        if mask & IN_IGNORED:
+          del self.wds[wd]
+        elif logname not in self.locks:
+          continue
+        elif name.endswith(".lock"):
+          if mask & (IN_CREATE | IN_MOVED_TO):
+            self.locks[logname].add(name)
+          elif mask & (IN_DELETE | IN_MOVED_FROM):
+            self.locks[logname].discard(name)
+            self.release(logname)
+        elif mask & (IN_DELETE | IN_MOVED_FROM):
+          xattr_cache.invalidate(os.path.join(self.root, logname, name))
+          self.queued.discard((logname, name))
+        else:
+          self.add_file(logname, name)
+
+  def add_segment(self, logname):
+    path = os.path.join(self.root, logname)
+    if not os.path.isdir(path):
+      self.remove_segment(logname)
+      return
+
+    if self.inotify is not None:
       try:
-        names = os.listdir(path)
+        self.wds[self.inotify.add_watch(path, self.SEGMENT_MASK)] = logname
+        self.unwatched.discard(logname)
       except OSError:
-        continue
-      if any(name.endswith(".lock") for name in names):
-        continue
+        if logname not in self.unwatched:
+          cloudlog.exception("uploader can't watch %s, rescanning it" % path)
+        self.unwatched.add(logname)
 
-      for name in sorted(names, key=self.get_upload_sort):
-        key = os.path.join(logname, name)
-        fn = os.path.join(path, name)
-        # skip files already uploaded
-        try:
-          is_uploaded = getxattr(fn, UPLOAD_ATTR_NAME)
-        except OSError:
-          cloudlog.event("uploader_getxattr_failed", exc=self.last_exc, key=key, fn=fn)
-          is_uploaded = True  # deleter could have deleted
-        if is_uploaded:
-          continue
-        yield (name, key, fn)
+    try:
+      names = os.listdir(path)
+    except OSError:
+      return
 
-  def next_file_to_upload(self, with_raw):
-    upload_files = list(self.gen_upload_files())
+    if logname in self.locks:
+      # rescan, drop the files deleted since the last one
+      self.queued -= {(l, n) for l, n in self.queued if l == logname and n not in names}
 
-    # try to upload qlog files first
-    for name, key, fn in upload_files:
-      if name in self.immediate_priority:
-        return (key, fn)
+    self.locks[logname] = {name for name in names if name.endswith(".lock")}
+    for name in names:
+      self.add_file(logname, name)
+    self.release(logname)
 
-    if with_raw:
-      # then upload the full log files, rear and front camera files
-      for name, key, fn in upload_files:
-        if name in self.high_priority:
-          return (key, fn)
+  def remove_segment(self, logname):
+    xattr_cache.invalidate(os.path.join(self.root, logname))
+    self.unwatched.discard(logname)
+    self.locks.pop(logname, None)
+    self.held.pop(logname, None)
+    self.queued = {(l, n) for l, n in self.queued if l != logname}
+
+  def add_file(self, logname, name):
+    if name.endswith(".lock") or name.endswith(".tmp") or (logname, name) in self.queued:
+      return
 
-      # then upload other files
-      for name, key, fn in upload_files:
-        if not name.endswith('.lock') and not name.endswith(".tmp"):
-          return (key, fn)
+    self.queued.add((logname, name))
+    if self.locks[logname]:
+      self.held.setdefault(logname, set()).add(name)
+    else:
+      self.push(logname, name)
+
+  def release(self, logname):
+    if not self.locks[logname]:
+      for name in self.held.pop(logname, ()):
+        self.push(logname, name)
+
+  def push(self, logname, name):
+    if (logname, name) in self.in_flight:
+      # done puts it back if it isn't uploaded
+      return
+    seg = tuple(get_directory_sort(logname))
+    if name in self.immediate_priority:
+      heapq.heappush(self.immediate, (seg, logname, self.immediate_priority[name], name))
+    elif name in self.high_priority:
+      heapq.heappush(self.raw, (0, seg, logname, self.high_priority[name], name))
+    else:
+      heapq.heappush(self.raw, (1, seg, logname, 0, name))
+
+  def top(self, heap):
+    """(logname, name) of the first file in heap still waiting for upload, None if there is none."""
+    while len(heap):
+      logname, name = heap[0][-3], heap[0][-1]
+      if (logname, name) not in self.queued or logname not in self.locks:
+        # deleted
+        heapq.heappop(heap)
+        continue
+      elif self.locks[logname]:
+        heapq.heappop(heap)
+        self.held.setdefault(logname, set()).add(name)
+        continue
+
+      fn = os.path.join(self.root, logname, name)
+      try:
+        is_uploaded = getxattr(fn, UPLOAD_ATTR_NAME)
+      except OSError:
+        cloudlog.event("uploader_getxattr_failed", key=os.path.join(logname, name), fn=fn)
+        is_uploaded = True  # deleter could have deleted
 
+      if is_uploaded:
+        heapq.heappop(heap)
+        self.queued.discard((logname, name))
+        continue
+      return logname, name
     return None
 
-  def do_upload(self, key, fn):
-    try:
-      url_resp = self.api.get("v1.3/"+self.dongle_id+"/upload_url/", timeout=10, path=key, access_token=self.api.get_token())
-      if url_resp.status_code == 412:
-        self.last_resp = url_resp
-        return
+  def next(self, with_raw):
+    """(logname, name) of the next file to upload, None if there is nothing to upload."""
+    with self.lock:
+      self.update()
+
+      heaps = [self.immediate, self.raw] if with_raw else [self.immediate]
+      for heap in heaps:
+        d = self.top(heap)
+        if d is not None:
+          heapq.heappop(heap)
+          self.in_flight.add(d)
+          return d
+      return None
+
+  def done(self, logname, name, uploaded):
+    """Called for every file handed out by next, puts it back in the queue if it wasn't uploaded."""
+    with self.lock:
+      self.in_flight.discard((logname, name))
+      if uploaded:
+        self.queued.discard((logname, name))
+      elif (logname, name) in self.queued:
+        self.push(logname, name)
+
+  def immediate_waiting(self):
+    with self.lock:
+      self.update()
+      return self.top(self.immediate) is not None
+
+
+class RateLimiter():
+  """Token bucket shared by the upload workers, rate in bytes per second."""
+  def __init__(self, rate, burst=None):
+    self.rate = rate
+    self.burst = burst if burst is not None else rate
+    self.tokens = self.burst
+    self.last = time.monotonic()
+    self.lock = threading.Lock()
+
+  def consume(self, n):
+    with self.lock:
+      now = time.monotonic()
+      self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+      self.last = now
+      self.tokens -= n
+      wait = -self.tokens / self.rate
+    if wait > 0:
+      time.sleep(wait)
+
+class ChunkReader():
+  """length bytes of f from its current position, as a request body. Reads are
+     shaped by the rate limiter, if there is one."""
+  def __init__(self, f, length, rate_limiter=None):
+    self.f = f
+    self.length = length
+    self.remaining = length
+    self.rate_limiter = rate_limiter
+
+  def __len__(self):
+    return self.length
+
+  def read(self, size=-1):
+    if size < 0 or size > self.remaining:
+      size = self.remaining
+    dat = self.f.read(size)
+    self.remaining -= len(dat)
+    if self.rate_limiter is not None:
+      self.rate_limiter.consume(len(dat))
+    return dat
+
+def get_upload_offset(fn, sz):
+  try:
+    offset = int(getxattr(fn, UPLOAD_OFFSET_ATTR_NAME) or 0)
+  except (OSError, ValueError):
+    return 0
+  return offset if 0 <= offset < sz else 0
 
-      url_resp_json = json.loads(url_resp.text)
-      url = url_resp_json['url']
-      headers = url_resp_json['headers']
-      cloudlog.info("upload_url v1.3 %s %s", url, str(headers))
+class Uploader():
+  def __init__(self, dongle_id, root, rate_limit=None):
+    self.dongle_id = dongle_id
+    self.api = Api(dongle_id)
+    self.root = root
 
-      if fake_upload:
-        cloudlog.info("*** WARNING, THIS IS A FAKE UPLOAD TO %s ***" % url)
+    self.rate_limiter = RateLimiter(rate_limit) if rate_limit else None
 
-        class FakeResponse():
-          def __init__(self):
-            self.status_code = 200
+    self.immediate_priority = {"qlog.bz2": 0, "qcamera.ts": 1}
+    self.high_priority = {"rlog.bz2": 0, "fcamera.hevc": 1, "dcamera.hevc": 2, "ecamera.hevc": 3}
 
-        self.last_resp = FakeResponse()
-      else:
-        with open(fn, "rb") as f:
-          self.last_resp = requests.put(url, data=f, headers=headers, timeout=10)
-    except Exception as e:
-      self.last_exc = (e, traceback.format_exc())
-      raise
+    self.queue = UploadQueue(root, self.immediate_priority, self.high_priority)
 
-  def normal_upload(self, key, fn):
-    self.last_resp = None
-    self.last_exc = None
+  def next_file_to_upload(self, with_raw):
+    # qlog files first, then the full log files, rear and front camera files, then other files
+    d = self.queue.next(with_raw)
+    if d is None:
+      return None
+
+    logname, name = d
+    return (os.path.join(logname, name), os.path.join(self.root, logname, name))
+
+  def put_file(self, url, headers, fn):
+    sz = os.path.getsize(fn)
+    with open(fn, "rb") as f:
+      return requests.put(url, data=ChunkReader(f, sz, self.rate_limiter), headers=headers, timeout=10)
+
+  def put_chunks(self, url, headers, fn, preempt=None):
+    """PUTs fn in chunks of UPLOAD_CHUNK_SIZE, starting from the offset saved by
+       an earlier attempt. Chunks carry a Content-Range, files that fit in one chunk
+       are a plain PUT. Only for urls that support that, the server answers 308 to
+       every chunk but the last. Returns the response to the last request, None if
+       preempt() returned True between two chunks."""
+    sz = os.path.getsize(fn)
+    offset = get_upload_offset(fn, sz)
+
+    with open(fn, "rb") as f:
+      while True:
+        length = min(UPLOAD_CHUNK_SIZE, sz - offset)
+        chunk_headers = dict(headers)
+        if length < sz:
+          chunk_headers['Content-Range'] = f"bytes {offset}-{offset + length - 1}/{sz}"
+
+        f.seek(offset)
+        resp = requests.put(url, data=ChunkReader(f, length, self.rate_limiter), headers=chunk_headers, timeout=10)
+        if resp.status_code == 416 and offset > 0:
+          # the server doesn't have the start of the file, start over
+          cloudlog.event("upload_resume_rejected", fn=fn, offset=offset)
+          offset = 0
+          continue
+        elif offset + length == sz or resp.status_code not in (200, 201, 308):
+          return resp
+        elif resp.status_code != 308:
+          # the server took the chunk for the whole file, send all of it instead
+          cloudlog.event("upload_range_ignored", fn=fn, offset=offset, status_code=resp.status_code)
+          setxattr(fn, UPLOAD_OFFSET_ATTR_NAME, b"0")
+          return self.put_file(url, headers, fn)
+
+        offset += length
+        setxattr(fn, UPLOAD_OFFSET_ATTR_NAME, str(offset).encode())
+        if preempt is not None and preempt():
+          return None
+
+  def do_upload(self, key, fn, preempt=None):
+    url_resp = self.api.get("v1.3/"+self.dongle_id+"/upload_url/", timeout=10, path=key, access_token=self.api.get_token())
+    if url_resp.status_code == 412:
+      return url_resp
+
+    url_resp_json = json.loads(url_resp.text)
+    url = url_resp_json['url']
+    headers = url_resp_json['headers']
+    cloudlog.info("upload_url v1.3 %s %s", url, str(headers))
+
+    if fake_upload:
+      cloudlog.info("*** WARNING, THIS IS A FAKE UPLOAD TO %s ***" % url)
+
+      class FakeResponse():
+        def __init__(self):
+          self.status_code = 200
+
+      return FakeResponse()
+    elif url_resp_json.get('resumable', False):
+      return self.put_chunks(url, headers, fn, preempt)
+    else:
+      return self.put_file(url, headers, fn)
 
+  def normal_upload(self, key, fn, preempt=None):
     try:
-      self.do_upload(key, fn)
-    except Exception:
-      pass
-
-    return self.last_resp
+      return self.do_upload(key, fn, preempt), None
+    except Exception as e:
+      return None, (e, traceback.format_exc())
 
   def upload(self, key, fn):
+    """True if fn was uploaded, False if it failed and None if it was preempted by a qlog"""
+    success = False
+    try:
+      success = self._upload(key, fn)
+    finally:
+      self.queue.done(*os.path.split(key), uploaded=success)
+    return success
+
+  def _upload(self, key, fn):
     try:
       sz = os.path.getsize(fn)
     except OSError:
@@ -192,37 +454,31 @@ class Uploader():
         # tag files of 0 size as uploaded
         setxattr(fn, UPLOAD_ATTR_NAME, UPLOAD_ATTR_VALUE)
       except OSError:
-        cloudlog.event("uploader_setxattr_failed", exc=self.last_exc, key=key, fn=fn, sz=sz)
+        cloudlog.event("uploader_setxattr_failed", key=key, fn=fn, sz=sz)
       success = True
     else:
       cloudlog.info("uploading %r", fn)
-      stat = self.normal_upload(key, fn)
-      if stat is not None and stat.status_code in (200, 201, 412):
+      # raw files make way for qlogs between chunks
+      preempt = None if os.path.basename(fn) in self.immediate_priority else self.queue.immediate_waiting
+      stat, exc = self.normal_upload(key, fn, preempt)
+      if stat is None and exc is None:
+        cloudlog.event("upload_preempted", key=key, fn=fn, sz=sz)
+        success = None
+      elif stat is not None and stat.status_code in (200, 201, 412):
         cloudlog.event("upload_success" if stat.status_code != 412 else "upload_ignored", key=key, fn=fn, sz=sz)
         try:
           # tag file as uploaded
           setxattr(fn, UPLOAD_ATTR_NAME, UPLOAD_ATTR_VALUE)
         except OSError:
-          cloudlog.event("uploader_setxattr_failed", exc=self.last_exc, key=key, fn=fn, sz=sz)
+          cloudlog.event("uploader_setxattr_failed", exc=exc, key=key, fn=fn, sz=sz)
         success = True
       else:
-        cloudlog.event("upload_failed", stat=stat, exc=self.last_exc, key=key, fn=fn, sz=sz)
+        cloudlog.event("upload_failed", stat=stat, exc=exc, key=key, fn=fn, sz=sz)
         success = False
 
     return success
 
-def uploader_fn(exit_event):
-  cloudlog.info("uploader_fn")
-
-  params = Params()
-  dongle_id = params.get("DongleId").decode('utf8')
-
-  if dongle_id is None:
-    cloudlog.info("uploader missing dongle_id")
-    raise Exception("uploader can't start without dongle id")
-
-  uploader = Uploader(dongle_id, ROOT)
-
+def upload_worker(uploader, params, exit_event):
   backoff = 0.1
   counter = 0
   on_wifi = False
@@ -235,7 +491,7 @@ def uploader_fn(exit_event):
 
     d = uploader.next_file_to_upload(with_raw=allow_raw_upload and on_wifi and offroad)
     if d is None:  # Nothing to upload
-      time.sleep(60 if offroad else 5)
+      exit_event.wait(60 if offroad else 5)
       continue
 
     key, fn = d
@@ -243,14 +499,33 @@ def uploader_fn(exit_event):
     cloudlog.event("uploader_netcheck", is_on_wifi=on_wifi)
     cloudlog.info("to upload %r", d)
     success = uploader.upload(key, fn)
-    if success:
+    if success or success is None:
       backoff = 0.1
     else:
       cloudlog.info("backoff %r", backoff)
-      time.sleep(backoff + random.uniform(0, backoff))
+      exit_event.wait(backoff + random.uniform(0, backoff))
       backoff = min(backoff*2, 120)
     cloudlog.info("upload done, success=%r", success)
 
+def uploader_fn(exit_event):
+  cloudlog.info("uploader_fn")
+
+  params = Params(cache=True)
+  dongle_id = params.get("DongleId").decode('utf8')
+
+  if dongle_id is None:
+    cloudlog.info("uploader missing dongle_id")
+    raise Exception("uploader can't start without dongle id")
+
+  uploader = Uploader(dongle_id, ROOT, rate_limit=UPLOAD_RATE_LIMIT)
+
+  workers = [threading.Thread(target=upload_worker, args=(uploader, params, exit_event), daemon=True)
+             for _ in range(UPLOAD_WORKERS)]
+  for t in workers:
+    t.start()
+  for t in workers:
+    t.join()
+
 def main():
   uploader_fn(threading.Event())
 
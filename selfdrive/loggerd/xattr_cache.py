@@ -1,13 +1,80 @@
+import os
+import threading
+from collections import OrderedDict
+
 from common.xattr import getxattr as getattr1
 from common.xattr import setxattr as setattr1
 
-cached_attributes = {}
-def getxattr(path, attr_name):
-  if (path, attr_name) not in cached_attributes:
+MAX_ENTRIES = 8192
+
+
+def _dirname(path):
+  return os.path.dirname(os.path.normpath(path))
+
+
+class XattrCache():
+  """LRU of (path, attr_name) -> value, with at most max_entries entries.
+     Entries of a directory are dropped with invalidate when it's deleted."""
+  def __init__(self, max_entries=MAX_ENTRIES):
+    self.max_entries = max_entries
+    self.values = OrderedDict()
+    self.dirs = {}  # dirname -> keys of the entries in it
+    self.hits = 0
+    self.misses = 0
+    self.lock = threading.Lock()
+
+  def get(self, path, attr_name):
+    key = (path, attr_name)
+    with self.lock:
+      if key in self.values:
+        self.values.move_to_end(key)
+        self.hits += 1
+        return self.values[key]
+      self.misses += 1
+
     response = getattr1(path, attr_name)
-    cached_attributes[(path, attr_name)] = response
-  return cached_attributes[(path, attr_name)]
+
+    with self.lock:
+      self.values[key] = response
+      self.dirs.setdefault(_dirname(path), set()).add(key)
+      while len(self.values) > self.max_entries:
+        self._remove(next(iter(self.values)))
+    return response
+
+  def set(self, path, attr_name, attr_value):
+    with self.lock:
+      if (path, attr_name) in self.values:
+        self._remove((path, attr_name))
+    return setattr1(path, attr_name, attr_value)
+
+  def invalidate(self, path):
+    """Drop everything cached for path and the files in it"""
+    path = os.path.normpath(path)
+    with self.lock:
+      for d in [d for d in self.dirs if d == path or d.startswith(path + os.sep)]:
+        for key in list(self.dirs[d]):
+          self._remove(key)
+      for key in [k for k in self.dirs.get(os.path.dirname(path), ()) if os.path.normpath(k[0]) == path]:
+        self._remove(key)
+
+  def _remove(self, key):
+    del self.values[key]
+    d = _dirname(key[0])
+    self.dirs[d].discard(key)
+    if not self.dirs[d]:
+      del self.dirs[d]
+
+  def stats(self):
+    return {"entries": len(self.values), "hits": self.hits, "misses": self.misses}
+
+
+cache = XattrCache()
+
+def getxattr(path, attr_name):
+  return cache.get(path, attr_name)
 
 def setxattr(path, attr_name, attr_value):
-  cached_attributes.pop((path, attr_name), None)
-  return setattr1(path, attr_name, attr_value)
+  return cache.set(path, attr_name, attr_value)
+
+def invalidate(path):
+  cache.invalidate(path)
@@ -1,38 +1,41 @@
 #!/usr/bin/env python3
+import socket
 import zmq
 import cereal.messaging as messaging
-from selfdrive.swaglog import get_le_handler
+from selfdrive.swaglog import LOG_MESSAGE_ADDR, get_le_handler, unpack_log_messages
 
 
 def main():
   le_handler = get_le_handler()
   le_level = 20  # logging.INFO
+  host = socket.gethostname()
 
   ctx = zmq.Context().instance()
   sock = ctx.socket(zmq.PULL)
-  sock.bind("ipc:///tmp/logmessage")
+  sock.bind(LOG_MESSAGE_ADDR)
 
   # and we publish them
   pub_sock = messaging.pub_sock('logMessage')
 
   while True:
-    dat = b''.join(sock.recv_multipart())
-    dat = dat.decode('utf8')
-
-    # print "RECV", repr(dat)
-
-    levelnum = ord(dat[0])
-    dat = dat[1:]
-
-    if levelnum >= le_level:
-      # push to logentries
-      # TODO: push to athena instead
-      le_handler.emit_raw(dat)
-
-    # then we publish them
-    msg = messaging.new_message()
-    msg.logMessage = dat
-    pub_sock.send(msg.to_bytes())
+    # everything that's waiting, python processes send batches of records
+    msgs = unpack_log_messages(sock.recv_multipart(), host)
+    while True:
+      try:
+        msgs += unpack_log_messages(sock.recv_multipart(zmq.NOBLOCK), host)
+      except zmq.error.Again:
+        break
+
+    for levelnum, dat in msgs:
+      if levelnum >= le_level:
+        # push to logentries
+        # TODO: push to athena instead
+        le_handler.emit_raw(dat)
+
+      # then we publish them
+      msg = messaging.new_message()
+      msg.logMessage = dat
+      pub_sock.send(msg.to_bytes())
 
 
 if __name__ == "__main__":
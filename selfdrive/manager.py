@@ -564,13 +564,14 @@ def main():
   ]
 
   # set unset params
-  for k, v in default_params:
-    if params.get(k) is None:
-      params.put(k, v)
-
-  # is this chffrplus?
-  if os.getenv("PASSIVE") is not None:
-    params.put("Passive", str(int(os.getenv("PASSIVE"))))
+  with params.transaction():
+    for k, v in default_params:
+      if params.get(k) is None:
+        params.put(k, v)
+
+    # is this chffrplus?
+    if os.getenv("PASSIVE") is not None:
+      params.put("Passive", str(int(os.getenv("PASSIVE"))))
 
   if params.get("Passive") is None:
     raise Exception("Passive must be set to continue")
@@ -0,0 +1,51 @@
+from cereal import log
+from common.realtime import sec_since_boot
+
+# capnp's default first segment, in 8 byte words
+DEFAULT_SEGMENT_WORDS = 1024
+MIN_SEGMENT_WORDS = 32
+# re-measure the size of a service's messages every this many messages
+MEASURE_INTERVAL = 100
+
+
+class MessagePool():
+  """Drop-in for messaging.new_message for processes that publish the same
+     messages every cycle.
+
+     capnp allocates and zeroes a first segment of 8 kB for every message,
+     plus more segments when that isn't enough. The pool remembers how big
+     each service's messages got and sizes the first segment to fit them,
+     so a message is a single allocation of about its final size.
+  """
+  def __init__(self):
+    self.words = {}
+    self.last = {}
+    self.count = {}
+
+  def _measure(self, service):
+    last = self.last.pop(service, None)
+    if last is None:
+      return
+    # room for the root pointer and some growth, e.g. of alert texts
+    words = int((last.total_size.word_count + 1) * 1.25)
+    self.words[service] = max(self.words.get(service, MIN_SEGMENT_WORDS), words)
+
+  def new_message(self, service=None, size=None):
+    cnt = self.count.get(service, 0)
+    if cnt % MEASURE_INTERVAL == 1:
+      self._measure(service)
+    self.count[service] = cnt + 1
+
+    dat = log.Event.new_message(num_first_segment_words=self.words.get(service, DEFAULT_SEGMENT_WORDS))
+    dat.logMonoTime = int(sec_since_boot() * 1e9)
+    dat.valid = True
+    if service is not None:
+      if size is None:
+        dat.init(service)
+      else:
+        dat.init(service, size)
+
+    # only kept to measure it later
+    if cnt % MEASURE_INTERVAL == 0:
+      self.last[service] = dat
+    return dat
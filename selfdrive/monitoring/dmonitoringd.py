@@ -7,7 +7,8 @@ from selfdrive.monitoring.driver_monitor import DriverStatus, MAX_TERMINAL_ALERT
 from selfdrive.locationd.calibrationd import Calibration
 
 
-def dmonitoringd_thread(sm=None, pm=None):
+def dmonitoringd_steps(sm=None, pm=None):
+  """Sets up dmonitoringd and then runs one iteration of its loop per next()"""
   if pm is None:
     pm = messaging.PubMaster(['dMonitoringState'])
 
@@ -34,6 +35,7 @@ def dmonitoringd_thread(sm=None, pm=None):
 
   # 10Hz <- dmonitoringmodeld
   while True:
+    yield
     sm.update()
 
     if not sm.updated['driverState']:
@@ -85,6 +87,11 @@ def dmonitoringd_thread(sm=None, pm=None):
     }
     pm.send('dMonitoringState', dat)
 
+
+def dmonitoringd_thread(sm=None, pm=None):
+  for _ in dmonitoringd_steps(sm, pm):
+    pass
+
 def main(sm=None, pm=None):
   dmonitoringd_thread(sm, pm)
 
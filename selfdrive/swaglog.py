@@ -1,10 +1,30 @@
 import os
+import time
 import logging
+import threading
 
 from logentries import LogentriesHandler
 import zmq
+try:
+  import msgpack
+except ImportError:
+  msgpack = None
 
-from common.logging_extra import SwagLogger, SwagFormatter
+from common.logging_extra import SwagLogger, SwagFormatter, NiceOrderedDict, json_handler, json_robust_dumps
+
+LOG_MESSAGE_ADDR = "ipc:///tmp/logmessage"
+
+# python processes send [BATCH_MARKER, msgpack'd batch], swaglog.cc and python processes
+# without msgpack send [levelnum, json]
+BATCH_MARKER = b"\x00"
+BATCH_SIZE = 64
+FLUSH_INTERVAL = 0.1  # s
+
+# fields of a record in a batch, logmessaged turns them into the dict of SwagFormatter.format_dict
+RECORD_FIELDS = ['msg', 'ctx', 'exc_info', 'levelnum', 'name', 'filename', 'lineno', 'pathname',
+                 'module', 'funcName', 'process', 'thread', 'threadName', 'created']
+# log dicts can have keys that aren't strings, newer msgpacks refuse those by default
+UNPACK_KWARGS = {'strict_map_key': False} if msgpack is not None and msgpack.version >= (1, 0) else {}
 
 
 def get_le_handler():
@@ -14,31 +34,136 @@ def get_le_handler():
 
 
 class LogMessageHandler(logging.Handler):
-  def __init__(self, formatter):
+  """Sends records to logmessaged in batches. Records are only packed into a list
+     of fields here, logmessaged formats them to json. A batch is sent when it's full,
+     FLUSH_INTERVAL after its first record, right away for errors and at exit.
+     Batches the socket can't take or that can't be packed are counted, and reported
+     in the next batch. Without msgpack every record is sent as json right away."""
+  def __init__(self, formatter, addr=LOG_MESSAGE_ADDR):
     logging.Handler.__init__(self)
     self.setFormatter(formatter)
+    self.addr = addr
     self.pid = None
+    self.pending = []
+    self.last_record = None  # the newest pending record, for handleError
+    self.dropped = 0
 
   def connect(self):
     self.zctx = zmq.Context()
     self.sock = self.zctx.socket(zmq.PUSH)
     self.sock.setsockopt(zmq.LINGER, 10)
-    self.sock.connect("ipc:///tmp/logmessage")
+    self.sock.connect(self.addr)
     self.pid = os.getpid()
+    self.pending = []
+    self.dropped = 0
+
+    self.has_pending = threading.Event()
+    threading.Thread(target=self.flush_thread, daemon=True).start()
+
+  def flush_thread(self):
+    while True:
+      self.has_pending.wait()
+      time.sleep(FLUSH_INTERVAL)
+      self.flush()
+
+  def pack_record(self, record):
+    if isinstance(record.msg, dict):
+      msg = record.msg
+    else:
+      try:
+        msg = record.getMessage()
+      except (ValueError, TypeError):
+        msg = [record.msg] + list(record.args)
+
+    exc_info = self.formatter.formatException(record.exc_info) if record.exc_info else None
+    return [msg, self.formatter.swaglogger.get_ctx(), exc_info, record.levelno, record.name, record.filename,
+            record.lineno, record.pathname, record.module, record.funcName, record.process, record.thread,
+            record.threadName, record.created]
 
   def emit(self, record):
     if os.getpid() != self.pid:
       self.connect()
 
-    msg = self.format(record).rstrip('\n')
-    # print("SEND".format(repr(msg)))
+    if msgpack is None:
+      self.send_json(record)
+      return
+
+    self.pending.append(self.pack_record(record))
+    self.last_record = record
+    if len(self.pending) >= BATCH_SIZE or record.levelno >= logging.ERROR:
+      self.send()
+    else:
+      self.has_pending.set()
+
+  def send(self):
+    self.has_pending.clear()
+    if not self.pending:
+      return
+
+    try:
+      dat = msgpack.packb([self.pid, self.dropped, self.pending], default=json_handler, use_bin_type=True)
+    except Exception:
+      # e.g. a lone surrogate in a str, the good records can't be told apart
+      self.dropped += len(self.pending)
+      self.pending = []
+      self.handleError(self.last_record)
+      return
+
     try:
-      s = chr(record.levelno)+msg
-      self.sock.send(s.encode('utf8'), zmq.NOBLOCK)
+      self.sock.send_multipart([BATCH_MARKER, dat], zmq.NOBLOCK)
+      self.dropped = 0
+    except zmq.error.Again:
+      self.dropped += len(self.pending)
+    self.pending = []
+
+  def send_json(self, record):
+    try:
+      self.sock.send_multipart([bytes([record.levelno]), self.format(record).encode('utf8')], zmq.NOBLOCK)
     except zmq.error.Again:
       # drop :/
       pass
 
+  def flush(self):
+    self.acquire()
+    try:
+      if self.pid == os.getpid():
+        self.send()
+    finally:
+      self.release()
+
+
+def record_to_json(fields, host):
+  """json of a record from a batch, the same as SwagFormatter.format"""
+  record = dict(zip(RECORD_FIELDS, fields))
+
+  record_dict = NiceOrderedDict()
+  record_dict['msg'] = record['msg']
+  record_dict['ctx'] = record['ctx']
+  if record['exc_info'] is not None:
+    record_dict['exc_info'] = record['exc_info']
+  record_dict['level'] = logging.getLevelName(record['levelnum'])
+  for k in ['levelnum', 'name', 'filename', 'lineno', 'pathname', 'module', 'funcName']:
+    record_dict[k] = record[k]
+  record_dict['host'] = host
+  for k in ['process', 'thread', 'threadName', 'created']:
+    record_dict[k] = record[k]
+  return json_robust_dumps(record_dict)
+
+
+def unpack_log_messages(frames, host):
+  """[(levelnum, json)] of a message received by logmessaged"""
+  if len(frames) == 2 and frames[0] == BATCH_MARKER:
+    pid, dropped, records = msgpack.unpackb(frames[1], raw=False, **UNPACK_KWARGS)
+    msgs = [(fields[3], record_to_json(fields, host)) for fields in records]
+    if dropped:
+      msg = NiceOrderedDict([('event', 'swaglog_dropped'), ('dropped', dropped)])
+      fields = [msg, {}, None, logging.WARNING, "swaglog", "", 0, "", "", "", pid, 0, "", time.time()]
+      msgs.insert(0, (logging.WARNING, record_to_json(fields, host)))
+    return msgs
+
+  dat = b''.join(frames).decode('utf8')
+  return [(ord(dat[0]), dat[1:])]
+
 
 def add_logentries_handler(log):
   """Function to add the logentries handler to swaglog.
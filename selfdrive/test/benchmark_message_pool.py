@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# Allocations per cycle of the messages controlsd sends, with messaging.new_message and with a MessagePool
+import gc
+import time
+import tracemalloc
+
+import cereal.messaging as messaging
+from selfdrive.message_pool import DEFAULT_SEGMENT_WORDS, MessagePool
+
+N = 10000
+
+
+def cycle(new_message, frame):
+  """Builds and serializes the messages of one controlsd cycle, returns their segment counts"""
+  msgs = []
+
+  dat = new_message('controlsState')
+  cs = dat.controlsState
+  cs.alertText1 = "TAKE CONTROL IMMEDIATELY"
+  cs.alertText2 = "Steering Temporarily Unavailable"
+  cs.canMonoTimes = [frame, frame + 1, frame + 2]
+  cs.vEgo = cs.vEgoRaw = cs.angleSteers = cs.curvature = 1.5
+  cs.enabled = cs.active = True
+  cs.lateralControlState.init('pidState').p = 0.1
+  msgs.append(dat)
+
+  dat = new_message('carState')
+  dat.carState.vEgo = 1.5
+  dat.carState.wheelSpeeds.fl = 1.5
+  dat.carState.cruiseState.speed = 20.
+  for e in dat.carState.init('events', 2):
+    e.enable = True
+  msgs.append(dat)
+
+  dat = new_message('carControl')
+  dat.carControl.enabled = True
+  dat.carControl.actuators.steer = 0.5
+  dat.carControl.hudControl.setSpeed = 20.
+  msgs.append(dat)
+
+  if frame % 100 == 0:
+    dat = new_message('carEvents', 2)
+    for e in dat.carEvents:
+      e.enable = True
+    msgs.append(dat)
+
+  # serialized like pm.send does, as segments to count them
+  return [len(dat.to_segments()) for dat in msgs]
+
+
+def measure(new_message, words):
+  for frame in range(200):
+    cycle(new_message, frame)
+
+  gc.disable()
+  tracemalloc.start()
+  gc_count = gc.get_count()[0]
+  segments = 0
+  t = time.monotonic()
+  for frame in range(N):
+    segments += sum(cycle(new_message, frame))
+  dt = time.monotonic() - t
+  gc_growth = gc.get_count()[0] - gc_count
+  retained, _ = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  gc.enable()
+
+  print("  %.1f us per cycle" % (dt / N * 1e6))
+  print("  %.2f segments per cycle, %d bytes of first segments" % (segments / N, 8 * words()))
+  print("  %d gc tracked objects and %d bytes of python memory left after %d cycles" % (gc_growth, retained, N))
+
+
+if __name__ == "__main__":
+  services = ['controlsState', 'carState', 'carControl']
+
+  print("messaging.new_message")
+  measure(messaging.new_message, lambda: DEFAULT_SEGMENT_WORDS * len(services))
+
+  pool = MessagePool()
+  print("MessagePool")
+  measure(pool.new_message, lambda: sum(pool.words[s] for s in services))
@@ -4,8 +4,8 @@ import os
 import sys
 import numbers
 import capnp
-
-import dictdiffer
+import numpy as np
+from collections import defaultdict, namedtuple
 
 if "CI" in os.environ:
   def tqdm(x):
@@ -28,75 +28,190 @@ def save_log(dest, log_msgs):
    f.write(dat)
 
 
-def remove_ignored_fields(msg, ignore):
-  msg = msg.as_builder()
-  for key in ignore:
-    attr = msg
-    keys = key.split(".")
-    if msg.which() not in key and len(keys) > 1:
+FieldDiff = namedtuple("FieldDiff", ["path", "idx", "mono_time", "a", "b"])
+
+
+def flatten_msg(d, prefix="", out=None):
+  """Flattens a to_dict(verbose=True) message into {"which.field.0.subfield": value}."""
+  if out is None:
+    out = {}
+  if isinstance(d, dict):
+    for k, v in d.items():
+      flatten_msg(v, prefix + "." + k if prefix else k, out)
+  elif isinstance(d, list):
+    if len(d) == 0:
+      out[prefix] = ()
+    for i, v in enumerate(d):
+      flatten_msg(v, f"{prefix}.{i}", out)
+  else:
+    out[prefix] = d
+  return out
+
+
+def _is_ignored(path, ignore_fields):
+  return any(path == f or path.startswith(f + ".") for f in ignore_fields)
+
+
+def _outside_tolerance(a, b, tolerance):
+  if isinstance(a, numbers.Number) and isinstance(b, numbers.Number):
+    if a != a and b != b:  # both nan
+      return False
+    return not abs(a - b) <= max(tolerance, tolerance * max(abs(a), abs(b)))
+  return a != b
+
+
+def _compare_column(a, b, tolerance):
+  """Returns the row indexes where two columns of field values differ."""
+  # only columns of plain numbers are vectorized, anything mixed with None or
+  # empty lists would make a ragged array, and numpy strings drop trailing NULs
+  kinds = set(map(type, a)) | set(map(type, b))
+  if not kinds <= {bool, int, float}:
+    return [i for i in range(len(a)) if _outside_tolerance(a[i], b[i], tolerance)]
+
+  arr_a, arr_b = np.array(a), np.array(b)
+  if arr_a.dtype.kind in "biuf" and arr_b.dtype.kind in "biuf":
+    # exact comparison in the native dtype first, so large ints don't go through floats
+    neq = arr_a != arr_b
+    if arr_a.dtype.kind == "f" and arr_b.dtype.kind == "f":
+      neq &= ~(np.isnan(arr_a) & np.isnan(arr_b))
+    idxs = np.flatnonzero(neq)
+    if len(idxs) == 0:
+      return idxs
+
+    fa, fb = arr_a[idxs].astype(np.float64), arr_b[idxs].astype(np.float64)
+    with np.errstate(invalid="ignore"):
+      within = np.abs(fa - fb) <= np.maximum(tolerance, tolerance * np.maximum(np.abs(fa), np.abs(fb)))
+    # float rounding can hide a difference between different large ints
+    exact_ints = (arr_a.dtype.kind in "iu") & (arr_b.dtype.kind in "iu") & (fa == fb)
+    return idxs[~within | exact_ints]
+
+  return [i for i in range(len(a)) if _outside_tolerance(a[i], b[i], tolerance)]
+
+
+def _events(log):
+  """(msg, bytes) of each message of a log, the bytes are None unless a LogReader kept them."""
+  if isinstance(log, LogReader):
+    return list(log.events_with_bytes())
+  return [(msg, None) for msg in log]
+
+
+def _ignored_fields_by_parent(which, ignore_fields):
+  """{parent path: [field names]} of the ignored fields a message of type which can have."""
+  by_parent = defaultdict(list)
+  for path in ignore_fields:
+    *parents, name = path.split(".")
+    if not parents or parents[0] == which:
+      by_parent[tuple(parents)].append(name)
+  return by_parent
+
+
+def _bytes_without_ignored(msg1, msg2, ignored_by_parent):
+  """Bytes of copies of two messages with the ignored fields made equal. Ignored
+     pointer fields are dropped from both, other fields get the value of msg1."""
+  b1, b2 = msg1.as_builder(), msg2.as_builder()
+  for parents, names in ignored_by_parent.items():
+    try:
+      s1, s2 = b1, b2
+      for p in parents:
+        s1, s2 = getattr(s1, p), getattr(s2, p)
+      for name in names:
+        v = getattr(s1, name)
+        if isinstance(v, (numbers.Number, capnp.lib.capnp._DynamicEnum)):
+          setattr(s2, name, v)
+        else:
+          s1.disown(name)
+          s2.disown(name)
+    except (AttributeError, capnp.lib.capnp.KjException):
+      # e.g. a path into a list
       continue
+  return b1.to_bytes(), b2.to_bytes()
 
-    for k in keys[:-1]:
-      try:
-        attr = getattr(msg, k)
-      except AttributeError:
-        break
-    else:
-      v = getattr(attr, keys[-1])
-      if isinstance(v, bool):
-        val = False
-      elif isinstance(v, numbers.Number):
-        val = 0
-      elif isinstance(v, capnp.lib.capnp._DynamicEnum):
-        val = 0
-      else:
-        raise NotImplementedError
-      setattr(attr, keys[-1], val)
-  return msg.as_reader()
 
+def compare_log_fields(log1, log2, ignore_fields=None, ignore_msgs=None, tolerance=None):
+  """Compares two logs field by field.
 
-def compare_logs(log1, log2, ignore_fields=None, ignore_msgs=None, tolerance=None):
+     Messages that are equal apart from the ignored fields are skipped, the others
+     are flattened into one column per field path, which is then compared
+     for all of them at once. Returns FieldDiffs in message order.
+  """
   if ignore_fields is None:
     ignore_fields = []
   if ignore_msgs is None:
     ignore_msgs = []
+  tolerance = EPSILON if tolerance is None else tolerance
 
-  log1, log2 = [list(filter(lambda m: m.which() not in ignore_msgs, log)) for log in (log1, log2)]
+  events1, events2 = [[e for e in _events(log) if e[0].which() not in ignore_msgs] for log in (log1, log2)]
+  log1, log2 = [m for m, _ in events1], [m for m, _ in events2]
 
   if len(log1) != len(log2):
     raise Exception(f"logs are not same length: {len(log1)} VS {len(log2)}")
 
-  diff = []
-  for msg1, msg2 in tqdm(zip(log1, log2)):
+  rows = defaultdict(list)
+  ignored_by_which = {}
+  for i, ((msg1, raw1), (msg2, raw2)) in enumerate(tqdm(zip(events1, events2))):
     if msg1.which() != msg2.which():
       print(msg1, msg2)
       raise Exception("msgs not aligned between logs")
+    # equal messages have nothing to compare, only the others are flattened
+    if raw1 is not None and raw2 is not None and raw1 == raw2:
+      continue
+    which = msg1.which()
+    if which not in ignored_by_which:
+      ignored_by_which[which] = _ignored_fields_by_parent(which, ignore_fields)
+    bytes1, bytes2 = _bytes_without_ignored(msg1, msg2, ignored_by_which[which])
+    if bytes1 != bytes2:
+      rows[which].append(i)
 
-    msg1_bytes = remove_ignored_fields(msg1, ignore_fields).as_builder().to_bytes()
-    msg2_bytes = remove_ignored_fields(msg2, ignore_fields).as_builder().to_bytes()
+  diff = []
+  for which, idxs in rows.items():
+    flat1 = [flatten_msg(log1[i].to_dict(verbose=True)) for i in idxs]
+    flat2 = [flatten_msg(log2[i].to_dict(verbose=True)) for i in idxs]
+
+    # layout comes from the first message, fields only present in some (unions, lists) are added after
+    layout = dict.fromkeys(flat1[0])
+    for f in flat1 + flat2:
+      if len(f) != len(layout) or f.keys() != layout.keys():
+        layout.update(dict.fromkeys(f))
+
+    for path in layout:
+      if _is_ignored(path, ignore_fields):
+        continue
+
+      a = [f.get(path) for f in flat1]
+      b = [f.get(path) for f in flat2]
+      for j in _compare_column(a, b, tolerance):
+        i = idxs[j]
+        diff.append(FieldDiff(path, i, log1[i].logMonoTime, a[j], b[j]))
+
+  diff.sort(key=lambda d: d.idx)
+  return diff
 
-    if msg1_bytes != msg2_bytes:
-      msg1_dict = msg1.to_dict(verbose=True)
-      msg2_dict = msg2.to_dict(verbose=True)
 
-      tolerance = EPSILON if tolerance is None else tolerance
-      dd = dictdiffer.diff(msg1_dict, msg2_dict, ignore=ignore_fields)
+def group_field_diffs(diff):
+  """Returns {path: (count, first mono time, last mono time)} for a compare_log_fields result."""
+  groups = {}
+  for d in diff:
+    if d.path in groups:
+      cnt, first, last = groups[d.path]
+      groups[d.path] = (cnt + 1, min(first, d.mono_time), max(last, d.mono_time))
+    else:
+      groups[d.path] = (1, d.mono_time, d.mono_time)
+  return groups
 
-      # Dictdiffer only supports relative tolerance, we also want to check for absolute
-      def outside_tolerance(diff):
-        if diff[0] == "change":
-          a, b = diff[2]
-          if isinstance(a, numbers.Number) and isinstance(b, numbers.Number):
-            return abs(a - b) > max(tolerance, tolerance * max(abs(a), abs(b)))
-        return True
 
-      dd = list(filter(outside_tolerance, dd))
+def compare_logs(log1, log2, ignore_fields=None, ignore_msgs=None, tolerance=None):
+  diff = compare_log_fields(log1, log2, ignore_fields, ignore_msgs, tolerance)
+  return [("change", d.path, (d.a, d.b)) for d in diff]
 
-      diff.extend(dd)
-  return diff
+
+def format_field_diffs(diff):
+  ret = ""
+  for path, (cnt, first, last) in sorted(group_field_diffs(diff).items()):
+    ret += "%s: %d (first %d, last %d)\n" % (path, cnt, first, last)
+  return ret
 
 
 if __name__ == "__main__":
   log1 = list(LogReader(sys.argv[1]))
   log2 = list(LogReader(sys.argv[2]))
-  print(compare_logs(log1, log2, sys.argv[3:]))
+  print(format_field_diffs(compare_log_fields(log1, log2, sys.argv[3:])))
@@ -14,12 +14,10 @@ else:
 
 from cereal import car, log
 from selfdrive.car.car_helpers import get_car
-import selfdrive.manager as manager
 import cereal.messaging as messaging
 from common.params import Params
 from cereal.services import service_list
-from collections import namedtuple
-from selfdrive.manager import managed_processes
+from collections import deque, namedtuple
 # Numpy gives different results based on CPU features after version 19
 NUMPY_TOLERANCE = 1e-7
 
@@ -149,6 +147,37 @@ class FakePubMaster(messaging.PubMaster):
     self.get_called.set()
     return dat
 
+class LockstepSubMaster(FakeSubMaster):
+  """SubMaster for lock-step replay: update() applies whatever was queued
+     before the step instead of waiting on the replay thread."""
+  def __init__(self, services):
+    super(LockstepSubMaster, self).__init__(services)
+    self.pending = []
+
+  def update(self, timeout=-1):
+    msgs, self.pending = self.pending, []
+    messaging.SubMaster.update_msgs(self, 0, msgs)
+
+
+class LockstepPubMaster(FakePubMaster):
+  def __init__(self, services):
+    super(LockstepPubMaster, self).__init__(services)
+    self.sent = deque()
+
+  def send(self, s, dat):
+    if isinstance(dat, bytes):
+      dat = log.Event.from_bytes(dat)
+    else:
+      dat = dat.as_reader()
+    self.data[s] = dat
+    self.sent.append(dat)
+
+  def pop_msg(self):
+    if not self.sent:
+      raise Exception("Process didn't publish the expected messages")
+    return self.sent.popleft()
+
+
 def fingerprint(msgs, fsm, can_sock):
   print("start fingerprinting")
   fsm.wait_on_getitem = True
@@ -308,25 +337,23 @@ CONFIGS = [
   ),
 ]
 
-def replay_process(cfg, lr):
-  proc = managed_processes[cfg.proc_name]
+def replay_process(cfg, lr, proc=None):
+  """proc: the process' entry in managed_processes. Importing selfdrive.manager
+     builds openpilot, so callers that already know it can skip that."""
+  if proc is None:
+    from selfdrive.manager import managed_processes
+    proc = managed_processes[cfg.proc_name]
+
   if isinstance(proc, str):
-    return python_replay_process(cfg, lr)
+    steps_fn = getattr(importlib.import_module(proc), cfg.proc_name + "_steps", None)
+    if steps_fn is not None:
+      return lockstep_replay_process(cfg, lr, steps_fn)
+    return python_replay_process(cfg, lr, proc)
   else:
     return cpp_replay_process(cfg, lr)
 
 
-def python_replay_process(cfg, lr):
-  sub_sockets = [s for _, sub in cfg.pub_sub.items() for s in sub]
-  pub_sockets = [s for s in cfg.pub_sub.keys() if s != 'can']
-
-  fsm = FakeSubMaster(pub_sockets)
-  fpm = FakePubMaster(sub_sockets)
-  args = (fsm, fpm)
-  if 'can' in list(cfg.pub_sub.keys()):
-    can_sock = FakeSocket()
-    args = (fsm, fpm, can_sock)
-
+def setup_python_replay(cfg, lr):
   all_msgs = sorted(lr, key=lambda msg: msg.logMonoTime)
   pub_msgs = [msg for msg in all_msgs if msg.which() in list(cfg.pub_sub.keys())]
 
@@ -347,8 +374,32 @@ def python_replay_process(cfg, lr):
         os.environ['FINGERPRINT'] = msg.carParams.carFingerprint
       break
 
-  manager.prepare_managed_process(cfg.proc_name)
-  mod = importlib.import_module(manager.managed_processes[cfg.proc_name])
+  return all_msgs, pub_msgs, params
+
+
+def get_recv_socks(cfg, msg, CP, fsm):
+  if cfg.should_recv_callback is not None:
+    return cfg.should_recv_callback(msg, CP, cfg, fsm)
+
+  recv_socks = [s for s in cfg.pub_sub[msg.which()] if
+                  (fsm.frame + 1) % int(service_list[msg.which()].frequency / service_list[s].frequency) == 0]
+  return recv_socks, bool(len(recv_socks))
+
+
+def python_replay_process(cfg, lr, proc):
+  sub_sockets = [s for _, sub in cfg.pub_sub.items() for s in sub]
+  pub_sockets = [s for s in cfg.pub_sub.keys() if s != 'can']
+
+  fsm = FakeSubMaster(pub_sockets)
+  fpm = FakePubMaster(sub_sockets)
+  args = (fsm, fpm)
+  if 'can' in list(cfg.pub_sub.keys()):
+    can_sock = FakeSocket()
+    args = (fsm, fpm, can_sock)
+
+  all_msgs, pub_msgs, params = setup_python_replay(cfg, lr)
+
+  mod = importlib.import_module(proc)
   thread = threading.Thread(target=mod.main, args=args)
   thread.daemon = True
   thread.start()
@@ -368,12 +419,7 @@ def python_replay_process(cfg, lr):
 
   log_msgs, msg_queue = [], []
   for msg in tqdm(pub_msgs):
-    if cfg.should_recv_callback is not None:
-      recv_socks, should_recv = cfg.should_recv_callback(msg, CP, cfg, fsm)
-    else:
-      recv_socks = [s for s in cfg.pub_sub[msg.which()] if
-                      (fsm.frame + 1) % int(service_list[msg.which()].frequency / service_list[s].frequency) == 0]
-      should_recv = bool(len(recv_socks))
+    recv_socks, should_recv = get_recv_socks(cfg, msg, CP, fsm)
 
     if msg.which() == 'can':
       can_sock.send(msg.as_builder().to_bytes())
@@ -392,7 +438,68 @@ def python_replay_process(cfg, lr):
         recv_cnt -= m.which() in recv_socks
   return log_msgs
 
+
+def lockstep_replay_process(cfg, lr, steps_fn):
+  """Replays a process single threaded. steps_fn(sm, pm[, can_sock]) is a generator
+     that sets the process up on the first next() and then runs one loop iteration
+     per next(). Sends and receives are the same as in python_replay_process."""
+  sub_sockets = [s for _, sub in cfg.pub_sub.items() for s in sub]
+  pub_sockets = [s for s in cfg.pub_sub.keys() if s != 'can']
+
+  fsm = LockstepSubMaster(pub_sockets)
+  fpm = LockstepPubMaster(sub_sockets)
+  args = (fsm, fpm)
+  can_sock = None
+  if 'can' in list(cfg.pub_sub.keys()):
+    can_sock = FakeSocket(wait=False)
+    args = (fsm, fpm, can_sock)
+
+  all_msgs, pub_msgs, params = setup_python_replay(cfg, lr)
+  steps = steps_fn(*args)
+
+  if cfg.init_callback is fingerprint:
+    # controlsd fingerprints during setup, give it the same CAN fingerprint() would
+    canmsgs = [msg for msg in all_msgs if msg.which() == "can"]
+    can_sock.data = [msg.as_builder().to_bytes() for msg in canmsgs[:300]]
+    next(steps)
+    can_sock.data = []
+  else:
+    if cfg.init_callback is not None:
+      cfg.init_callback(all_msgs, fsm, can_sock)
+    next(steps)
+
+  CP = car.CarParams.from_bytes(params.get("CarParams", block=True))
+
+  log_msgs, msg_queue = [], []
+  for msg in tqdm(pub_msgs):
+    recv_socks, should_recv = get_recv_socks(cfg, msg, CP, fsm)
+
+    if msg.which() == 'can':
+      can_sock.data.append(msg.as_builder().to_bytes())
+    else:
+      msg_queue.append(msg.as_builder())
+
+    if should_recv:
+      fsm.pending.extend(msg_queue)
+      msg_queue = []
+
+    # can driven processes run a loop iteration for every can message
+    if msg.which() == 'can' or should_recv:
+      next(steps)
+
+    if should_recv:
+      recv_cnt = len(recv_socks)
+      while recv_cnt > 0:
+        m = fpm.pop_msg()
+        log_msgs.append(m)
+
+        recv_cnt -= m.which() in recv_socks
+
+  steps.close()
+  return log_msgs
+
 def cpp_replay_process(cfg, lr):
+  import selfdrive.manager as manager
   sub_sockets = [s for _, sub in cfg.pub_sub.items() for s in sub]  # We get responses here
   pm = messaging.PubMaster(cfg.pub_sub.keys())
   sockets = {s : messaging.sub_sock(s, timeout=1000) for s in sub_sockets}
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+import json
+import math
+import unittest
+from unittest import mock
+
+from cereal import log
+from selfdrive.test.process_replay import compare_logs as cl
+from selfdrive.test.process_replay.compare_logs import compare_log_fields, compare_logs
+
+
+class FakeMsg():
+  def __init__(self, which, fields, mono_time=0):
+    self._which = which
+    self.fields = fields
+    self.logMonoTime = mono_time
+    self.to_dict_calls = 0
+
+  def which(self):
+    return self._which
+
+  def to_dict(self, verbose=False):
+    self.to_dict_calls += 1
+    return {self._which: self.fields}
+
+  def as_builder(self):
+    return self
+
+  def to_bytes(self):
+    return json.dumps({self._which: self.fields}, sort_keys=True).encode()
+
+
+def controls_state(mono_time, **kwargs):
+  msg = log.Event.new_message(logMonoTime=mono_time)
+  msg.init("controlsState")
+  for k, v in kwargs.items():
+    setattr(msg.controlsState, k, v)
+  return msg.as_reader()
+
+
+def sendcan(dats):
+  msg = log.Event.new_message()
+  msg.init("sendcan", len(dats))
+  for c, dat in zip(msg.sendcan, dats):
+    c.dat = dat
+  return msg.as_reader()
+
+
+def make_logs(fields1, fields2, which="carState"):
+  log1 = [FakeMsg(which, f, i) for i, f in enumerate(fields1)]
+  log2 = [FakeMsg(which, f, i) for i, f in enumerate(fields2)]
+  return log1, log2
+
+
+class TestCompareLogs(unittest.TestCase):
+  def test_equal_logs(self):
+    log1, log2 = make_logs([{"vEgo": i * 1.5, "gear": "drive"} for i in range(10)],
+                           [{"vEgo": i * 1.5, "gear": "drive"} for i in range(10)])
+    self.assertEqual(compare_log_fields(log1, log2), [])
+    # equal messages aren't flattened
+    self.assertEqual(sum(m.to_dict_calls for m in log1 + log2), 0)
+
+  def test_tolerance(self):
+    log1, log2 = make_logs([{"vEgo": 10.0}, {"vEgo": 10.0}, {"vEgo": math.nan}, {"vEgo": 0.0}],
+                           [{"vEgo": 10.0 + 1e-6}, {"vEgo": 10.5}, {"vEgo": math.nan}, {"vEgo": 1e-6}])
+    diff = compare_log_fields(log1, log2, tolerance=1e-3)
+    self.assertEqual([(d.path, d.idx) for d in diff], [("carState.vEgo", 1)])
+
+    # the default tolerance is exact up to float epsilon
+    diff = compare_log_fields(log1, log2)
+    self.assertEqual([d.idx for d in diff], [0, 1, 3])
+
+  def test_ignore_fields(self):
+    log1, log2 = make_logs([{"vEgo": 1.0, "vEgoRaw": 1.0, "cruiseState": {"speed": 1.0}}],
+                           [{"vEgo": 2.0, "vEgoRaw": 2.0, "cruiseState": {"speed": 2.0}}])
+    diff = compare_log_fields(log1, log2, ignore_fields=["carState.vEgo", "carState.cruiseState"])
+    self.assertEqual([d.path for d in diff], ["carState.vEgoRaw"])
+
+  def test_ignore_msgs(self):
+    log1 = [FakeMsg("carState", {"vEgo": 1.0}), FakeMsg("carEvents", [{"name": "a"}])]
+    log2 = [FakeMsg("carState", {"vEgo": 1.0}), FakeMsg("carEvents", [{"name": "b"}])]
+    self.assertEqual(compare_logs(log1, log2, ignore_msgs=["carEvents"]), [])
+    self.assertEqual(compare_logs(log1, log2), [("change", "carEvents.0.name", ("a", "b"))])
+
+  def test_list_length(self):
+    log1, log2 = make_logs([{"events": [1, 2]}, {"events": []}, {"events": [3]}],
+                           [{"events": [1, 2, 3]}, {"events": [4]}, {"events": [3]}])
+    diff = compare_logs(log1, log2)
+    self.assertCountEqual(diff, [("change", "carState.events.2", (None, 3)),
+                                 ("change", "carState.events", ((), None)),
+                                 ("change", "carState.events.0", (None, 4))])
+
+  def test_mixed_column(self):
+    # empty lists, None and numbers in one column can't be one numpy array
+    log1, log2 = make_logs([{"x": []}, {"x": [1.0]}, {"y": 1}],
+                           [{"x": [1.0]}, {"x": [1.0]}, {"y": 2}])
+    diff = compare_log_fields(log1, log2)
+    self.assertEqual(sorted((d.path, d.idx) for d in diff),
+                     [("carState.x", 0), ("carState.x.0", 0), ("carState.y", 2)])
+
+  def test_large_ints(self):
+    log1, log2 = make_logs([{"t": 2**62}, {"t": 2**62}], [{"t": 2**62 + 1}, {"t": 2**62}])
+    diff = compare_log_fields(log1, log2, tolerance=1e-3)
+    self.assertEqual([d.idx for d in diff], [0])
+
+  def test_not_aligned(self):
+    log1 = [FakeMsg("carState", {})]
+    log2 = [FakeMsg("controlsState", {})]
+    with self.assertRaises(Exception):
+      compare_log_fields(log1, log2)
+
+
+class TestCompareCapnpLogs(unittest.TestCase):
+  def test_ignored_fields_not_flattened(self):
+    ignore = ["logMonoTime", "controlsState.cumLagMs", "controlsState.startMonoTime", "controlsState.alertText1"]
+    log1 = [controls_state(i, vEgo=1., cumLagMs=i, startMonoTime=i, alertText1="a") for i in range(10)]
+    log2 = [controls_state(i + 1, vEgo=1., cumLagMs=i * 2, startMonoTime=0, alertText1="bcd") for i in range(10)]
+
+    with mock.patch.object(cl, "flatten_msg", wraps=cl.flatten_msg) as flatten:
+      self.assertEqual(compare_log_fields(log1, log2, ignore), [])
+      self.assertEqual(flatten.call_count, 0)
+
+      log2[3] = controls_state(4, vEgo=2., cumLagMs=6, alertText1="bcd")
+      diff = compare_log_fields(log1, log2, ignore)
+      self.assertEqual([(d.path, d.idx) for d in diff], [("controlsState.vEgo", 3)])
+      # one top level call per message, the others are recursive
+      self.assertEqual(len([c for c in flatten.call_args_list if len(c.args) == 1]), 2)
+
+    # the messages aren't changed
+    self.assertEqual(log2[3].controlsState.alertText1, "bcd")
+
+  def test_trailing_nul_bytes(self):
+    log1 = [sendcan([b"\x01\x00", b"\x02"])]
+    log2 = [sendcan([b"\x01", b"\x02"])]
+    diff = compare_log_fields(log1, log2)
+    self.assertEqual([(d.path, d.a, d.b) for d in diff], [("sendcan.0.dat", b"\x01\x00", b"\x01")])
+
+
+if __name__ == "__main__":
+  unittest.main()
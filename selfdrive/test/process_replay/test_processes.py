@@ -1,13 +1,20 @@
 #!/usr/bin/env python3
 import argparse
+import multiprocessing
 import os
+import queue
+import shutil
 import sys
+import tempfile
+import traceback
+from collections import namedtuple
 from typing import Any, cast
 
 from selfdrive.car.car_helpers import interface_names
 from selfdrive.test.process_replay.compare_logs import compare_logs
 from selfdrive.test.process_replay.process_replay import (CONFIGS,
                                                           replay_process)
+from tools.lib.filereader import FileReader
 from tools.lib.logreader import LogReader
 from selfdrive.car.chrysler.values import CAR as CHRYSLER
 from selfdrive.car.gm.values import CAR as GM
@@ -99,15 +106,15 @@ def get_segment(segment_name, original=True):
   return rlog_url
 
 
-def test_process(cfg, lr, cmp_log_fn, ignore_fields=None, ignore_msgs=None):
+def test_process(cfg, lr, cmp_log_fn, ignore_fields=None, ignore_msgs=None, proc=None):
   if ignore_fields is None:
     ignore_fields = []
   if ignore_msgs is None:
     ignore_msgs = []
   url = BASE_URL + os.path.basename(cmp_log_fn)
-  cmp_log_msgs = list(LogReader(url))
+  cmp_log_msgs = LogReader(url)
 
-  log_msgs = replay_process(cfg, lr)
+  log_msgs = replay_process(cfg, lr, proc)
 
   # check to make sure openpilot is engaged in the route
   # TODO: update routes so enable check can run
@@ -126,6 +133,79 @@ def test_process(cfg, lr, cmp_log_fn, ignore_fields=None, ignore_msgs=None):
   except Exception as e:
     return str(e)
 
+# proc is the process' entry in managed_processes. Workers re-import this module,
+# so it must not import selfdrive.manager, which builds openpilot when it's imported
+ReplayJob = namedtuple("ReplayJob", ["segment", "proc_name", "proc", "rlog_fn", "fingerprint", "cmp_log_fn",
+                                     "ignore_fields", "ignore_msgs"])
+
+def run_replay_job(job):
+  os.environ['FINGERPRINT'] = job.fingerprint
+  cfg = next(cfg for cfg in CONFIGS if cfg.proc_name == job.proc_name)
+  return test_process(cfg, LogReader(job.rlog_fn), job.cmp_log_fn, job.ignore_fields, job.ignore_msgs, job.proc)
+
+def _replay_worker(q, job):
+  try:
+    q.put((job.segment, job.proc_name, True, run_replay_job(job)))
+  except Exception:
+    q.put((job.segment, job.proc_name, False, traceback.format_exc()))
+
+def run_replay_jobs(jobs, n_jobs):
+  """Runs each job in its own process. Every process gets a private HOME, which
+     is where Params lives on PC, so replays can't see each other's params.
+     cpp processes publish on real sockets, so only one of those runs at a time."""
+  ctx = multiprocessing.get_context("spawn")
+  q = ctx.Queue()
+  pending = list(jobs)
+  running = {}
+  results = {}
+
+  def exclusive(job):
+    return not isinstance(job.proc, str)
+
+  try:
+    while pending or running:
+      for job in list(pending):
+        if len(running) >= n_jobs:
+          break
+        if exclusive(job) and any(exclusive(j) for j, _, _ in running.values()):
+          continue
+
+        pending.remove(job)
+        home = tempfile.mkdtemp()
+        prev_home = os.environ.get('HOME')
+        os.environ['HOME'] = home
+        try:
+          proc = ctx.Process(target=_replay_worker, args=(q, job))
+          proc.start()
+        finally:
+          if prev_home is None:
+            del os.environ['HOME']
+          else:
+            os.environ['HOME'] = prev_home
+        running[(job.segment, job.proc_name)] = (job, proc, home)
+
+      try:
+        segment, proc_name, ok, result = q.get(timeout=1.)
+      except queue.Empty:
+        for key, (job, proc, home) in running.items():
+          if proc.exitcode not in (None, 0):
+            raise Exception("replay of %s on %s crashed with exit code %d" % (job.proc_name, job.segment, proc.exitcode))
+        continue
+
+      _, proc, home = running.pop((segment, proc_name))
+      proc.join()
+      shutil.rmtree(home, ignore_errors=True)
+      if not ok:
+        raise Exception("replay of %s on %s failed:\n%s" % (proc_name, segment, result))
+      results[(segment, proc_name)] = result
+  finally:
+    for _, proc, home in running.values():
+      proc.terminate()
+      proc.join()
+      shutil.rmtree(home, ignore_errors=True)
+
+  return results
+
 def format_diff(results, ref_commit):
   diff1, diff2 = "", ""
   diff2 += "***** tested against commit %s *****\n" % ref_commit
@@ -172,6 +252,8 @@ if __name__ == "__main__":
                         help="Extra fields or msgs to ignore (e.g. carState.events)")
   parser.add_argument("--ignore-msgs", type=str, nargs="*", default=[],
                         help="Msgs to ignore (e.g. carEvents)")
+  parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of replays to run in parallel, each in its own process")
   args = parser.parse_args()
 
   cars_whitelisted = len(args.whitelist_cars) > 0
@@ -193,6 +275,11 @@ if __name__ == "__main__":
     assert len(untested) == 0, "Cars missing routes: %s" % (str(untested))
 
   results: Any = {}
+  jobs = []
+  log_dir = tempfile.mkdtemp() if args.jobs > 1 else None
+  if log_dir is not None:
+    # the build happens here once, the workers get the process entries from the jobs
+    from selfdrive.manager import managed_processes
   for segment, keys in segments.items():
     if (cars_whitelisted and keys["car_brand"].upper() not in args.whitelist_cars) or \
        (not cars_whitelisted and keys["car_brand"].upper() in args.blacklist_cars):
@@ -203,12 +290,18 @@ if __name__ == "__main__":
     else:
       os.environ['FINGERPRINT'] = ""
 
-    print("***** testing route segment %s *****\n" % segment)
-
     results[segment] = {}
 
     rlog_fn = get_segment(segment)
-    lr = LogReader(rlog_fn)
+    if log_dir is not None:
+      # download once here instead of in every worker
+      local_fn = os.path.join(log_dir, "%s_rlog.bz2" % segment.replace("|", "_"))
+      with FileReader(rlog_fn) as f, open(local_fn, "wb") as local_f:
+        local_f.write(f.read())
+      rlog_fn = local_fn
+    else:
+      print("***** testing route segment %s *****\n" % segment)
+      lr = LogReader(rlog_fn)
 
     for cfg in CONFIGS:
       if (procs_whitelisted and cfg.proc_name not in args.whitelist_procs) or \
@@ -216,7 +309,22 @@ if __name__ == "__main__":
         continue
 
       cmp_log_fn = os.path.join(process_replay_dir, "%s_%s_%s.bz2" % (segment, cfg.proc_name, ref_commit))
-      results[segment][cfg.proc_name] = test_process(cfg, lr, cmp_log_fn, args.ignore_fields, args.ignore_msgs)
+      if log_dir is not None:
+        jobs.append(ReplayJob(segment, cfg.proc_name, managed_processes[cfg.proc_name], rlog_fn,
+                              os.environ['FINGERPRINT'], cmp_log_fn, args.ignore_fields, args.ignore_msgs))
+      else:
+        results[segment][cfg.proc_name] = test_process(cfg, lr, cmp_log_fn, args.ignore_fields, args.ignore_msgs)
+
+  if log_dir is not None:
+    print("***** testing %d replays with %d jobs *****\n" % (len(jobs), args.jobs))
+    try:
+      job_results = run_replay_jobs(jobs, args.jobs)
+    finally:
+      shutil.rmtree(log_dir)
+
+    # same order as a serial run
+    for job in jobs:
+      results[job.segment][job.proc_name] = job_results[(job.segment, job.proc_name)]
 
   diff1, diff2, failed = format_diff(results, ref_commit)
   with open(os.path.join(process_replay_dir, "diff.txt"), "w") as f:
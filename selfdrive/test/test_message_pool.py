@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+import gc
+import tracemalloc
+import unittest
+
+from cereal import log
+from selfdrive.message_pool import DEFAULT_SEGMENT_WORDS, MessagePool
+from selfdrive.test.benchmark_message_pool import cycle
+
+
+class TestMessagePool(unittest.TestCase):
+  def test_sized_segments(self):
+    pool = MessagePool()
+    for _ in range(3):
+      dat = pool.new_message('carEvents', 20)
+      for e in dat.carEvents:
+        e.enable = True
+      dat.to_bytes()
+
+    # sized to the messages seen so far, which fit into one segment
+    self.assertLess(pool.words['carEvents'], DEFAULT_SEGMENT_WORDS)
+    self.assertEqual(len(dat.to_segments()), 1)
+    self.assertEqual(len(dat.carEvents), 20)
+    self.assertTrue(all(e.enable for e in log.Event.from_bytes(dat.to_bytes()).carEvents))
+
+  def test_steady_state(self):
+    # controlsd runs with gc disabled, so a cycle must not leave objects behind
+    pool = MessagePool()
+    for frame in range(200):
+      cycle(pool.new_message, frame)
+
+    gc.disable()
+    tracemalloc.start()
+    try:
+      gc_count = gc.get_count()[0]
+      for frame in range(1000):
+        self.assertEqual(cycle(pool.new_message, frame), [1] * (4 if frame % 100 == 0 else 3))
+      self.assertLessEqual(gc.get_count()[0] - gc_count, 0)
+      self.assertLess(tracemalloc.get_traced_memory()[0], 4096)
+    finally:
+      tracemalloc.stop()
+      gc.enable()
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+import json
+import logging
+import socket
+import tempfile
+import time
+import unittest
+from unittest import mock
+import zmq
+
+from common.logging_extra import SwagFormatter, SwagLogger
+from selfdrive import swaglog
+from selfdrive.swaglog import LogMessageHandler, unpack_log_messages
+
+
+class TestSwaglog(unittest.TestCase):
+  def setUp(self):
+    self.addr = f"ipc://{tempfile.mktemp()}"
+    self.ctx = zmq.Context()
+    self.sock = self.ctx.socket(zmq.PULL)
+    self.sock.bind(self.addr)
+    self.host = socket.gethostname()
+
+    self.log = SwagLogger()
+    self.log.setLevel(logging.DEBUG)
+    self.formatter = SwagFormatter(self.log)
+    self.handler = LogMessageHandler(SwagFormatter(self.log), addr=self.addr)
+    self.log.addHandler(self.handler)
+
+    # what the old handler sent for every record
+    self.records = []
+    self.log.addHandler(self)
+
+  def tearDown(self):
+    self.sock.close()
+    self.ctx.term()
+
+  # collects the records as a handler
+  level = logging.DEBUG
+  def handle(self, record):
+    self.records.append((record.levelno, self.formatter.format(record)))
+
+  def recv(self, timeout=1000):
+    msgs = []
+    while self.sock.poll(timeout):
+      msgs += unpack_log_messages(self.sock.recv_multipart(), self.host)
+      timeout = 100
+    return msgs
+
+  def test_same_as_json(self):
+    with self.log.ctx(route="abc"):
+      self.log.info("info %d", 1)
+      self.log.event("test_event", a=1, b=[1, 2], c={3: "x"}, d=object())
+      self.log.warning({"dict": "msg"})
+    try:
+      raise ValueError("test")
+    except ValueError:
+      self.log.exception("with exc_info")
+
+    msgs = self.recv()
+    self.assertEqual(len(msgs), 4)
+    for (levelnum, dat), (expected_levelnum, expected) in zip(msgs, self.records):
+      self.assertEqual(levelnum, expected_levelnum)
+      dat, expected = json.loads(dat), json.loads(expected)
+      # the repr of object() has its address
+      dat['msg'].pop('d', None) if isinstance(dat['msg'], dict) else None
+      expected['msg'].pop('d', None) if isinstance(expected['msg'], dict) else None
+      self.assertEqual(dat, expected)
+      self.assertEqual(list(dat.keys()), list(expected.keys()))
+
+  def test_batching(self):
+    for i in range(swaglog.BATCH_SIZE * 2 + 1):
+      self.log.debug("msg %d", i)
+
+    # full batches are sent right away, the rest after FLUSH_INTERVAL
+    self.assertEqual(len(unpack_log_messages(self.sock.recv_multipart(), self.host)), swaglog.BATCH_SIZE)
+    self.assertEqual(len(unpack_log_messages(self.sock.recv_multipart(), self.host)), swaglog.BATCH_SIZE)
+    self.assertFalse(self.sock.poll(0))
+    t = time.monotonic()
+    self.assertTrue(self.sock.poll(1000))
+    self.assertLess(time.monotonic() - t, swaglog.FLUSH_INTERVAL * 5)
+    self.assertEqual(len(unpack_log_messages(self.sock.recv_multipart(), self.host)), 1)
+
+    # errors aren't held back
+    self.log.error("error")
+    self.assertTrue(self.sock.poll(swaglog.FLUSH_INTERVAL * 1000 / 5))
+
+  def test_drops_counted(self):
+    self.log.info("first")
+    self.log.info("second")
+    with mock.patch.object(self.handler.sock, "send_multipart", side_effect=zmq.error.Again):
+      self.handler.flush()
+    self.assertEqual(self.handler.dropped, 2)
+
+    self.log.info("after drops")
+    self.handler.flush()
+    msgs = self.recv()
+    self.assertEqual(json.loads(msgs[0][1])['msg'], {"event": "swaglog_dropped", "dropped": 2})
+    self.assertEqual(json.loads(msgs[1][1])['msg'], "after drops")
+
+  def test_pack_error(self):
+    # json takes lone surrogates, msgpack doesn't
+    with mock.patch.object(self.handler, "handleError") as handle_error:
+      self.log.info("first")
+      self.log.event("bad", x="\ud800")
+      self.handler.flush()
+      self.assertEqual(handle_error.call_count, 1)
+      self.assertEqual(self.handler.dropped, 2)
+      self.assertEqual(self.handler.pending, [])
+
+      # errors are sent from emit, the exception doesn't reach the caller
+      self.log.event("bad", x="\ud800", error=True)
+      self.assertEqual(handle_error.call_count, 2)
+      self.assertEqual(self.handler.dropped, 3)
+
+    self.log.info("after drops")
+    self.handler.flush()
+    msgs = self.recv()
+    self.assertEqual(json.loads(msgs[0][1])['msg'], {"event": "swaglog_dropped", "dropped": 3})
+    self.assertEqual(json.loads(msgs[1][1])['msg'], "after drops")
+
+  def test_event_levels(self):
+    self.log.event("info_event")
+    self.log.event("debug_event", debug=True)
+    self.log.event("error_event", error=True)
+    msgs = self.recv()
+    self.assertEqual([levelnum for levelnum, _ in msgs], [logging.INFO, logging.DEBUG, logging.ERROR])
+
+  def test_without_msgpack(self):
+    with mock.patch.object(swaglog, "msgpack", None):
+      self.log.info("info %d", 1)
+      self.log.event("test_event", a=1)
+      msgs = self.recv()
+
+    self.assertEqual(len(msgs), 2)
+    for (levelnum, dat), (expected_levelnum, expected) in zip(msgs, self.records):
+      self.assertEqual(levelnum, expected_levelnum)
+      self.assertEqual(json.loads(dat), json.loads(expected))
+
+  def test_cloudlog_c_format(self):
+    # swaglog.cc sends the level and the json in two frames
+    dat = json.dumps({"msg": "from c"})
+    self.assertEqual(unpack_log_messages([bytes([20]), dat.encode()], self.host), [(20, dat)])
+
+
+if __name__ == "__main__":
+  unittest.main()
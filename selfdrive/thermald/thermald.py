@@ -199,7 +199,7 @@ def thermald_thread():
   handle_fan = None
   is_uno = False
 
-  params = Params()
+  params = Params(cache=True)
   pm = PowerMonitoring()
   no_panda_cnt = 0
 
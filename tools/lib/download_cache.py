@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import fcntl
+import atexit
+import argparse
+import threading
+from tools.lib.file_helpers import mkdirs_exists_ok, atomic_write_in_dir
+
+#  Byte budget for all cached chunks, least recently used ones are evicted past it
+CACHE_MAX_BYTES = int(os.environ.get("FILEREADER_CACHE_MAX_BYTES", 10 * 1000 * 1000 * 1000))
+#  How often the index is written back while reading
+FLUSH_INTERVAL = 10.
+
+INDEX_FILE = "index.json"
+LOCK_FILE = "index.lock"
+INDEX_VERSION = 1
+
+STAT_KEYS = ("hits", "misses", "bytes_saved", "bytes_downloaded")
+
+
+class DownloadCache(object):
+  """Size-bounded LRU store for downloaded file chunks.
+
+     Which files are present, their sizes and access times live in an index
+     file, so lookups don't have to stat the cache directory. The index is
+     merged with the on-disk copy under a lock, since several processes can
+     share one cache directory.
+  """
+  def __init__(self, cache_dir, max_bytes=CACHE_MAX_BYTES):
+    self.cache_dir = cache_dir
+    self.max_bytes = max_bytes
+    self._lock = threading.Lock()
+    self._files = None
+    self._evicted = set()
+    self._stats = dict.fromkeys(STAT_KEYS, 0)
+    self._last_flush = 0.
+    atexit.register(self.flush, True)
+
+  @property
+  def _index_path(self):
+    return os.path.join(self.cache_dir, INDEX_FILE)
+
+  def _read_index(self):
+    try:
+      with open(self._index_path, "r") as f:
+        index = json.load(f)
+      if index.get("version") == INDEX_VERSION:
+        return index
+    except (OSError, ValueError):
+      pass
+    return None
+
+  def _scan(self):
+    files = {}
+    try:
+      for entry in os.scandir(self.cache_dir):
+        if entry.is_file() and entry.name not in (INDEX_FILE, LOCK_FILE) and not entry.name.startswith("."):
+          st = entry.stat()
+          files[entry.name] = [st.st_size, st.st_atime]
+    except FileNotFoundError:
+      pass
+    return files
+
+  def _load(self):
+    if self._files is None:
+      index = self._read_index()
+      # caches from before the index existed are picked up once
+      self._files = index["files"] if index is not None else self._scan()
+
+  def total_bytes(self):
+    with self._lock:
+      self._load()
+      return sum(size for size, _ in self._files.values())
+
+  def contains(self, name):
+    with self._lock:
+      self._load()
+      return name in self._files
+
+  def get(self, name):
+    """Returns the cached contents for name, or None if it isn't cached."""
+    with self._lock:
+      self._load()
+      if name not in self._files:
+        self._stats["misses"] += 1
+        return None
+
+      try:
+        with open(os.path.join(self.cache_dir, name), "rb") as f:
+          data = f.read()
+      except FileNotFoundError:
+        # removed from under us
+        del self._files[name]
+        self._stats["misses"] += 1
+        return None
+
+      self._files[name] = [len(data), time.time()]
+      self._stats["hits"] += 1
+      self._stats["bytes_saved"] += len(data)
+
+    self.flush()
+    return data
+
+  def put(self, name, data):
+    mkdirs_exists_ok(self.cache_dir)
+    with atomic_write_in_dir(os.path.join(self.cache_dir, name), mode="wb", overwrite=True) as f:
+      f.write(data)
+
+    with self._lock:
+      self._load()
+      self._files[name] = [len(data), time.time()]
+      self._evicted.discard(name)
+      self._stats["bytes_downloaded"] += len(data)
+      self._evict()
+
+    self.flush()
+
+  def _evict(self):
+    total = sum(size for size, _ in self._files.values())
+    if total <= self.max_bytes:
+      return
+
+    for name in sorted(self._files, key=lambda n: self._files[n][1]):
+      if total <= self.max_bytes:
+        break
+      size, _ = self._files.pop(name)
+      total -= size
+      self._evicted.add(name)
+      try:
+        os.remove(os.path.join(self.cache_dir, name))
+      except FileNotFoundError:
+        pass
+
+    self._last_flush = 0.
+
+  def flush(self, force=False):
+    """Merges this process' view of the cache into the index file."""
+    with self._lock:
+      if self._files is None:
+        return
+      if not force and time.time() - self._last_flush < FLUSH_INTERVAL:
+        return
+      if not os.path.isdir(self.cache_dir):
+        return
+
+      with open(os.path.join(self.cache_dir, LOCK_FILE), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        index = self._read_index() or {"files": {}, "stats": {}}
+        files = {n: v for n, v in index["files"].items() if n not in self._evicted}
+        for name, (size, atime) in self._files.items():
+          if name in files:
+            if files[name][1] < atime:
+              files[name] = [size, atime]
+          elif os.path.exists(os.path.join(self.cache_dir, name)):
+            # not in the index and gone from disk means another process evicted it
+            files[name] = [size, atime]
+        stats = {k: index["stats"].get(k, 0) + self._stats[k] for k in STAT_KEYS}
+
+        with atomic_write_in_dir(self._index_path, mode="w", overwrite=True) as f:
+          json.dump({"version": INDEX_VERSION, "files": files, "stats": stats}, f)
+
+      self._files = files
+      self._evicted = set()
+      self._stats = dict.fromkeys(STAT_KEYS, 0)
+      self._last_flush = time.time()
+
+  def stats(self):
+    self.flush(force=True)
+    index = self._read_index() or {"files": {}, "stats": {}}
+    ret = {k: index["stats"].get(k, 0) for k in STAT_KEYS}
+    ret["files"] = len(index["files"])
+    ret["bytes"] = sum(size for size, _ in index["files"].values())
+    ret["max_bytes"] = self.max_bytes
+    lookups = ret["hits"] + ret["misses"]
+    ret["hit_rate"] = ret["hits"] / lookups if lookups > 0 else 0.
+    return ret
+
+
+def main(argv):
+  from tools.lib.url_file import CACHE_DIR
+
+  parser = argparse.ArgumentParser(description="Manage the URLFile download cache.")
+  parser.add_argument("--cache-dir", default=CACHE_DIR)
+  parser.add_argument("command", choices=["stats"])
+  args = parser.parse_args(argv)
+
+  if args.command == "stats":
+    stats = DownloadCache(args.cache_dir).stats()
+    print(f"files:      {stats['files']}")
+    print(f"size:       {stats['bytes'] / 1e6:.1f} MB of {stats['max_bytes'] / 1e6:.1f} MB")
+    print(f"hit rate:   {stats['hit_rate'] * 100:.1f}% ({stats['hits']} hits, {stats['misses']} misses)")
+    print(f"downloaded: {stats['bytes_downloaded'] / 1e6:.1f} MB")
+    print(f"saved:      {stats['bytes_saved'] / 1e6:.1f} MB")
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))
@@ -2,12 +2,19 @@
 import os
 import sys
 import bz2
+import bisect
+import json
+import mmap
+import shutil
+import struct
 import tempfile
 import subprocess
 import urllib.parse
+from concurrent.futures import ProcessPoolExecutor
 import capnp
 import numpy as np
 
+from tools.lib.cache import cache_path_for_file_path
 from tools.lib.exceptions import DataUnreadableError
 try:
   from xx.chffr.lib.filereader import FileReader
@@ -16,6 +23,10 @@ except ImportError:
 from cereal import log as capnp_log
 
 OP_PATH = os.path.dirname(os.path.dirname(capnp_log.__file__))
+STREAM_CHUNK_SIZE = 1024 * 1024
+# capnp doesn't read messages with more segments
+MAX_SEGMENTS = 512
+LOG_INDEX_VERSION = 2
 
 def index_log(fn):
   index_log_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "index_log")
@@ -31,22 +42,318 @@ def index_log(fn):
     raise DataUnreadableError("%s capnp is corrupted/truncated" % fn) from e
   return np.frombuffer(dat, dtype=np.uint64)
 
-def event_read_multiple_bytes(dat):
+def index_log_bytes(dat):
   with tempfile.NamedTemporaryFile() as dat_f:
     dat_f.write(dat)
     dat_f.flush()
     idx = index_log(dat_f.name)
 
   end_idx = np.uint64(len(dat))
-  idx = np.append(idx, end_idx)
+  return np.append(idx, end_idx)
 
-  return [capnp_log.Event.from_bytes(dat[idx[i]:idx[i+1]])
-          for i in range(len(idx)-1)]
+def event_read_multiple_bytes(dat, idx=None):
+  if idx is None:
+    idx = index_log_bytes(dat)
+  return list(LogEvents(dat, idx))
 
+class LogEvents(object):
+  """Sequence of the events in a decompressed log.
+
+     All readers share dat through memoryviews instead of each holding a copy
+     of its message, and are only created when accessed.
+  """
+  def __init__(self, dat, idx):
+    self._dat = memoryview(dat)
+    self._idx = idx.tolist()
+
+  def __len__(self):
+    return len(self._idx) - 1
+
+  def __getitem__(self, i):
+    if isinstance(i, slice):
+      return [self[j] for j in range(*i.indices(len(self)))]
+    if i < 0:
+      i += len(self)
+    if not 0 <= i < len(self):
+      raise IndexError("event index out of range")
+    # messages start on word boundaries, so the views stay aligned for capnp
+    return capnp_log.Event.from_bytes(self.raw(i))
+
+  def raw(self, i):
+    """The bytes of event i, a view of the log data."""
+    return self._dat[self._idx[i]:self._idx[i+1]]
+
+  def __iter__(self):
+    for i in range(len(self)):
+      yield self[i]
+
+def load_log_data(fn):
+  """Downloads, decompresses and indexes a log. The result is picklable,
+     so this can run in a worker process and be handed to LogReader."""
+  _, ext = os.path.splitext(urllib.parse.urlparse(fn).path)
+  with FileReader(fn) as f:
+    dat = f.read()
+
+  # old rlogs weren't bz2 compressed
+  if ext == ".bz2":
+    dat = bz2.decompress(dat)
+  elif ext != "":
+    raise Exception(f"unknown extension {ext}")
+
+  return dat, index_log_bytes(dat)
+
+def frame_length(dat, offset=0):
+  """Returns the size in bytes of the capnp message starting at offset,
+     or None if dat doesn't hold enough of it to tell."""
+  avail = len(dat) - offset
+  if avail < 4:
+    return None
+
+  # segment table: (segment count - 1), then one word count per segment, padded to 8 bytes
+  num_segments = struct.unpack_from("<I", dat, offset)[0] + 1
+  if num_segments > MAX_SEGMENTS:
+    raise DataUnreadableError("capnp is corrupted, %d segments at %d" % (num_segments, offset))
+  header_len = (4 + 4*num_segments + 7) & ~7
+  if avail < header_len:
+    return None
+
+  segment_words = struct.unpack_from("<%dI" % num_segments, dat, offset + 4)
+  return header_len + 8*sum(segment_words)
+
+def _read_chunks(f, chunk_size):
+  # URLFile can't read past the end of the remote file
+  length = f.get_length() if hasattr(f, "get_length") else None
+  pos = 0
+  while length is None or pos < length:
+    dat = f.read(chunk_size if length is None else min(chunk_size, length - pos))
+    if not dat:
+      break
+    pos += len(dat)
+    yield dat
+
+def _decompress_chunks(chunks):
+  decompressor = bz2.BZ2Decompressor()
+  for dat in chunks:
+    while dat:
+      yield decompressor.decompress(dat)
+      # multi-stream bz2, start over on the leftover bytes
+      dat = b""
+      if decompressor.eof:
+        dat = decompressor.unused_data
+        decompressor = bz2.BZ2Decompressor()
+
+def event_stream_bytes(chunks):
+  """Splits a stream of raw log chunks into the bytes of each capnp message."""
+  buf = bytearray()
+  pos = 0
+  for dat in chunks:
+    buf += dat
+    # sliced as a view, so each message is copied once. The view is released
+    # before the buffer is resized
+    with memoryview(buf) as view:
+      while True:
+        n = frame_length(view, pos)
+        if n is None or len(view) - pos < n:
+          break
+        yield bytes(view[pos:pos+n])
+        pos += n
+
+    # drop consumed messages so the buffer stays around one chunk in size
+    if pos > 0:
+      del buf[:pos]
+      pos = 0
+
+  if len(buf) > 0:
+    raise DataUnreadableError("capnp is truncated, %d trailing bytes" % len(buf))
+
+def _event_bytes_for_file(fn, chunk_size=STREAM_CHUNK_SIZE):
+  _, ext = os.path.splitext(urllib.parse.urlparse(fn).path)
+  if ext not in ("", ".bz2"):
+    raise Exception(f"unknown extension {ext}")
+
+  with FileReader(fn) as f:
+    chunks = _read_chunks(f, chunk_size)
+    if ext == ".bz2":
+      chunks = _decompress_chunks(chunks)
+    try:
+      yield from event_stream_bytes(chunks)
+    except DataUnreadableError as e:
+      raise DataUnreadableError("%s %s" % (fn, e)) from e
+
+def stream_log(fn, which=None, only_union_types=False, chunk_size=STREAM_CHUNK_SIZE):
+  """Yields the events of a log one at a time without decompressing
+     or indexing the whole file up front.
+
+     which: optional message type or collection of types, other events are skipped.
+  """
+  if isinstance(which, str):
+    which = {which}
+  elif which is not None:
+    which = set(which)
+
+  for dat in _event_bytes_for_file(fn, chunk_size):
+    ent = capnp_log.Event.from_bytes(dat)
+    if which is None and not only_union_types:
+      yield ent
+      continue
+
+    try:
+      w = ent.which()
+    except capnp.lib.capnp.KjException:
+      continue
+    if which is None or w in which:
+      yield ent
+
+def log_start_time(fn):
+  """logMonoTime of the first message of a log, only decompresses as much as that needs."""
+  for ent in stream_log(fn):
+    return ent.logMonoTime
+  raise DataUnreadableError("%s has no messages" % fn)
+
+
+class LogIndex(object):
+  """Uncompressed, memory-mapped copy of a log with per-message offsets,
+     logMonoTimes and per-which() indexes, cached next to the other tools caches.
+
+     The first open decodes the log once, later opens only mmap the cache.
+     The cache is rebuilt when the size or mtime of the log changed.
+  """
+  def __init__(self, fn, cache_prefix=None):
+    self.path = cache_path_for_file_path(fn, cache_prefix) + ".logindex"
+    source = self._source(fn)
+    if not self._valid(self.path, source):
+      self.build(fn, self.path, source)
+
+    with open(os.path.join(self.path, "meta.json")) as f:
+      meta = json.load(f)
+    self.types = meta['types']
+    self._type_codes = {w: i for i, w in enumerate(self.types)}
+
+    self.offsets = np.load(os.path.join(self.path, "offsets.npy"), mmap_mode='r')
+    self.mono_times = np.load(os.path.join(self.path, "mono_times.npy"), mmap_mode='r')
+    self.which_codes = np.load(os.path.join(self.path, "which.npy"), mmap_mode='r')
+    # message indexes sorted by (which, logMonoTime), which_bounds[c]:which_bounds[c+1] is type c
+    self.which_order = np.load(os.path.join(self.path, "which_order.npy"), mmap_mode='r')
+    self.which_bounds = np.load(os.path.join(self.path, "which_bounds.npy"), mmap_mode='r')
+
+    self._data_f = open(os.path.join(self.path, "data"), "rb")
+    size = os.fstat(self._data_f.fileno()).st_size
+    self._data = mmap.mmap(self._data_f.fileno(), size, access=mmap.ACCESS_READ) if size > 0 else b""
+
+  @staticmethod
+  def _source(fn):
+    """Size and mtime of the log the index is built from, remote logs only have a size."""
+    if urllib.parse.urlparse(fn).scheme in ("http", "https"):
+      with FileReader(fn) as f:
+        return {'size': f.get_length(), 'mtime': None}
+    st = os.stat(fn)
+    return {'size': st.st_size, 'mtime': st.st_mtime_ns}
+
+  @staticmethod
+  def _valid(path, source):
+    try:
+      with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+      return meta['version'] == LOG_INDEX_VERSION and meta['source'] == source
+    except (OSError, ValueError, KeyError):
+      return False
+
+  @staticmethod
+  def build(fn, path, source):
+    offsets, mono_times, which_codes, types = [0], [], [], []
+    type_codes = {}
+
+    tmp_path = tempfile.mkdtemp(dir=os.path.dirname(path))
+    try:
+      with open(os.path.join(tmp_path, "data"), "wb") as data_f:
+        for dat in _event_bytes_for_file(fn):
+          ent = capnp_log.Event.from_bytes(dat)
+          try:
+            w = ent.which()
+          except capnp.lib.capnp.KjException:
+            w = ""
+          if w not in type_codes:
+            type_codes[w] = len(types)
+            types.append(w)
+
+          data_f.write(dat)
+          offsets.append(offsets[-1] + len(dat))
+          mono_times.append(ent.logMonoTime)
+          which_codes.append(type_codes[w])
+
+      mono_times = np.array(mono_times, dtype=np.uint64)
+      which_codes = np.array(which_codes, dtype=np.uint16)
+      which_order = np.lexsort((mono_times, which_codes))
+      which_bounds = np.searchsorted(which_codes[which_order], np.arange(len(types) + 1))
+
+      np.save(os.path.join(tmp_path, "offsets.npy"), np.array(offsets, dtype=np.uint64))
+      np.save(os.path.join(tmp_path, "mono_times.npy"), mono_times)
+      np.save(os.path.join(tmp_path, "which.npy"), which_codes)
+      np.save(os.path.join(tmp_path, "which_order.npy"), which_order.astype(np.uint64))
+      np.save(os.path.join(tmp_path, "which_bounds.npy"), which_bounds.astype(np.uint64))
+      with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+        json.dump({'version': LOG_INDEX_VERSION, 'types': types, 'source': source}, f)
+
+      if os.path.isdir(path):
+        shutil.rmtree(path)
+      os.rename(tmp_path, path)
+    except OSError:
+      # another process finished the same index first
+      if not LogIndex._valid(path, source):
+        raise
+    finally:
+      if os.path.isdir(tmp_path):
+        shutil.rmtree(tmp_path)
+
+  def close(self):
+    if isinstance(self._data, mmap.mmap):
+      try:
+        self._data.close()
+      except BufferError:
+        # events handed out still reference the map, it's unmapped once they're gone
+        pass
+    self._data_f.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  def __len__(self):
+    return len(self.mono_times)
+
+  def __getitem__(self, i):
+    return capnp_log.Event.from_bytes(memoryview(self._data)[int(self.offsets[i]):int(self.offsets[i+1])])
+
+  def indexes(self, which=None, t0=None, t1=None):
+    """Returns message indexes in [t0, t1) (logMonoTime ns) in time order."""
+    if which is None:
+      idxs = np.arange(len(self), dtype=np.uint64)
+      mono_times = self.mono_times
+      if t0 is not None or t1 is not None:
+        idxs = idxs[np.argsort(mono_times, kind='stable')]
+        mono_times = mono_times[idxs]
+    else:
+      code = self._type_codes.get(which)
+      if code is None:
+        return np.array([], dtype=np.uint64)
+      idxs = self.which_order[self.which_bounds[code]:self.which_bounds[code+1]]
+      mono_times = self.mono_times[idxs]
+
+    start = 0 if t0 is None else np.searchsorted(mono_times, np.uint64(t0), side='left')
+    end = len(idxs) if t1 is None else np.searchsorted(mono_times, np.uint64(t1), side='left')
+    return idxs[start:end]
+
+  def messages(self, which=None, t0=None, t1=None):
+    for i in self.indexes(which, t0, t1):
+      yield self[i]
 
 # this is an iterator itself, and uses private variables from LogReader
 class MultiLogIterator(object):
-  def __init__(self, log_paths, wraparound=True):
+  def __init__(self, log_paths, wraparound=True, prefetch=0):
+    """prefetch: number of segments ahead of the cursor to decode in a process pool.
+       With prefetch enabled only those and the current segment are kept in memory."""
     self._log_paths = log_paths
     self._wraparound = wraparound
 
@@ -54,16 +361,83 @@ class MultiLogIterator(object):
     self._current_log = self._first_log_idx
     self._idx = 0
     self._log_readers = [None]*len(log_paths)
-    self.start_time = self._log_reader(self._first_log_idx)._ts[0]
+    self._ts_max = [None]*len(log_paths)
+    self._start_times = {}
+
+    self._prefetch = prefetch
+    self._pool = ProcessPoolExecutor(max_workers=prefetch) if prefetch > 0 else None
+    self._futures = {}
+
+    self.start_time = self._segment_start(self._first_log_idx)
+    self._update_prefetch()
 
   def _log_reader(self, i):
     if self._log_readers[i] is None and self._log_paths[i] is not None:
       log_path = self._log_paths[i]
       print("LogReader:%s" % log_path)
-      self._log_readers[i] = LogReader(log_path)
+      if self._pool is None:
+        self._log_readers[i] = LogReader(log_path)
+      else:
+        future = self._futures.pop(i, None) or self._pool.submit(load_log_data, log_path)
+        self._log_readers[i] = LogReader(log_path, log_data=future.result())
+      self._start_times[i] = int(self._log_readers[i]._ts[0])
 
     return self._log_readers[i]
 
+  def _segments_ahead(self, i, n):
+    ret = []
+    n_logs = len(self._log_paths)
+    for j in range(i + 1, i + n_logs):
+      if len(ret) == n or (j >= n_logs and not self._wraparound):
+        break
+      if self._log_paths[j % n_logs] is not None:
+        ret.append(j % n_logs)
+    return ret
+
+  def _update_prefetch(self):
+    if self._pool is None:
+      return
+
+    ahead = self._segments_ahead(self._current_log, self._prefetch)
+    keep = set(ahead) | {self._current_log}
+
+    # evict everything outside the window, start times are kept for seeking
+    for i in range(len(self._log_readers)):
+      if i not in keep:
+        self._log_readers[i] = None
+        self._ts_max[i] = None
+    for i in list(self._futures.keys()):
+      if i not in keep:
+        self._futures.pop(i).cancel()
+
+    for i in ahead:
+      if self._log_readers[i] is None and i not in self._futures:
+        self._futures[i] = self._pool.submit(load_log_data, self._log_paths[i])
+
+  def close(self):
+    if self._pool is not None:
+      for future in self._futures.values():
+        future.cancel()
+      self._futures = {}
+      self._pool.shutdown(wait=False)
+      self._pool = None
+
+  def _segment_start(self, i):
+    # read from the head of the log, so seeking doesn't load the segments it passes
+    if i not in self._start_times:
+      if self._log_readers[i] is not None:
+        self._start_times[i] = int(self._log_readers[i]._ts[0])
+      else:
+        self._start_times[i] = log_start_time(self._log_paths[i])
+    return self._start_times[i]
+
+  def _segment_ts_max(self, i):
+    # logMonoTime isn't strictly sorted within a log, the running max is
+    # and searching it finds the first message at or after a time
+    if self._ts_max[i] is None:
+      self._ts_max[i] = np.maximum.accumulate(self._log_reader(i)._ts)
+    return self._ts_max[i]
+
   def __iter__(self):
     return self
 
@@ -81,6 +455,7 @@ class MultiLogIterator(object):
           self._current_log = self._first_log_idx
         else:
           raise StopIteration
+      self._update_prefetch()
 
   def __next__(self):
     while 1:
@@ -91,54 +466,76 @@ class MultiLogIterator(object):
 
   def tell(self):
     # returns seconds from start of log
-    return (self._log_reader(self._current_log)._ts[self._idx] - self.start_time) * 1e-9
+    return (int(self._log_reader(self._current_log)._ts[self._idx]) - self.start_time) * 1e-9
 
   def seek(self, ts):
-    # seek to nearest minute
-    minute = int(ts/60)
-    if minute >= len(self._log_paths) or self._log_paths[minute] is None:
-      return False
+    # ts is seconds from start of log
+    return self.seek_mono(self.start_time + int(ts * 1e9))
 
-    self._current_log = minute
+  def seek_mono(self, mono_time):
+    """Moves to the first message with logMonoTime >= mono_time.
 
-    # HACK: O(n) seek afterward
-    self._idx = 0
-    while self.tell() < ts:
-      self._inc()
-    return True
+       Returns False if mono_time is past the end of the route."""
+    segments = [i for i in range(len(self._log_paths)) if self._log_paths[i] is not None]
 
+    # find the last segment starting at or before mono_time. The segment a 60s cadence
+    # would put it in is usually right, so that and the next one are checked before bisecting
+    lo, hi = 0, len(segments)
+    guess = self._first_log_idx + (mono_time - self.start_time) // int(60e9)
+    guess = min(bisect.bisect_left(segments, guess), len(segments) - 1)
+    for k in (guess, guess + 1):
+      if k >= hi:
+        break
+      if self._segment_start(segments[k]) <= mono_time:
+        lo = k + 1
+      else:
+        hi = k
+        break
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if self._segment_start(segments[mid]) <= mono_time:
+        lo = mid + 1
+      else:
+        hi = mid
+    seg = max(lo - 1, 0)
+
+    idx = int(np.searchsorted(self._segment_ts_max(segments[seg]), np.uint64(max(mono_time, 0)), side='left'))
+    if idx == len(self._log_reader(segments[seg])._ts):
+      # between segments, continue from the start of the next one
+      if seg + 1 == len(segments):
+        return False
+      seg, idx = seg + 1, 0
+
+    self._current_log = segments[seg]
+    self._idx = idx
+    self._update_prefetch()
+    return True
 
 class LogReader(object):
-  def __init__(self, fn, canonicalize=True, only_union_types=False):
+  def __init__(self, fn, canonicalize=True, only_union_types=False, log_data=None):
     data_version = None
-    _, ext = os.path.splitext(urllib.parse.urlparse(fn).path)
-    with FileReader(fn) as f:
-      dat = f.read()
-
-    if ext == "":
-      # old rlogs weren't bz2 compressed
-      ents = event_read_multiple_bytes(dat)
-    elif ext == ".bz2":
-      dat = bz2.decompress(dat)
-      ents = event_read_multiple_bytes(dat)
-    else:
-      raise Exception(f"unknown extension {ext}")
+    if log_data is None:
+      log_data = load_log_data(fn)
+    ents = LogEvents(*log_data)
 
-    self._ts = [x.logMonoTime for x in ents]
+    self._ts = np.fromiter((x.logMonoTime for x in ents), dtype=np.uint64, count=len(ents))
     self.data_version = data_version
     self._only_union_types = only_union_types
     self._ents = ents
 
   def __iter__(self):
-    for ent in self._ents:
+    for ent, _ in self.events_with_bytes():
+      yield ent
+
+  def events_with_bytes(self):
+    """(event, bytes of the event) of each event, without copying or reserializing it."""
+    for i, ent in enumerate(self._ents):
       if self._only_union_types:
         try:
           ent.which()
-          yield ent
         except capnp.lib.capnp.KjException:
-          pass
-      else:
-        yield ent
+          continue
+      yield ent, self._ents.raw(i)
 
 if __name__ == "__main__":
   log_path = sys.argv[1]
@@ -1,11 +1,48 @@
 #!/usr/bin/env python3
 
 import os
+import re
+import tempfile
+import threading
 import unittest
 import shutil
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from tools.lib import url_file
+from tools.lib.download_cache import DownloadCache
 from tools.lib.url_file import URLFile, CACHE_DIR
 
 
+class RangeRequestHandler(BaseHTTPRequestHandler):
+  data = os.urandom(int(url_file.CHUNK_SIZE * 3.5))
+  requests = []
+
+  def log_message(self, *args):
+    pass
+
+  def do_HEAD(self):
+    self.send_response(200)
+    self.send_header("Content-Length", str(len(self.data)))
+    self.end_headers()
+
+  def do_GET(self):
+    m = re.match(r"bytes=(\d+)-(\d+)", self.headers.get("Range", ""))
+    if m is None:
+      start, end = 0, len(self.data) - 1
+      self.send_response(200)
+    else:
+      start, end = int(m.group(1)), min(int(m.group(2)), len(self.data) - 1)
+      if start >= len(self.data):
+        self.send_response(416)
+        self.end_headers()
+        return
+      self.send_response(206)
+    self.requests.append((start, end))
+    self.send_header("Content-Length", str(end - start + 1))
+    self.end_headers()
+    self.wfile.write(self.data[start:end + 1])
+
+
 class TestFileDownload(unittest.TestCase):
 
   def compare_loads(self, url, start=0, length=None):
@@ -64,5 +101,117 @@ class TestFileDownload(unittest.TestCase):
     self.compare_loads(large_file_url)
 
 
+class TestLocalFileDownload(unittest.TestCase):
+  def setUp(self):
+    self.server = ThreadingHTTPServer(("127.0.0.1", 0), RangeRequestHandler)
+    threading.Thread(target=self.server.serve_forever, daemon=True).start()
+    self.url = f"http://127.0.0.1:{self.server.server_port}/rlog.bz2"
+    self.data = RangeRequestHandler.data
+    RangeRequestHandler.requests = []
+    shutil.rmtree(CACHE_DIR, ignore_errors=True)
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def test_parallel_read(self):
+    f = URLFile(self.url, cache=True)
+    f.seek(100)
+    self.assertEqual(f.read(ll=int(url_file.CHUNK_SIZE * 3)), self.data[100:100 + int(url_file.CHUNK_SIZE * 3)])
+    f.seek(0)
+    self.assertEqual(f.read(), self.data)
+
+  def test_uncached_read(self):
+    f = URLFile(self.url, cache=False)
+    f.seek(10)
+    self.assertEqual(f.read(ll=1000), self.data[10:1010])
+
+  def test_sequential_prefetch(self):
+    f = URLFile(self.url, cache=True)
+    with mock.patch.object(url_file, "PREFETCH_CHUNKS", 2):
+      self.assertEqual(f.read(ll=1000), self.data[:1000])
+      self.assertEqual(f.read(ll=1000), self.data[1000:2000])
+      # the pool has one worker, so this runs after the read ahead is done
+      url_file._prefetch_pool.submit(lambda: None).result()
+      n_requests = len(RangeRequestHandler.requests)
+      # the next chunks were read ahead and come from the cache
+      f.seek(url_file.CHUNK_SIZE)
+      self.assertEqual(f.read(ll=url_file.CHUNK_SIZE), self.data[url_file.CHUNK_SIZE:2 * url_file.CHUNK_SIZE])
+      self.assertEqual(len(RangeRequestHandler.requests), n_requests)
+
+  def test_read_after_failed_transfer(self):
+    f = URLFile(self.url, cache=True)
+    with mock.patch.object(URLFile, "_setup_curl", side_effect=[None, RuntimeError]):
+      with self.assertRaises(RuntimeError):
+        f.read(ll=url_file.CHUNK_SIZE * 2)
+    f.seek(0)
+    self.assertEqual(f.read(ll=url_file.CHUNK_SIZE * 2), self.data[:url_file.CHUNK_SIZE * 2])
+
+
+class TestDownloadCache(unittest.TestCase):
+  def setUp(self):
+    self.cache_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.cache_dir)
+
+  def test_lru_eviction(self):
+    cache = DownloadCache(self.cache_dir, max_bytes=3000)
+    for name in ["a", "b", "c"]:
+      cache.put(name, b"x" * 1000)
+    self.assertEqual(cache.get("a"), b"x" * 1000)
+
+    # b is the least recently used
+    cache.put("d", b"y" * 1000)
+    self.assertFalse(cache.contains("b"))
+    self.assertFalse(os.path.exists(os.path.join(self.cache_dir, "b")))
+    self.assertTrue(all(cache.contains(n) for n in ["a", "c", "d"]))
+    self.assertEqual(cache.total_bytes(), 3000)
+
+  def test_index_shared(self):
+    cache = DownloadCache(self.cache_dir)
+    cache.put("a", b"abc")
+    cache.get("a")
+    cache.get("missing")
+    cache.flush(force=True)
+
+    stats = DownloadCache(self.cache_dir).stats()
+    self.assertEqual(stats["files"], 1)
+    self.assertEqual(stats["hits"], 1)
+    self.assertEqual(stats["misses"], 1)
+    self.assertEqual(stats["bytes_saved"], 3)
+    self.assertAlmostEqual(stats["hit_rate"], 0.5)
+
+  def test_puts_are_not_lookups(self):
+    cache = DownloadCache(self.cache_dir)
+    cache.put("a", b"abc")
+    cache.put("b", b"abc")
+    stats = cache.stats()
+    self.assertEqual(stats["misses"], 0)
+    self.assertEqual(stats["bytes_downloaded"], 6)
+
+  def test_evicted_by_other_process(self):
+    cache = DownloadCache(self.cache_dir, max_bytes=2000)
+    cache.put("a", b"x" * 1000)
+    cache.flush(force=True)
+
+    other = DownloadCache(self.cache_dir, max_bytes=2000)
+    other.put("b", b"y" * 1500)
+    other.flush(force=True)
+    self.assertFalse(os.path.exists(os.path.join(self.cache_dir, "a")))
+
+    # a is still in this process' view, it mustn't come back into the index
+    cache.flush(force=True)
+    self.assertFalse(cache.contains("a"))
+    self.assertEqual(cache.stats()["files"], 1)
+
+  def test_removed_file(self):
+    cache = DownloadCache(self.cache_dir)
+    cache.put("a", b"abc")
+    os.remove(os.path.join(self.cache_dir, "a"))
+    self.assertIsNone(cache.get("a"))
+    self.assertFalse(cache.contains("a"))
+
+
 if __name__ == "__main__":
     unittest.main()
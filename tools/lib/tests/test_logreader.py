@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+import bz2
+import shutil
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+import numpy as np
+
+from cereal import log
+from tools.lib.exceptions import DataUnreadableError
+from tools.lib.logreader import LogEvents, LogIndex, MultiLogIterator, stream_log
+
+
+def make_log(n=1000):
+  msgs = []
+  for i in range(n):
+    w = "carState" if i % 3 == 0 else "controlsState"
+    msg = log.Event.new_message()
+    msg.init(w)
+    msg.logMonoTime = i * 10000000
+    msgs.append(msg)
+  return msgs
+
+
+class TestLogReader(unittest.TestCase):
+  def setUp(self):
+    self.msgs = make_log()
+    self.dat = b"".join(m.to_bytes() for m in self.msgs)
+
+  def _write(self, dat, suffix):
+    f = tempfile.NamedTemporaryFile(suffix=suffix)
+    f.write(dat)
+    f.flush()
+    return f
+
+  def test_stream_bz2(self):
+    with self._write(bz2.compress(self.dat), ".bz2") as f:
+      ts = [m.logMonoTime for m in stream_log(f.name, chunk_size=1000)]
+    self.assertEqual(ts, [m.logMonoTime for m in self.msgs])
+
+  def test_stream_uncompressed(self):
+    with self._write(self.dat, "") as f:
+      ts = [m.logMonoTime for m in stream_log(f.name, chunk_size=333)]
+    self.assertEqual(ts, [m.logMonoTime for m in self.msgs])
+
+  def test_stream_which(self):
+    with self._write(bz2.compress(self.dat), ".bz2") as f:
+      ents = list(stream_log(f.name, which="carState"))
+    self.assertEqual(len(ents), len([m for m in self.msgs if m.which() == "carState"]))
+    self.assertTrue(all(e.which() == "carState" for e in ents))
+
+  def test_stream_truncated(self):
+    ents = []
+    with self._write(bz2.compress(self.dat[:-5]), ".bz2") as f, self.assertRaises(DataUnreadableError):
+      for ent in stream_log(f.name):
+        ents.append(ent)
+    # the messages before the truncated one are read
+    self.assertEqual(len(ents), len(self.msgs) - 1)
+
+  def test_stream_corrupted(self):
+    # a segment table with too many segments between two messages
+    pos = sum(len(m.to_bytes()) for m in self.msgs[:10])
+    dat = self.dat[:pos] + b"\xff" * 8 + self.dat[pos:]
+    with self._write(dat, "") as f, self.assertRaises(DataUnreadableError):
+      list(stream_log(f.name))
+
+  def test_log_events(self):
+    idx = np.cumsum([0] + [len(m.to_bytes()) for m in self.msgs]).astype(np.uint64)
+    ents = LogEvents(self.dat, idx)
+    self.assertEqual(len(ents), len(self.msgs))
+    self.assertEqual([e.logMonoTime for e in ents], [m.logMonoTime for m in self.msgs])
+    self.assertEqual(ents[-1].logMonoTime, self.msgs[-1].logMonoTime)
+    self.assertEqual([e.which() for e in ents[5:8]], [m.which() for m in self.msgs[5:8]])
+    self.assertEqual(bytes(ents.raw(3)), self.msgs[3].to_bytes())
+    with self.assertRaises(IndexError):
+      ents[len(self.msgs)]
+
+  def test_log_index(self):
+    cache_dir = tempfile.mkdtemp()
+    try:
+      with mock.patch("tools.lib.cache.DEFAULT_CACHE_DIR", cache_dir), \
+           self._write(bz2.compress(self.dat), ".bz2") as f:
+        with LogIndex(f.name) as idx:
+          self.assertEqual(len(idx), len(self.msgs))
+          self.assertEqual(idx[10].logMonoTime, self.msgs[10].logMonoTime)
+
+        # second open must come from the cache
+        with mock.patch("tools.lib.logreader.LogIndex.build") as build, LogIndex(f.name) as idx:
+          t0, t1 = 100000000, 500000000
+          ts = [m.logMonoTime for m in idx.messages("carState", t0, t1)]
+          build.assert_not_called()
+
+        expected = [m.logMonoTime for m in self.msgs if m.which() == "carState" and t0 <= m.logMonoTime < t1]
+        self.assertEqual(ts, expected)
+    finally:
+      shutil.rmtree(cache_dir)
+
+  def test_log_index_source_changed(self):
+    cache_dir = tempfile.mkdtemp()
+    try:
+      with mock.patch("tools.lib.cache.DEFAULT_CACHE_DIR", cache_dir), \
+           self._write(bz2.compress(self.dat), ".bz2") as f:
+        with LogIndex(f.name) as idx:
+          self.assertEqual(len(idx), len(self.msgs))
+
+        # same path, different log
+        f.seek(0)
+        f.truncate()
+        f.write(bz2.compress(self.dat[:len(self.msgs[0].to_bytes())]))
+        f.flush()
+        with LogIndex(f.name) as idx:
+          self.assertEqual(len(idx), 1)
+    finally:
+      shutil.rmtree(cache_dir)
+
+
+class FakeLogReader(object):
+  def __init__(self, ts):
+    self._ts = np.array(ts, dtype=np.uint64)
+    self._ents = list(ts)
+
+
+class TestMultiLogIterator(unittest.TestCase):
+  def setUp(self):
+    # segments of uneven length, one missing, slightly unsorted within a segment
+    t0 = 1000 * 10**9
+    self.segments = {
+      0: [t0 + i * 10**8 for i in range(500)],
+      1: [t0 + 55 * 10**9 + i * 10**8 for i in range(700)],
+      3: [t0 + 190 * 10**9 + i * 10**8 for i in range(600)],
+    }
+    self.segments[1][10], self.segments[1][11] = self.segments[1][11], self.segments[1][10]
+    self.t0 = t0
+
+    start_time = mock.patch("tools.lib.logreader.log_start_time", lambda p: self.segments[int(p)][0])
+    start_time.start()
+    self.addCleanup(start_time.stop)
+
+    self.paths = [str(i) if i in self.segments else None for i in range(4)]
+    with mock.patch("tools.lib.logreader.LogReader", lambda p: FakeLogReader(self.segments[int(p)])):
+      self.lr = MultiLogIterator(self.paths, wraparound=False)
+      for i in self.segments:
+        self.lr._log_reader(i)
+
+  def _linear_seek(self, mono_time):
+    for seg in sorted(self.segments):
+      for t in self.segments[seg]:
+        if t >= mono_time:
+          return t
+    return None
+
+  def test_seek_mono(self):
+    for mono_time in range(self.t0 - 10**9, self.t0 + 260 * 10**9, 3 * 10**8 + 7):
+      expected = self._linear_seek(mono_time)
+      self.assertEqual(self.lr.seek_mono(mono_time), expected is not None)
+      if expected is not None:
+        self.assertAlmostEqual(self.lr.tell(), (expected - self.t0) * 1e-9)
+
+  def test_seek_loads_one_segment(self):
+    with mock.patch("tools.lib.logreader.LogReader", lambda p: FakeLogReader(self.segments[int(p)])):
+      for mono_time, seg in [(self.t0 + 200 * 10**9, 3), (self.t0 + 10 * 10**9, 0), (self.t0 + 100 * 10**9, 1)]:
+        lr = MultiLogIterator(self.paths, wraparound=False)
+        self.assertTrue(lr.seek_mono(mono_time))
+        self.assertEqual([i for i, r in enumerate(lr._log_readers) if r is not None], [seg])
+
+  def test_seek(self):
+    self.assertTrue(self.lr.seek(60.))
+    self.assertEqual(next(self.lr), self._linear_seek(self.t0 + 60 * 10**9))
+    self.assertAlmostEqual(self.lr.tell(), 60.1)
+    self.assertFalse(self.lr.seek(300.))
+
+  def test_prefetch(self):
+    paths = self.paths
+    with mock.patch("tools.lib.logreader.ProcessPoolExecutor", ThreadPoolExecutor), \
+         mock.patch("tools.lib.logreader.load_log_data", lambda p: self.segments[int(p)]), \
+         mock.patch("tools.lib.logreader.LogReader", lambda p, log_data=None: FakeLogReader(log_data)):
+      lr = MultiLogIterator(paths, wraparound=True, prefetch=1)
+      self.assertEqual(set(lr._futures.keys()), {1})
+
+      msgs = [next(lr) for _ in range(len(self.segments[0]) + 1)]
+      self.assertEqual(msgs, self.segments[0] + self.segments[1][:1])
+      # segment 0 is behind the cursor, segment 3 is next
+      self.assertIsNone(lr._log_readers[0])
+      self.assertEqual(set(lr._futures.keys()), {3})
+
+      self.assertTrue(lr.seek(0.))
+      self.assertEqual(next(lr), self.segments[0][0])
+      self.assertIsNone(lr._log_readers[3])
+      lr.close()
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -6,15 +6,26 @@ import tempfile
 import threading
 import urllib.parse
 import pycurl
+from concurrent.futures import ThreadPoolExecutor, wait
 from hashlib import sha256
 from io import BytesIO
 from tenacity import retry, wait_random_exponential, stop_after_attempt
 from tools.lib.file_helpers import mkdirs_exists_ok, atomic_write_in_dir
+from tools.lib.download_cache import DownloadCache
 #  Cache chunk size
 K = 1000
 CHUNK_SIZE = 1000 * K
+#  Number of chunks downloaded in parallel, and read ahead on sequential reads
+MAX_CONNECTIONS = 8
+PREFETCH_CHUNKS = 4
 
 CACHE_DIR = "/tmp/comma_download_cache/"
+download_cache = DownloadCache(CACHE_DIR)
+
+#  Read ahead happens on a background thread, chunk name -> future of the download it's in
+_prefetch_pool = ThreadPoolExecutor(max_workers=1)
+_prefetching = {}
+_prefetching_lock = threading.Lock()
 
 
 def hash_256(link):
@@ -31,6 +42,7 @@ class URLFile(object):
     self._length = None
     self._local_file = None
     self._debug = debug
+    self._last_read_end = None
     #  True by default, false if FILEREADER_CACHE is defined, but can be overwritten by the cache input
     self._force_download = not int(os.environ.get("FILEREADER_CACHE", "0"))
     if cache is not None:
@@ -42,6 +54,16 @@ class URLFile(object):
       self._curl = self._tlocal.curl = pycurl.Curl()
     mkdirs_exists_ok(CACHE_DIR)
 
+  @classmethod
+  def _curl_multi(cls):
+    # handles stay in the pool between reads so connections are reused
+    try:
+      return cls._tlocal.multi, cls._tlocal.multi_curls
+    except AttributeError:
+      cls._tlocal.multi = pycurl.CurlMulti()
+      cls._tlocal.multi_curls = [pycurl.Curl() for _ in range(MAX_CONNECTIONS)]
+      return cls._tlocal.multi, cls._tlocal.multi_curls
+
   def __enter__(self):
     return self
 
@@ -81,6 +103,10 @@ class URLFile(object):
         file_length.write(str(self._length))
     return self._length
 
+  def _chunk_name(self, position):
+    chunk_number = position / CHUNK_SIZE
+    return hash_256(self._url) + "_" + str(chunk_number)
+
   def read(self, ll=None):
     if self._force_download:
       return self.read_aux(ll=ll)
@@ -89,28 +115,138 @@ class URLFile(object):
     file_end = self._pos + ll if ll is not None else self.get_length()
     #  We have to allign with chunks we store. Position is the begginiing of the latest chunk that starts before or at our file
     position = (file_begin // CHUNK_SIZE) * CHUNK_SIZE
-    response = b""
-    while True:
-      self._pos = position
-      chunk_number = self._pos / CHUNK_SIZE
-      file_name = hash_256(self._url) + "_" + str(chunk_number)
-      full_path = os.path.join(CACHE_DIR, str(file_name))
-      data = None
-      #  If we don't have a file, download it
-      if not os.path.exists(full_path):
-        data = self.read_aux(ll=CHUNK_SIZE)
-        with atomic_write_in_dir(full_path, mode="wb") as new_cached_file:
-          new_cached_file.write(data)
-      else:
-        with open(full_path, "rb") as cached_file:
-          data = cached_file.read()
-
-      response += data[max(0, file_begin - position): min(CHUNK_SIZE, file_end - position)]
-
-      position += CHUNK_SIZE
-      if position >= file_end:
-        self._pos = file_end
-        return response
+    positions = list(range(position, max(file_end, position + 1), CHUNK_SIZE))
+
+    #  Read ahead when the caller is going through the file sequentially
+    prefetch = []
+    if file_begin == self._last_read_end:
+      next_position = positions[-1] + CHUNK_SIZE
+      prefetch_end = min(next_position + PREFETCH_CHUNKS * CHUNK_SIZE, self.get_length())
+      prefetch = list(range(next_position, prefetch_end, CHUNK_SIZE))
+
+    #  Chunks that are being read ahead are waited for, everything else is downloaded in parallel
+    self._wait_prefetch(positions)
+    chunks = {p: download_cache.get(self._chunk_name(p)) for p in positions}
+    missing = [p for p in positions if chunks[p] is None]
+    self._prefetch(prefetch)
+    for p, data in self._download_chunks(missing).items():
+      download_cache.put(self._chunk_name(p), data)
+      chunks[p] = data
+
+    response = bytearray(max(0, file_end - file_begin))
+    response_len = 0
+    for p in positions:
+      chunk = memoryview(chunks[p])[max(0, file_begin - p): min(CHUNK_SIZE, file_end - p)]
+      response[response_len:response_len + len(chunk)] = chunk
+      response_len += len(chunk)
+
+    self._pos = file_end
+    self._last_read_end = file_end
+    del response[response_len:]
+    return bytes(response)
+
+  def _prefetch(self, positions):
+    with _prefetching_lock:
+      names = {p: self._chunk_name(p) for p in positions}
+      todo = [p for p in positions if names[p] not in _prefetching and not download_cache.contains(names[p])]
+      if not todo:
+        return
+
+      future = _prefetch_pool.submit(self._prefetch_chunks, todo)
+      for p in todo:
+        _prefetching[names[p]] = future
+
+    def done(_):
+      with _prefetching_lock:
+        for p in todo:
+          _prefetching.pop(names[p], None)
+    future.add_done_callback(done)
+
+  def _prefetch_chunks(self, positions):
+    #  failed chunks are left to the read that needs them
+    for p, data in self._download_chunks(positions, retry_failed=False).items():
+      download_cache.put(self._chunk_name(p), data)
+
+  def _wait_prefetch(self, positions):
+    with _prefetching_lock:
+      futures = {_prefetching[n] for n in map(self._chunk_name, positions) if n in _prefetching}
+    wait(futures)
+
+  def _setup_curl(self, c, headers, dats):
+    c.setopt(pycurl.URL, self._url)
+    c.setopt(pycurl.WRITEDATA, dats)
+    c.setopt(pycurl.NOSIGNAL, 1)
+    c.setopt(pycurl.TIMEOUT_MS, 500000)
+    c.setopt(pycurl.HTTPHEADER, headers)
+    c.setopt(pycurl.FOLLOWLOCATION, True)
+
+  def _check_response(self, response_code, download_range, headers, dats):
+    if response_code == 416:  # Requested Range Not Satisfiable
+      raise Exception(f"Error, range out of bounds {response_code} {headers} ({self._url}): {repr(dats.getvalue())[:500]}")
+    if download_range and response_code != 206:  # Partial Content
+      raise Exception(f"Error, requested range but got unexpected response {response_code} {headers} ({self._url}): {repr(dats.getvalue())[:500]}")
+    if (not download_range) and response_code != 200:  # OK
+      raise Exception(f"Error {response_code} {headers} ({self._url}): {repr(dats.getvalue())[:500]}")
+
+  def _download_chunks(self, positions, retry_failed=True):
+    """Downloads whole chunks starting at positions over a pool of connections."""
+    if self._debug and len(positions) > 0:
+      print("downloading", self._url, "chunks", [p // CHUNK_SIZE for p in positions])
+
+    multi, curls = self._curl_multi()
+    pending = list(positions)
+    free = list(curls)
+    active = {}
+    failed = []
+    ret = {}
+    try:
+      while pending or active:
+        while pending and free:
+          p = pending.pop(0)
+          c = free.pop()
+          dats = BytesIO()
+          c.reset()
+          self._setup_curl(c, ["Connection: keep-alive", f"Range: bytes={p}-{p + CHUNK_SIZE - 1}"], dats)
+          multi.add_handle(c)
+          active[c] = (p, dats)
+
+        while multi.perform()[0] == pycurl.E_CALL_MULTI_PERFORM:
+          pass
+
+        while True:
+          num_queued, ok_list, err_list = multi.info_read()
+          for c in ok_list:
+            p, dats = active.pop(c)
+            multi.remove_handle(c)
+            if c.getinfo(pycurl.RESPONSE_CODE) == 206:
+              ret[p] = dats.getvalue()
+            else:
+              failed.append(p)
+            free.append(c)
+          for c, _, _ in err_list:
+            p, _ = active.pop(c)
+            multi.remove_handle(c)
+            failed.append(p)
+            free.append(c)
+          if num_queued == 0:
+            break
+
+        if active:
+          multi.select(1.0)
+    finally:
+      #  handles left attached to the shared multi would break every later read
+      for c in active:
+        multi.remove_handle(c)
+
+    if not retry_failed:
+      return ret
+
+    #  Retry failures one at a time, this raises on persistent errors
+    for p in failed:
+      self._pos = p
+      ret[p] = self.read_aux(ll=CHUNK_SIZE)
+
+    return ret
 
   @retry(wait=wait_random_exponential(multiplier=1, max=5), stop=stop_after_attempt(3), reraise=True)
   def read_aux(self, ll=None):
@@ -123,12 +259,7 @@ class URLFile(object):
 
     dats = BytesIO()
     c = self._curl
-    c.setopt(pycurl.URL, self._url)
-    c.setopt(pycurl.WRITEDATA, dats)
-    c.setopt(pycurl.NOSIGNAL, 1)
-    c.setopt(pycurl.TIMEOUT_MS, 500000)
-    c.setopt(pycurl.HTTPHEADER, headers)
-    c.setopt(pycurl.FOLLOWLOCATION, True)
+    self._setup_curl(c, headers, dats)
 
     if self._debug:
       print("downloading", self._url)
@@ -153,13 +284,7 @@ class URLFile(object):
       if t2 - t1 > 0.1:
         print("get %s %r %.f slow" % (self._url, headers, t2 - t1))
 
-    response_code = c.getinfo(pycurl.RESPONSE_CODE)
-    if response_code == 416:  # Requested Range Not Satisfiable
-      raise Exception(f"Error, range out of bounds {response_code} {headers} ({self._url}): {repr(dats.getvalue())[:500]}")
-    if download_range and response_code != 206:  # Partial Content
-      raise Exception(f"Error, requested range but got unexpected response {response_code} {headers} ({self._url}): {repr(dats.getvalue())[:500]}")
-    if (not download_range) and response_code != 200:  # OK
-      raise Exception(f"Error {response_code} {headers} ({self._url}): {repr(dats.getvalue())[:500]}")
+    self._check_response(c.getinfo(pycurl.RESPONSE_CODE), download_range, headers, dats)
 
     ret = dats.getvalue()
     self._pos += len(ret)
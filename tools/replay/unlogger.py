@@ -33,8 +33,10 @@ StopAndQuit = namedtuple("StopAndQuit", ())
 
 
 class UnloggerWorker(object):
-  def __init__(self):
+  def __init__(self, prefetch=0):
+    self._prefetch = prefetch
     self._frame_reader = None
+    self._lr = None
     self._cookie = None
     self._readahead = deque()
 
@@ -122,7 +124,9 @@ class UnloggerWorker(object):
     if route is None or (isinstance(cmd, SetRoute) and route.name != cmd.name):
       seek_to = cmd.start_time
       route = Route(cmd.name, cmd.data_dir)
-      self._lr = MultiLogIterator(route.log_paths(), wraparound=True)
+      if self._lr is not None:
+        self._lr.close()
+      self._lr = MultiLogIterator(route.log_paths(), wraparound=True, prefetch=self._prefetch)
       if self._frame_reader is not None:
         self._frame_reader.close()
       if "frame" in pub_types or "encodeIdx" in pub_types:
@@ -376,6 +380,10 @@ def get_arg_parser():
     "--bind-early", action="store_true", default=False,
     help="Bind early to avoid dropping messages.")
 
+  parser.add_argument(
+    "--prefetch", type=int, default=2,
+    help="Number of upcoming segments to decode in the background, 0 to disable.")
+
   return parser
 
 def main(argv):
@@ -405,7 +413,7 @@ def main(argv):
   subprocesses = {}
   try:
     subprocesses["data"] = multiprocessing.Process(
-      target=UnloggerWorker().run,
+      target=UnloggerWorker(args.prefetch).run,
       args=(forward_commands_address, data_address, address_mapping.copy()))
 
     subprocesses["control"] = multiprocessing.Process(